@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Benchmark whole extractions against a fake elasticsearch (see fake_es.py) for the
+csv, json lines, json, dataframe, parquet and feather outputs. Every output is run in a fresh process
+and the docs/sec, peak RSS and time spent in each stage are written as JSON so
+runs can be compared over time.
+
+    python benchmarks/extract.py --docs 200000 --width 20 --depth 3 --out results.json
+
+Stages are the time summed over every call, with several workers they overlap:
+    server: the fake elasticsearch rendering responses (not part of esextract)
+    decode: the client's serializer decoding responses
+    search: page requests in total, including server and decode
+    clean: extracting the return fields from the hits
+    write: the csv, json lines, parquet or feather page writers
+    other: the rest of the wall time (e.g. counting, building the DataFrame)
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, "..", "esextract", "src"))
+sys.path.insert(0, BENCHMARKS)
+
+import esextract
+import fake_es
+
+
+OUTPUTS = ["csv", "jsonl", "json", "dataframe", "parquet", "feather"]
+
+
+def _timed(stages:dict, stage:str, function):
+    """ Wrap function so the time spent in it is added to stages[stage].
+    """
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stages[stage] += time.perf_counter() - start
+    return timed
+
+
+def _instrument(stages:dict, client) -> None:
+    """ Patch the stages of the extraction with timers.
+    """
+    fake_es.FakeConnection.perform_request = _timed(stages, "server", fake_es.FakeConnection.perform_request)
+    serializer = client.transport.serializer
+    serializer.loads = _timed(stages, "decode", serializer.loads)
+    esextract._search_page = _timed(stages, "search", esextract._search_page)
+    esextract._clean_page = _timed(stages, "clean", esextract._clean_page)
+    for writer in (esextract._CsvPageWriter, esextract._JsonLinesPageWriter, esextract._ParquetPageWriter):  # Feather inherits from parquet
+        writer.write = _timed(stages, "write", writer.write)
+        writer.close = _timed(stages, "write", writer.close)
+
+
+def _peak_rss_mb() -> float:
+    """ The peak resident memory of this process so far in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # Bytes on macOS, KB on linux
+
+
+def run_output(output:str, config:dict) -> dict:
+    """ Run one extraction to the given output and measure it, meant to be run in a
+    fresh process so the peak RSS belongs to this output alone.
+    """
+    dataset = fake_es.Dataset(config["docs"], config["width"], config["depth"])
+    client = fake_es.client(dataset, esextract._get_serializer(config["serializer"]))
+    stages = dict.fromkeys(["server", "decode", "search", "clean", "write"], 0.0)
+    _instrument(stages, client)
+    query = {"index": "bench", "paging_id_field": "id", "paging_time_field": "created_at", "return_fields": dataset.return_fields(),
+             "is_match_all": True, "workers": config["workers"], "max_page_size": config["page_size"], "client": client}
+    baseline_rss = _peak_rss_mb()
+
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        if output == "json":
+            rows = len(esextract.query_to_json(**query)["data"])
+        elif output == "dataframe":
+            rows = len(esextract.query_to_dataframe(**query))
+        else:
+            esextract.query_to_file(os.path.join(directory, f"bench.{output}"), **query)
+            rows = dataset.docs
+        seconds = time.perf_counter() - start
+
+    if rows != dataset.docs:
+        raise Exception(f"{output} returned {rows} documents, expected {dataset.docs}")
+
+    stages = {stage: round(value, 4) for stage, value in stages.items()}
+    stages["other"] = round(max(0.0, seconds - stages["search"] - stages["clean"] - stages["write"]), 4)
+    return {"output": output, "docs": rows, "seconds": round(seconds, 4), "docs_per_sec": round(rows / seconds, 1),
+            "baseline_rss_mb": round(baseline_rss, 1), "peak_rss_mb": round(_peak_rss_mb(), 1), "stages": stages}
+
+
+def _child(output:str, config:dict, results:multiprocessing.Queue) -> None:
+    try:
+        results.put(run_output(output, config))
+    except Exception as e:
+        results.put({"output": output, "error": repr(e)})
+
+
+def _git_commit() -> str:
+    """ The commit of the checkout being benchmarked, None outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser("Benchmark extractions against a fake elasticsearch")
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--width", help="Fields per document", type=int, default=10)
+    parser.add_argument("--depth", help="Nesting depth of every field", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--page_size", help="Largest page size", type=int, default=10000)
+    parser.add_argument("--serializer", default="auto", choices=["auto", "orjson", "json"])
+    parser.add_argument("--outputs", help="Outputs to run", nargs="+", default=OUTPUTS, choices=OUTPUTS)
+    parser.add_argument("--repeat", help="Runs per output, the fastest is kept", type=int, default=1)
+    parser.add_argument("--out", help="Write the results to this file instead of stdout", default=None)
+    args = parser.parse_args()
+
+    config = {"docs": args.docs, "width": args.width, "depth": args.depth, "workers": args.workers,
+              "page_size": args.page_size, "serializer": args.serializer}
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for output in args.outputs:
+        best = None
+        for n in range(args.repeat):
+            queue = context.Queue()
+            process = context.Process(target=_child, args=(output, config, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            if "error" in result or best == None or result["seconds"] < best["seconds"]:
+                best = result
+            if "error" in result:
+                break
+        print(f"{output}: {best.get('docs_per_sec', best.get('error'))} docs/sec", file=sys.stderr)
+        results.append(best)
+
+    report = {"benchmark": "extract", "time": datetime.datetime.now(datetime.timezone.utc).isoformat(), "commit": _git_commit(),
+              "python": platform.python_version(), "platform": platform.platform(), "config": config, "results": results}
+    if args.out == None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
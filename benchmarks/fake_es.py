@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""A stand-in for an Elasticsearch cluster used by the benchmarks. FakeConnection
+replaces the http connection of a real Elasticsearch client, so requests still go
+through the client's transport and serializer, and serves synthetic documents
+from a point in time with search_after paging, time windows and slices.
+
+    es = fake_es.client(fake_es.Dataset(docs=100000, width=20, depth=3))
+"""
+
+import json
+import random
+
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Connection
+from elasticsearch.exceptions import RequestError
+
+
+BASE_TIME = 1600000000000  # created_at of the first document in epoch milliseconds
+TIME_STEP = 1000  # Milliseconds between documents
+
+
+class Dataset:
+    """ Synthetic documents numbered 0 to docs - 1, sorted by created_at then id.
+    Every document has an id, a created_at and width fields nested depth levels
+    deep, every fifth field is a list of two objects. The bodies are rendered from
+    a small pool of templates so the fake server's memory stays flat.
+    """
+    def __init__(self, docs:int =100000, width:int =10, depth:int =2, templates:int =64, seed:int =0):
+        self.docs = docs
+        self.width = width
+        self.depth = depth
+        r = random.Random(seed)
+        self.templates = []
+        for n in range(templates):
+            body = json.dumps({f"f{k}": self._field(k, r) for k in range(width)}, separators=(",", ":"))
+            self.templates.append(body[1:])  # Drop the opening brace, id and created_at go first
+
+    def _field(self, k:int, r:random.Random):
+        """ Build the value of field k, nested depth levels deep.
+        """
+        leaf = (r.randint(0, 10**9), "x" * r.randint(5, 60), r.random(), r.random() > 0.5)[k % 4]
+        for level in reversed(range(1, self.depth)):
+            leaf = {f"l{level}": leaf}
+        if k % 5 == 4:
+            return [leaf, leaf]
+        return leaf
+
+    def return_fields(self) -> list:
+        """ Every leaf field of the documents.
+        """
+        return ["id", "created_at"] + [".".join([f"f{k}"] + [f"l{level}" for level in range(1, self.depth)]) for k in range(self.width)]
+
+    def source(self, num:int) -> str:
+        """ The json _source of document num.
+        """
+        return '{"id":%d,"created_at":%d,%s' % (num, BASE_TIME + num * TIME_STEP, self.templates[num % len(self.templates)])
+
+
+def _time_range(body:dict, docs:int) -> (int, int):
+    """ The document numbers matching the range filters of a query body.
+    """
+    lower, upper = 0, docs
+    must_not = body.get("query", {}).get("bool", {}).get("must_not", [])
+    if any(condition.get("exists", {}).get("field") == "created_at" for condition in (must_not if type(must_not) is list else [must_not])):
+        return 0, 0  # Every document has a created_at
+    filters = body.get("query", {}).get("bool", {}).get("filter", [])
+    for condition in filters if type(filters) is list else [filters]:
+        bounds = condition.get("range", {}).get("created_at")
+        if bounds == None:
+            continue
+        if "gte" in bounds:
+            lower = max(lower, -(-(int(bounds["gte"]) - BASE_TIME) // TIME_STEP))
+        if "lt" in bounds:
+            upper = min(upper, -(-(int(bounds["lt"]) - BASE_TIME) // TIME_STEP))
+    return max(lower, 0), max(upper, 0)
+
+
+class FakeConnection(Connection):
+    """ Answers the requests esextract makes from the dataset instead of the network.
+    Set FakeConnection.dataset before creating the client.
+    """
+    dataset = Dataset()
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        body = json.loads(body) if body else {}
+        params = params or {}
+        data = self.dataset
+
+        if url == "/":
+            response = {"version": {"number": "7.17.0", "build_flavor": "default"}, "tagline": "You Know, for Search"}
+        elif url.endswith("/_pit"):
+            response = {"id": "fake-pit"} if method == "POST" else {"succeeded": True, "num_freed": 1}
+        elif url.endswith("/_count"):
+            if set(body) - {"query"}:  # Like elasticsearch, the count api only takes a query
+                raise RequestError(400, "parsing_exception", f"request does not support [{sorted(set(body) - {'query'})[0]}]")
+            lower, upper = _time_range(body, data.docs)
+            response = {"count": upper - lower}
+        elif url.endswith("/_search") and "aggs" in body:
+            lower, upper = _time_range(body, data.docs)
+            found = upper > lower
+            response = {"pit_id": "fake-pit", "hits": {"total": {"value": upper - lower, "relation": "eq"}, "hits": []},
+                        "aggregations": {"min_time": {"value": BASE_TIME + lower * TIME_STEP if found else None},
+                                         "max_time": {"value": BASE_TIME + (upper - 1) * TIME_STEP if found else None}}}
+        elif url.endswith("/_search"):
+            return 200, {"content-type": "application/json"}, self._page(body, int(params.get("size", 10)))
+        else:
+            raise Exception(f"Fake elasticsearch can not answer {method} {url}")
+
+        return 200, {"content-type": "application/json", "X-Elastic-Product": "Elasticsearch"}, json.dumps(response)
+
+    def _page(self, body:dict, size:int) -> str:
+        """ Render a page of hits after the search_after marker.
+        """
+        data = self.dataset
+        lower, upper = _time_range(body, data.docs)
+        sort_fields = [list(field)[0] for field in body.get("sort", [{"_shard_doc": "asc"}])]
+
+        start = lower
+        if body.get("search_after"):
+            after = body["search_after"][0]
+            start = max(lower, ((after - BASE_TIME) // TIME_STEP if sort_fields[0] == "created_at" else after) + 1)
+
+        step = 1
+        first = lower
+        if "slice" in body:
+            step = body["slice"]["max"]
+            start += (body["slice"]["id"] - start) % step
+            first += (body["slice"]["id"] - first) % step
+
+        hits = []
+        for num in range(start, upper, step)[:size]:
+            sort = [BASE_TIME + num * TIME_STEP if field == "created_at" else num for field in sort_fields]
+            hits.append('{"_source":%s,"sort":%s}' % (data.source(num), json.dumps(sort)))
+
+        total = ""
+        if body.get("track_total_hits"):  # Counted over the whole query, not just after search_after
+            total = '"total":{"value":%d,"relation":"eq"},' % len(range(first, upper, step))
+        if not hits and not total:  # filter_path drops empty hits
+            return '{"pit_id":"fake-pit"}'
+        return '{"pit_id":"fake-pit","hits":{%s"hits":[%s]}}' % (total, ",".join(hits))
+
+
+def client(dataset:Dataset, serializer=None) -> Elasticsearch:
+    """ Return a real Elasticsearch client whose requests are answered from dataset.
+    """
+    FakeConnection.dataset = dataset
+    kwargs = {"serializer": serializer} if serializer != None else {}
+    return Elasticsearch(["fake"], connection_class=FakeConnection, **kwargs)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Benchmark how quickly the command line gets going: the time to import esextract
+and the time from launching python to the first search request of a csv download
+against a fake elasticsearch (see fake_es.py). Every run is a fresh process so
+nothing is already imported, and the heavy modules loaded by then are listed.
+
+    python benchmarks/startup.py --repeat 5 --out startup.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ["pandas", "pyarrow", "numpy", "yaml", "orjson", "aiohttp"]
+
+
+def _child(out:str) -> None:
+    """ Run the command line until its first search request, then report and exit.
+    """
+    start = time.perf_counter()
+    sys.path.insert(0, os.path.join(BENCHMARKS, "..", "esextract", "src"))
+    import esextract
+    imported = time.perf_counter()
+
+    sys.path.insert(0, BENCHMARKS)
+    import fake_es
+    perform_request = fake_es.FakeConnection.perform_request
+
+    def first_search(self, method, url, *args, **kwargs):
+        if url.endswith("/_search"):
+            print(json.dumps({"import_seconds": imported - start, "first_request_seconds": time.perf_counter() - start,
+                              "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules]}), flush=True)
+            os._exit(0)
+        return perform_request(self, method, url, *args, **kwargs)
+
+    fake_es.FakeConnection.perform_request = first_search
+    dataset = fake_es.Dataset(1000)
+    esextract.get_client = lambda *args, **kwargs: fake_es.client(dataset)
+    sys.argv = ["esextract", "--match_all", "-i", "bench", "-f", " ".join(dataset.return_fields()), "-pi", "id", "-pt", "created_at",
+                "-o", out, "--log_level", "WARNING"]
+    esextract.main()
+    raise Exception("The command line finished without a search request")
+
+
+def run_once() -> dict:
+    """ Launch a fresh python running the command line and time it.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", os.path.join(directory, "out.csv")])
+        launched = time.perf_counter() - start
+
+    result = json.loads(output.decode().splitlines()[-1])
+    result["launch_to_first_request_seconds"] = launched  # Includes starting the interpreter
+    return {key: round(value, 4) if type(value) is float else value for key, value in result.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser("Benchmark the command line startup")
+    parser.add_argument("--repeat", help="Runs, the fastest is kept", type=int, default=5)
+    parser.add_argument("--out", help="Write the results to this file instead of stdout", default=None)
+    parser.add_argument("--child", help=argparse.SUPPRESS, default=None)
+    args = parser.parse_args()
+
+    if args.child != None:
+        _child(args.child)
+        return
+
+    runs = [run_once() for n in range(args.repeat)]
+    best = min(runs, key=lambda run: run["launch_to_first_request_seconds"])
+    print(f"first request after {best['launch_to_first_request_seconds']}s, import {best['import_seconds']}s", file=sys.stderr)
+
+    sys.path.insert(0, BENCHMARKS)
+    from extract import _git_commit
+    report = {"benchmark": "startup", "time": datetime.datetime.now(datetime.timezone.utc).isoformat(), "commit": _git_commit(),
+              "python": platform.python_version(), "platform": platform.platform(), "results": [best]}
+    if args.out == None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,111 @@
 """A simple library for interacting with elasticsearch databases.
 """
 
+from __future__ import annotations  # Keeps the pandas and pyarrow annotations from importing them
+
 import argparse
+import asyncio
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing, contextmanager, nullcontext
+from functools import lru_cache, partial, reduce
+import copy
 import csv
+import datetime
+import gzip
+import hashlib
+import importlib
+import io
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError, TransportError
+from elasticsearch.serializer import JSONSerializer
 import os
-import pandas
 import json
-import pyarrow as pa
-import pyarrow.parquet as pq
+import logging
+import queue
+import random
+import threading
+import time
+from urllib.parse import quote
+
+try:
+    import orjson
+except ImportError:  # Optional, install esextract[fast] for faster response decoding
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # Optional, install esextract[zstd] for .zst outputs
+    zstandard = None
+
+
+class _LazyModule:
+    """ Stands in for a module that is only imported when one of its attributes is
+    first used. pandas and pyarrow take most of the import time of esextract and
+    are only needed for DataFrames and parquet, so csv and json downloads (and the
+    command line) start without them.
+    """
+    def __init__(self, name:str, extra:str):
+        self._name = name
+        self._extra = extra
+        self._module = None
+
+    def __getattr__(self, attr:str):
+        if self._module == None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError as e:
+                raise ImportError(f"Error: DataFrame and parquet support needs {self._name.split('.')[0]}, install it with 'pip install esextract[{self._extra}]'.") from e
+        return getattr(self._module, attr)
+
+
+pandas = _LazyModule("pandas", "dataframe")  # Optional, install esextract[dataframe] for DataFrames and parquet
+pa = _LazyModule("pyarrow", "dataframe")
+pq = _LazyModule("pyarrow.parquet", "dataframe")
+pc = _LazyModule("pyarrow.compute", "dataframe")
+pads = _LazyModule("pyarrow.dataset", "dataframe")
+pacsv = _LazyModule("pyarrow.csv", "dataframe")
+pajson = _LazyModule("pyarrow.json", "dataframe")
+
+
+_PIT_KEEP_ALIVE = "5m"  # How long each point in time is kept open between page requests
+_SHARD_DOC_MAX = 2**63 - 1  # The largest _shard_doc sort value
+_STATE_LOCK = threading.Lock()  # Guards read-modify-write of the incremental state store
+_CACHE_LOCK = threading.Lock()  # Guards read-modify-write of the result cache index
+_CLIENTS = {}  # Shared elasticsearch clients keyed by connection settings, see get_client
+_CLIENTS_LOCK = threading.Lock()
+_SOURCE_FILTER_PATH = "pit_id,hits.total,hits.hits._source,hits.hits.sort"  # Strip the hit metadata from pages
+_FIELDS_FILTER_PATH = "pit_id,hits.total,hits.hits.fields,hits.hits.sort"
+_RESPONSE_STATS = threading.local()  # Size and decode time of the last response decoded on this thread, see _JSONSerializer
+_TARGET_PAGE_BYTES = 32 * 2**20  # Page size controller aims for responses of about this size
+_TARGET_PAGE_SECONDS = 5  # and about this long per request
+_SEARCH_RETRIES = 6  # Times a page request is retried with backoff on 429, 5xx and timeouts
+_BACKOFF_BASE = 0.5  # Seconds, doubled every retry
+_BACKOFF_MAX = 60
+_STAGES = ("request", "decode", "clean", "write")  # Timed stages of every page, see _Metrics
+_COUNT_MODES = ("hits", "exact", "none")  # How the documents matching a query are counted, see _Metrics
+_PROMETHEUS_INTERVAL = 1  # Seconds between rewrites of a prometheus textfile
+_COMPOSITE_PAGE_SIZE = 1000  # Buckets per composite aggregation page
+_CALENDAR_INTERVALS = ("minute", "1m", "hour", "1h", "day", "1d", "week", "1w", "month", "1M", "quarter", "1q", "year", "1y")
+_METRIC_AGGREGATIONS = ("sum", "avg", "min", "max", "value_count", "cardinality")
+_MAX_OPEN_PARTITIONS = 64  # Part files kept open at once when writing a partitioned dataset
+_HIVE_DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"  # Partition of documents missing the partition field
+_OUTPUT_EXTENSIONS = (".csv", ".jsonl", ".parquet", ".feather", ".arrow",  # Output formats of the page writers
+                      ".csv.gz", ".csv.zst", ".jsonl.gz", ".jsonl.zst")
+_COMPRESSION_EXTENSIONS = {".gz": "gzip", ".zst": "zstd"}  # Compressed csv and json lines outputs
+_GZIP_LEVEL = 6
+_ZSTD_LEVEL = 3
+_WRITER_QUEUE_SIZE = 4  # Pages waiting for the background writer before the download blocks
+_DATASET_FORMATS = {"csv": "csv", "jsonl": "json", "parquet": "parquet", "feather": "ipc", "arrow": "ipc"}  # pyarrow.dataset format of each
+_JSON_LINES_CHUNK = 100000  # Rows encoded at a time when writing a DataFrame as json lines
+_MAPPING_TYPES = {"long": "int64", "integer": "int32", "short": "int16", "byte": "int8", "unsigned_long": "uint64",  # Arrow type of each elasticsearch field type, see _mapping_schema
+                  "double": "double", "float": "float", "half_float": "float", "scaled_float": "double", "boolean": "bool",
+                  "date": "timestamp[ms]", "date_nanos": "timestamp[ns]", "keyword": "string", "constant_keyword": "string",
+                  "wildcard": "string", "text": "string", "match_only_text": "string", "ip": "string", "version": "string"}
+_MAPPING_DATE_FORMATS = {"strict_date_optional_time", "date_optional_time", "strict_date_optional_time_nanos", "strict_date_time",  # Date formats that cast to timestamps
+                         "date_time", "strict_date", "date", "epoch_millis"}
+
+logger = logging.getLogger(__name__)
 
 
 def _get_env_variables() -> (str, str, str, str):
@@ -29,6 +126,126 @@ def _get_env_variables() -> (str, str, str, str):
     return host, port, username, password
 
 
+class _JSONSerializer(JSONSerializer):
+    """ The standard library serializer, also recording the size and decode time of
+    every response so the page size controller and metrics can see them.
+    """
+    def loads(self, s):
+        start = time.perf_counter()
+        data = self._decode(s)
+        _RESPONSE_STATS.bytes = len(s)
+        _RESPONSE_STATS.seconds = time.perf_counter() - start
+        return data
+
+    def _decode(self, s):
+        return JSONSerializer.loads(self, s)
+
+
+class _OrjsonSerializer(_JSONSerializer):
+    """ Elasticsearch serializer that decodes and encodes with orjson, falling back to
+    the standard library for anything orjson rejects.
+    """
+    def _decode(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return JSONSerializer.loads(self, s)
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode("utf-8")
+        except TypeError:
+            return super().dumps(data)
+
+
+def _get_serializer(serializer:str ="auto") -> JSONSerializer:
+    """ Pick the json serializer for a client.
+
+    Args:
+        serializer (str): 'orjson', 'json' for the standard library, or 'auto' to use
+            orjson when it is installed
+
+    Returns:
+        JSONSerializer: the serializer
+    """
+    if serializer == "orjson" and orjson == None:
+        raise Exception("Error: the 'orjson' serializer needs the orjson package, install it with 'pip install esextract[fast]'.")
+    elif serializer not in ("auto", "orjson", "json"):
+        raise Exception("Invalid serializer please use either 'auto', 'orjson' or 'json'")
+
+    if serializer != "json" and orjson != None:
+        return _OrjsonSerializer()
+
+    return _JSONSerializer()
+
+
+def get_client(host:str =None, port:str =None, username:str =None, password:str =None, pool_size:int =10, timeout:int =30, max_retries:int =0, http_compress:bool =False, serializer:str ="auto") -> Elasticsearch:
+    """ Return a shared elasticsearch client, creating it the first time it is asked for.
+    Clients are cached per host, credentials and settings, so repeated queries reuse
+    the open keep-alive connections instead of paying a new TLS handshake each time.
+    The query functions use this by default, or accept a client of your own.
+
+    Args:
+        host (str): the elasticsearch host address, defaults to env var 'ELASTIC_HOST'
+        port (str): the elasticsearch port, defaults to env var 'ELASTIC_PORT'
+        username (str): the elasticsearch username login, defaults to env var 'ELASTIC_USER'
+        password (str): the elasticsearch password, defaults to env var 'ELASTIC_SECRET'
+        pool_size (int): the maximum connections kept open to each node, use at least
+            as many as parallel workers
+        timeout (int): the request timeout in seconds
+        max_retries (int): the number of times the client itself retries a failed request,
+            the page requests are already retried with backoff by _PageController
+        http_compress (bool): gzip compress requests and responses, trades cpu for bandwidth
+        serializer (str): the json serializer, 'orjson', 'json' or 'auto' to use orjson
+            when it is installed
+
+    Returns:
+        Elasticsearch: the shared client
+    """
+    env_host, env_port, env_username, env_password = _get_env_variables()
+    host = host if host != None else env_host
+    port = port if port != None else env_port
+    username = username if username != None else env_username
+    password = password if password != None else env_password
+
+    key = (host, port, username, password, pool_size, timeout, max_retries, http_compress, serializer)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = Elasticsearch([host], http_auth=(username, password), scheme="https", port=port,
+                                          verify_certs=False, ssl_show_warn=False, maxsize=pool_size,
+                                          timeout=timeout, max_retries=max_retries, retry_on_timeout=max_retries > 0,
+                                          http_compress=http_compress, serializer=_get_serializer(serializer))  # Open connection to the Elasticsearch database
+        return _CLIENTS[key]
+
+
+def close_clients() -> None:
+    """ Close every shared client created by get_client and their connection pools.
+    """
+    with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
+
+
+def _get_async_client() -> AsyncElasticsearch:
+    """ Open a new async elasticsearch client from the environment variables. Async
+    clients belong to the event loop they are used in so they are not shared.
+
+    Returns:
+        AsyncElasticsearch: the new client, the caller must close it
+    """
+    try:
+        from elasticsearch import AsyncElasticsearch  # Only imported by the async api, it needs aiohttp
+    except ImportError as e:
+        raise ImportError("Error: the async functions need aiohttp, install it with 'pip install esextract[async]'.") from e
+
+    host, port, username, password = _get_env_variables()
+    return AsyncElasticsearch([host], http_auth=(username, password), scheme="https", port=port,
+                    verify_certs=False, ssl_show_warn=False, max_retries=0, serializer=_get_serializer())  # Open connection to the Elasticsearch database
+
+
 def _generate_query_json(search_fields:list, search_string:str, field_to_exist:str = None, date_field:str = None, start_date:str = None, end_date:str = None, is_match_all:bool = False) -> dict:
     """ Generates the query json body from the simple query parameters.
 
@@ -78,6 +295,54 @@ def _generate_query_json(search_fields:list, search_string:str, field_to_exist:s
     return json
 
 
+def _get_paging_fields(paging_id_field:str =None, paging_time_field:str =None) -> (str, str):
+    """ Resolve the optional paging fields, falling back to the 'PAGE_ID_FIELD' and
+    'PAGE_TIME_FIELD' environment variables. Paging is done on a point in time so
+    neither field is required, when given the results are sorted on them.
+
+    Args:
+        paging_id_field (str): the id field to page on
+        paging_time_field (str): the date/time field to page on
+
+    Returns:
+        str: the id field to page on or None
+        str: the date/time field to page on or None
+    """
+    if paging_id_field == None:
+        paging_id_field = os.getenv("PAGE_ID_FIELD", None)
+    if paging_time_field == None:
+        paging_time_field = os.getenv("PAGE_TIME_FIELD", None)
+
+    return paging_id_field, paging_time_field
+
+
+def _resolve_query_target(return_fields:list, index:str =None, paging_id_field:str =None, paging_time_field:str =None) -> (list, str, str, str):
+    """ Fill in the index and paging fields from the environment variables when they
+    are not given and add the paging fields to the return fields.
+
+    Args:
+        return_fields (list): the fields to return from the query, it is not modified
+        index (str): to search into
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+
+    Returns:
+        list: the fields to return from the query including the paging fields
+        str: index to search into
+        str: the id field to sort on or None
+        str: the date/time field to sort on or None
+    """
+    paging_id_field, paging_time_field = _get_paging_fields(paging_id_field, paging_time_field)
+    return_fields = return_fields + [field for field in (paging_id_field, paging_time_field) if field != None and field not in return_fields]
+
+    if index == None:
+        index = os.getenv("DEFAULT_INDEX", None)
+        if index == None:
+            raise Exception("Error: no 'DEFAULT_INDEX' environment variables defined. Please provide it as a parameter or define it.")
+
+    return return_fields, index, paging_id_field, paging_time_field
+
+
 def _args_to_query(args:argparse.ArgumentParser) -> (str, dict, list, str, str):
     """ Take the arguments and returns required data to make an elasticsearch query.
 
@@ -88,8 +353,8 @@ def _args_to_query(args:argparse.ArgumentParser) -> (str, dict, list, str, str):
         str: index to search into
         dict: the json body of the query
         list: the fields to return from the query
-        str: the id field to page on
-        str: the date/time field to page on
+        str: the id field to page on or None
+        str: the date/time field to page on or None
     """
     date_field = None
     if (args.start != None or args.end != None) and args.date_field == None:
@@ -103,23 +368,18 @@ def _args_to_query(args:argparse.ArgumentParser) -> (str, dict, list, str, str):
     else:
         json = _generate_query_json(None, None, args.exists, date_field, args.start, args.end, args.match_all)
 
+    if args.fields_api:
+        json = _use_fields_api(json)
+
     fields = []  
     if args.fields:
         fields = args.fields.split()
 
-    paging_id_field = None
-    paging_time_field = None
-    if args.page_id == None or args.page_time == None:
-        paging_id_field = os.getenv("PAGE_ID_FIELD", None)
-        paging_time_field = os.getenv("PAGE_TIME_FIELD", None)
-        fields += [paging_id_field, paging_time_field]
-    else:
-        fields += [args.page_id, args.page_time]
-        paging_id_field = args.page_id
-        paging_time_field = args.page_time
+    paging_id_field, paging_time_field = _get_paging_fields(args.page_id, args.page_time)
+    fields += [field for field in (paging_id_field, paging_time_field) if field != None and field not in fields]
 
-    index = None
-    if args.index == None:
+    index = args.index
+    if index == None:
         index = os.getenv("DEFAULT_INDEX", None)
 
     return (index, json, fields, paging_id_field, paging_time_field)
@@ -135,13 +395,37 @@ def _check_arguments(args:argparse.ArgumentParser) -> bool:
         bool: True if passes argument checks, False if fails
     """
     if  not args.search and not args.exists and not args.match_all:
-        print("error: you must provide a search term")
+        logger.error("error: you must provide a search term")
         return False
     elif (args.start and not args.end) or (not args.start and args.end):
-        print("error: you must provide both a start and an end date")
+        logger.error("error: you must provide both a start and an end date")
+        return False
+    elif args.workers < 1:
+        logger.error("error: you must use at least one worker")
+        return False
+    elif args.min_page_size < 1 or args.max_page_size < args.min_page_size:
+        logger.error("error: page sizes must be at least 1 and --min_page_size no larger than --max_page_size")
+        return False
+    elif args.metrics and args.group_by == None:
+        logger.error("error: --metrics needs --group_by")
+        return False
+    elif args.group_by != None and (args.workers > 1 or args.fan_out):
+        logger.error("error: --group_by aggregates in elasticsearch and can not be used with --workers or --fan_out")
+        return False
+    elif args.max_rows_per_file != None and args.max_rows_per_file < 1:
+        logger.error("error: --max_rows_per_file must be at least 1")
+        return False
+    elif (args.partition_by != None or args.max_rows_per_file != None) and (args.resume or args.incremental != None or args.group_by != None):
+        logger.error("error: partitioned datasets can not be used with --resume, --incremental or --group_by")
+        return False
+    elif args.resume and (_split_extension(args.out)[1] != ".csv" or args.workers > 1 or args.fan_out or args.incremental != None or None in _get_paging_fields(args.page_id, args.page_time)):
+        logger.error("error: --resume needs an uncompressed .csv output, one worker without --fan_out or --incremental and both paging fields (-pi and -pt)")
+        return False
+    elif _split_extension(args.out)[1] not in _OUTPUT_EXTENSIONS:
+        logger.error("error: the output file must end in .csv, .jsonl, .parquet, .feather or .arrow, csv and jsonl can add .gz or .zst")
         return False
     elif not os.path.exists(os.path.dirname(args.out)) and os.path.dirname(args.out) != '':
-        print(f"error: the directory '{os.path.dirname(args.out)}' does not exist.")
+        logger.error(f"error: the directory '{os.path.dirname(args.out)}' does not exist.")
         return False
 
     date_field = None
@@ -150,14 +434,6 @@ def _check_arguments(args:argparse.ArgumentParser) -> bool:
         if date_field == None:
             raise Exception("error: no 'DEFAULT_DATE_FIELD' environment variable defined. Please supply one as an argument with -d or define one.")
 
-    paging_id_field = None
-    paging_time_field = None
-    if args.page_id == None or args.page_time == None:
-        paging_id_field = os.getenv("PAGE_ID_FIELD", None)
-        paging_time_field = os.getenv("PAGE_TIME_FIELD", None)
-        if paging_id_field == None or paging_time_field == None:
-            raise Exception("error: no 'PAGE_ID_FIELD' or 'PAGE_TIME_FIELD' environment variables defined. Please provide them as arguments as -pi and -pt or define them.")
-
     index = None
     if args.index == None:
         index = os.getenv("DEFAULT_INDEX", None)
@@ -167,10 +443,13 @@ def _check_arguments(args:argparse.ArgumentParser) -> bool:
     return True
 
 
-def _get_arguments() -> argparse.ArgumentParser:
+def _get_arguments(argv:list =None) -> argparse.ArgumentParser:
     """ Parse the command line arguments and return them as an argument
     object.
 
+    Args:
+        argv (list): the arguments to parse, the command line arguments if None
+
     Returns:
         argparse.ArgumentParser: the arguments passed to the program
     """
@@ -192,52 +471,143 @@ def _get_arguments() -> argparse.ArgumentParser:
                         metavar="date (yyyy-mm-dd)", default=None)
     parser.add_argument("-ed", "--end", help="Ending date to stop searching yyyy-mm-dd or now",
                         metavar="date (yyyy-mm-dd)", default=None)
-    parser.add_argument("-o", "--out", help="Output file with path", default="output.csv")
+    parser.add_argument("-o", "--out", help="Output file with path, ending in .csv, .jsonl, .parquet, .feather or .arrow, "
+                                             "add .gz or .zst to compress csv and jsonl", default="output.csv")
     parser.add_argument("-pi", "--page_id", help="Id field for paging", default=None)
     parser.add_argument("-pt", "--page_time", help="Date/time field for paging", default=None)
-    args = parser.parse_args()
+    parser.add_argument("-w", "--workers", help="Number of paging time slices to download in parallel", type=int, default=1)
+    parser.add_argument("--split_output", help="Write each parallel slice to its own part file", action="store_true", default=False)
+    parser.add_argument("--timeout", help="Elasticsearch request timeout in seconds", type=int, default=30)
+    parser.add_argument("--http_compress", help="Gzip compress elasticsearch requests and responses", action="store_true", default=False)
+    parser.add_argument("--schema", help="Take the parquet and feather column types from the index mapping instead of inferring them "
+                                         "from the documents", default=None, choices=["mapping"])
+    parser.add_argument("--row_group_size", help="Rows per parquet row group, defaults to one row group per page", type=int, default=None)
+    parser.add_argument("--checkpoint_every", help="Save a resumable checkpoint every N pages (csv output with both paging fields), "
+                                                   "every 10 pages with --resume", type=int, default=None)
+    parser.add_argument("--resume", help="Resume an interrupted download from its checkpoint file", action="store_true", default=False)
+    parser.add_argument("--incremental", help="Only download documents newer than the last run recorded in this state file, "
+                                              "written to a new timestamped partition file", metavar="state_file", default=None)
+    parser.add_argument("--compression", help="Parquet compression codec, feather files use lz4 or zstd and are otherwise uncompressed", default="snappy",
+                        choices=["none", "snappy", "gzip", "brotli", "lz4", "zstd"])
+    parser.add_argument("--min_page_size", help="Smallest page the adaptive page size may shrink to", type=int, default=100)
+    parser.add_argument("--max_page_size", help="Largest page the adaptive page size may grow to", type=int, default=10000)
+    parser.add_argument("--metrics_file", help="Write per page timings and progress to this file as json lines, "
+                                               "or as a prometheus textfile if it ends in .prom", default=None)
+    parser.add_argument("--count", help="How the documents matching the query are counted for the progress and eta: with the first page "
+                                        "of each slice, with a count request before the download begins, or not at all", default="hits",
+                        choices=["hits", "exact", "none"])
+    parser.add_argument("--fan_out", help="Download every index behind the index pattern on its own, --workers indices at a time, "
+                                          "instead of slicing the query. With --split_output each index is written to its own file",
+                        action="store_true", default=False)
+    parser.add_argument("--log_level", help="Logging level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--group_by", help="Aggregate in elasticsearch instead of downloading documents, grouping by these fields "
+                                           "(field for terms, field:interval for dates, e.g. \"user.id created_at:1d\")", default=None)
+    parser.add_argument("--metrics", help="Metrics per group as aggregation:field, e.g. \"sum:retweet_count avg:followers_count\"", default=None)
+    parser.add_argument("--fields_api", help="Fetch the return fields through the fields api instead of _source", action="store_true", default=False)
+    parser.add_argument("--serializer", help="Json serializer for elasticsearch responses, auto uses orjson when installed", default="auto",
+                        choices=["auto", "orjson", "json"])
+    parser.add_argument("--partition_by", help="Write a partitioned dataset directory named after --out, partitioned by field:day, "
+                                               "field:month or the values of a field", default=None)
+    parser.add_argument("--max_rows_per_file", help="Most rows in each part file of a dataset", type=int, default=None)
+    parser.add_argument("--manifest", help="Run every query in this yaml or json manifest in one process with one client", default=None)
+    parser.add_argument("--concurrency", help="Manifest queries run at the same time, overrides the manifest", type=int, default=None)
+    parser.add_argument("--report", help="Write the manifest results to this json file", default=None)
+    args = parser.parse_args(argv)
 
     return args
 
 
-def _write_csv_headers(headers:list, out_file:str) -> None:
-    """ Write the return fields to the csv file as headers
+def _get_docs_from_response(hits:list) -> (list, list):
+    """ Extract the actual document data from the raw response and extract
+    pagination information.
+
+    Args:
+        hits (list): list of raw response json objects from elasticsearch
+
+    Returns:
+        list: a list of document data extracted from raw responses
+        list: the sort values of the last hit to update pagination
+    """
+    docs = [doc["_source"] for doc in hits]  # Extract the field information
+
+    return docs, hits[-1]["sort"]
+
+
+def _compile_field_path(path:tuple):
+    """ Compile the nested part of a split field name into a function that follows
+    it into a document, mapping the rest of the path over every element when a
+    list of objects is reached.
 
     Args:
-        headers (list): list of DataFrame column headers (all return fields)
-        out_file (str): the path including filename of the file to write to
+        path (tuple): the field names of the path below the top level field
+
+    Returns:
+        callable: a function taking part of a document and returning the value at the
+            end of the path, a list of values for lists of objects or an empty string
+            when the field is missing
     """
-    print(f"Writing headers to {out_file}")
-    with open(out_file, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(headers)
+    layer = path[0]
 
+    if len(path) == 1:
+        def walk(data):
+            if type(data) is dict:
+                return data.get(layer, "")
+            if type(data) is list:
+                return [e.get(layer, "") if type(e) is dict else walk(e) for e in data]
+            return ""
+        return walk
 
-def _get_docs_from_response(hits:list, id_field:str, time_field:str) -> (list, str, str):
-    """ Extract the actual document data from the raw response and extract
-    pagination information.
+    walk_rest = _compile_field_path(path[1:])
+
+    def walk(data):
+        if type(data) is dict:
+            return walk_rest(data.get(layer, ""))
+        if type(data) is list:
+            return [walk(e) for e in data]
+        return ""
+    return walk
+
+
+@lru_cache(maxsize=128)
+def _compile_doc_cleaner(fields:tuple):
+    """ Compile the return fields into a single function that cleans a whole page of
+    documents. The field names are split once per query and the generated function
+    builds each cleaned document as one dict literal, looking up each top level
+    object once for all the nested fields below it.
 
     Args:
-        hits (list): list of raw response json objects from elasticsearch
-        id_field (str): the id pagination field to update
-        time_field (str): the time pagination field to update
+        fields (tuple): the fields in the data
 
     Returns:
-        list: a list of document data extracted from raw responses
-        str: the latest timestamp to update pagination
-        str: the latest id to update pagination
+        callable: a function taking a list of documents and returning the cleaned documents
     """
-    timestamp = None
-    _id = None
-    docs = []
+    namespace = {}
+    top_levels = {}
+    items = []
 
-    for num, doc in enumerate(hits):
-        source_data = doc["_source"]  # Extract the field information
-        _id = source_data[id_field]
-        timestamp = source_data[time_field]
-        docs.append(source_data)  # Add the field JSON information to a document list
+    for num, field in enumerate(fields):
+        if '.' not in field:
+            items.append(f"{field!r}: source.get({field!r}, '')")
+            continue
 
-    return docs, timestamp, _id
+        first, *rest = field.split('.')
+        top = top_levels.setdefault(first, f"top{len(top_levels)}")
+        walk = f"walk{num}"
+        namespace[walk] = _compile_field_path(tuple(rest))
+        if len(rest) == 1:  # Inline the common one level nesting
+            items.append(f"{field!r}: ({top}.get({rest[0]!r}, '') if type({top}) is dict else {walk}({top}))")
+        else:
+            items.append(f"{field!r}: {walk}({top})")
+
+    loop = "for source in sources"
+    if top_levels:  # Bind every top level object once per document
+        names = ", ".join(top_levels.values())
+        lookups = ", ".join(f"source.get({first!r}, '')" for first in top_levels)
+        loop += f" for {names}, in [({lookups},)]"
+
+    exec(f"def clean(sources):\n    return [{{{', '.join(items)}}} {loop}]\n", namespace)
+
+    return namespace["clean"]
 
 
 def _clean_elastic_docs(sources:list, fields:list) -> list:
@@ -252,305 +622,3544 @@ def _clean_elastic_docs(sources:list, fields:list) -> list:
     Returns:
         list: a list of documents that have been cleaned for export
     """
-    parsed_sources = []
-    for source in sources:
-        out = {}
-        for field in fields:
-            if '.' in field:
-                f_split = field.split('.')
-                try:
-                    source[f_split[0]]
-                except:
-                    out[field] = ""
-                    continue
-                data = source[f_split[0]]
-                for layer in f_split[1:]:
-                    if type(data) is list:
-                        out[field] = []
-                        for e in data:
-                            out[field].append(e[layer])
-                    else:
-                        data = data[layer]
-                        out[field] = data
-            else:
-                try:
-                    source[field]
-                except:
-                    out[field] = ""
-                    continue
-                out[field] = source[field]
-        parsed_sources.append(out)
+    return _compile_doc_cleaner(tuple(fields))(sources)
 
-    return parsed_sources
 
+def _field_values(values):
+    """ The fields api returns every field as an array of values, which are kept as
+    lists even when there is only one, so the type of a column does not depend on how
+    many values the documents of a page happen to have.
+
+    Args:
+        values: the array of values of a field, None if the field is missing
+
+    Returns:
+        the list of values or an empty string when missing
+    """
+    if values == None:
+        return ""
+    return values
 
-def _query_to_csv_large(host:str, port:str, username:str, password:str, index:str, json:dict, return_fields:list, paging_id_field:str, paging_time_field:str, out_file:str) -> None:
-    """ This is the internal function for handling the connection to elasticsearch and
-    the subsequent API calls with the data provided from the Query object. It then saves
-    the results to a csv file.
+
+def _clean_fields_docs(field_docs:list, fields:list) -> list:
+    """ Clean the document data returned by the fields api. The fields api already
+    flattens nested fields to their dotted names and returns every value as a list.
 
     Args:
-        host (str): the elasticsearch host address
-        port (str): the elasticsearch port
-        username (str): the elasticsearch username login
-        password (str): the elasticsearch password
-        index (str): to search into
-        json (dict): the json body of the query
-        return_fields (list): the fields to return from the query
-        paging_id_field (str): the id field to page on
-        paging_time_field (str): the date/time field to page on
-        out_file (str): the path to the output file including filename
+        field_docs (list): list of document data (from fields objects) extracted from raw responses
+        fields (list): list of fields in the data
+
+    Returns:
+        list: a list of documents that have been cleaned for export
     """
-    es = Elasticsearch([host], http_auth=(username, password), scheme="https", port=port,
-                    verify_certs=False, ssl_show_warn=False)  # Open connection to the Elasticsearch database
+    return [{field: _field_values(doc.get(field)) for field in fields} for doc in field_docs]
 
-    print("Counting documents in query")
 
-    response = es.count(index=index, body=json)  # Send a count query to check the total hits of the search
-    document_count = response['count']
+def _use_fields_api(json:dict) -> dict:
+    """ Copy the query json body and switch it to fetching the return fields through the
+    fields api instead of _source. Only the requested fields come back, already
+    flattened, which makes responses for wide documents much smaller to decode.
+    The fields themselves are added to each page body by _page_body.
 
-    print(f"Found {document_count} documents matching query")
-    print("Beginning download")
+    Args:
+        json (dict): the json body of the query
 
-    current_count = 0
+    Returns:
+        dict: the new json query body
+    """
+    fields_json = copy.deepcopy(json)
+    fields_json["_source"] = False
 
-    _write_csv_headers(return_fields, out_file)
+    return fields_json
 
-    with open(out_file, "a", newline="", encoding='utf-8') as file:
-        writer = csv.DictWriter(file, return_fields)
-        while True:  # Main response loop
-            # Search query on main index using max documents per query (10,000) and sort to allow for paging
-            response = es.search(index=index, size=10000,
-                                sort=[f"{paging_time_field}:asc", f"{paging_id_field}:asc"],
-                                body=json, _source=return_fields)
-            res_docs = response["hits"]["hits"]
 
-            if not res_docs:  # If no new responses returned leave loop
-                break
+def _search_params(body:dict, return_fields:list) -> dict:
+    """ The request parameters for a page search, filtering the response down to the
+    documents and their sort values.
 
-            current_count += len(res_docs)
-            print(f"Downloading: [{current_count}/{document_count}]")
-            elastic_docs, last_timestamp, last_id = _get_docs_from_response(res_docs, paging_id_field, paging_time_field)  # Extracts data from nested JSON
-            json["search_after"] = [last_timestamp, last_id]  # Set page marker to last result
-            rows = _clean_elastic_docs(elastic_docs, return_fields)
-            writer.writerows(rows)
+    Args:
+        body (dict): the json body of the page request
+        return_fields (list): the fields to return from the query
 
-    if current_count > 0:
-        print("Saved data to query_output.csv")
-    else:
-        print("No results nothing saved")
+    Returns:
+        dict: the keyword arguments for es.search
+    """
+    if body.get("_source") is False:
+        return {"filter_path": _FIELDS_FILTER_PATH}
 
-    print("Done")
+    return {"_source": return_fields, "filter_path": _SOURCE_FILTER_PATH}
 
 
-def _query_to_json(host:str, port:str, username:str, password:str, json:dict, return_fields:list, index:str =None, paging_id_field:str =None, paging_time_field:str =None) -> list:
-    """ This is the internal function for handling the connection to elasticsearch and
-    the subsequent API calls with the data provided from the Query object. It then returns
-    the resultts in a list of JSON objects.
+def _clean_page(hits:list, body:dict, return_fields:list) -> list:
+    """ Extract and clean the documents of a page of hits from either _source or the
+    fields api, depending on how the page was requested.
 
     Args:
-        host (str): the elasticsearch host address
-        port (str): the elasticsearch port
-        username (str): the elasticsearch username login
-        password (str): the elasticsearch password
-        json (dict): the json body of the query
+        hits (list): list of raw response json objects from elasticsearch
+        body (dict): the json body of the page request
         return_fields (list): the fields to return from the query
-        index (str): to search into
-        paging_id_field (str): the id field to page on
-        paging_time_field (str): the date/time field to page on
 
     Returns:
-        list: a list of cleaned json documents returned by the query
+        list: a list of documents that have been cleaned for export
     """
-    if paging_id_field == None or paging_time_field == None:
-        paging_id_field = os.getenv("PAGE_ID_FIELD", None)
-        paging_time_field = os.getenv("PAGE_TIME_FIELD", None)
-        return_fields.append(paging_id_field)
-        return_fields.append(paging_time_field)
-        if paging_id_field == None or paging_time_field == None:
-            raise Exception("Error: no 'PAGE_ID_FIELD' or 'PAGE_TIME_FIELD' environment variables defined. Please provide them as parameters or define them.")
-    else:
-        return_fields += [paging_id_field, paging_time_field]
+    if body.get("_source") is False:
+        return _clean_fields_docs([hit.get("fields", {}) for hit in hits], return_fields)
 
-    if index == None:
-        index = os.getenv("DEFAULT_INDEX", None)
-        if index == None:
-            raise Exception("Error: no 'DEFAULT_INDEX' environment variables defined. Please provide it as a parameter or define it.")
+    elastic_docs, last_sort = _get_docs_from_response(hits)  # Extracts data from nested JSON
+    return _clean_elastic_docs(elastic_docs, return_fields)
 
-    print("Connecting to elasticsearch")
-    es = Elasticsearch([host], http_auth=(username, password), scheme="https", port=port,
-                    verify_certs=False, ssl_show_warn=False)  # Open connection to the Elasticsearch database
-    print("Counting documents in query")
-    
-    response = es.count(index=index, body=json)  # Send a count query to check the total hits of the search
-    document_count = response['count']
-    
-    print(f"Found {document_count} documents matching query")
-    print("Beginning download")
 
-    current_count = 0
-    rows = []
+class _Metrics:
+    """ Timings and counters of one extraction, shared by every slice. The time spent
+    in each stage (the elasticsearch request, decoding responses, cleaning documents
+    and writing them) is added up as pages go by, which shows whether a download is
+    bound by elasticsearch, the cpu or the disk. After every page an event is sent to
+    the on_metrics callback and written to the metrics file, as a json line or, for
+    files ending in .prom, as a prometheus textfile.
 
-    while True:  # Main response loop
-        # Search query on main index using max documents per query (10,000) and sort to allow for paging
-        response = es.search(index=index, size=10000,
-            sort=[f"{paging_time_field}:asc", f"{paging_id_field}:asc"],
-            body=json, _source=return_fields)
-        res_docs = response["hits"]["hits"]
+    Every event is a dict with:
+        event: 'page' or 'done'
+        slice: the slice of the page (page events only)
+        page_docs: the documents in the page (page events only)
+        docs: the documents downloaded so far
+        expected_docs: the documents matching the query, None if unknown, estimated
+            until every slice has been counted, see expected
+        elapsed_seconds, docs_per_sec, eta_seconds: progress of the download
+        bytes: the response bytes received so far
+        retries: the page requests retried so far
+        page_size: the current page size
+        stages: the seconds spent in each stage so far
+        page_stages: the seconds spent in each stage since the last event, with
+            several workers this covers every page finished in between
+    """
+    def __init__(self, on_metrics=None, metrics_file:str =None, count:str ="hits"):
+        if count not in _COUNT_MODES:
+            raise Exception(f"Error: count must be one of {', '.join(_COUNT_MODES)}, not '{count}'.")
+        self.on_metrics = on_metrics
+        self.metrics_file = metrics_file
+        self.count = count
+        self.counts = {}  # Documents matching the query or each of its slices, see found
+        self.count_parts = 1
+        self.lock = threading.Lock()
+        self.stages = dict.fromkeys(_STAGES, 0.0)
+        self.last_stages = dict(self.stages)
+        self.bytes = 0
+        self.retries = 0
+        self.start = time.perf_counter()
+        self.start_count = 0
+        self.last_prometheus = None
 
-        if not res_docs:  # If no new responses returned leave loop
-            break
+    def add(self, stage:str, seconds:float) -> None:
+        with self.lock:
+            self.stages[stage] += seconds
 
-        current_count += len(res_docs)
-        print(f"Downloading: [{current_count}/{document_count}]")
-        elastic_docs, last_timestamp, last_id = _get_docs_from_response(res_docs, paging_id_field, paging_time_field)  # Extracts data from nested JSON
-        json["search_after"] = [last_timestamp, last_id]  # Set page marker to last result
-        rows += _clean_elastic_docs(elastic_docs,  return_fields)
+    @contextmanager
+    def timed(self, stage:str):
+        """ Add the time spent in the with block to a stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
 
-    print("Done")
-    return rows
+    def request(self, seconds:float, response_bytes:int, decode_seconds:float) -> None:
+        """ Record a page request, seconds includes decoding the response. The size
+        and decode time are None when the client's serializer does not report them.
+        """
+        with self.lock:
+            self.stages["request"] += seconds - (decode_seconds or 0)
+            self.stages["decode"] += decode_seconds or 0
+            self.bytes += response_bytes or 0
 
+    def retry(self) -> None:
+        with self.lock:
+            self.retries += 1
 
-def query_to_json(index:str =None, paging_id_field:str =None, paging_time_field =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False) -> list:
-    """ This is the function that takes in query parameters and returns a list of json objects from
-    elasticsearch documents. This function creates a query object and calls an internal function that handles
-    the actual communication with elasticsearch.
+    def started(self, start_count:int =0) -> None:
+        """ Restart the clock when the download begins, start_count documents were
+        already downloaded by an earlier run.
+        """
+        self.start = time.perf_counter()
+        self.start_count = start_count
 
-    Args:
-        index (str): the elasticsearch index you want to query
-        paging_id_field (str): the id field to page on
-        paging_time_field (str): the date/time field to page on
-        return_fields (list): the fields you want returned from the query
-        fields_to_search (list): the fields you want to search for your query string in
-        search_string (str): the terms you want to search for in the search fields
-        field_to_exist (str): supplied field will be used as an extra check to 
-            only return documents where this field isn't null
-        date_field (str): supplied field will be used to search by a custom date field
-            use in conjunction with start_date and end_date args
-        start_date (str): the first date you want to return documents from in format
-            yyyy-mm-dd
-        end_date (str): the last date you want to return documents from in format
-            yyyy-mm-dd, can also be set to 'now' to use current date
-        is_match_all (bool): this overrides search terms and exist terms and returns
-            all documents between start and end dates if specified
+    def expect(self, parts:int) -> None:
+        """ Set how many counts (e.g. one per slice) add up to the documents matching the query.
+        """
+        self.count_parts = parts
 
-    Returns:
-        list: a list of cleaned json documents returned by the query
-    """
-    host, port, username, password = _get_env_variables()
-    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
-    response_list = _query_to_json(host, port, username, password, json, return_fields, index, paging_id_field, paging_time_field)
-    response_json = {"data":response_list}
+    def found(self, key, count:int) -> None:
+        """ Record the documents elasticsearch found matching the query, or the part of
+        it under key, a None key records a new part. Counts of None are ignored.
+        """
+        if count != None:
+            with self.lock:
+                self.counts[key if key != None else len(self.counts)] = count
 
-    return response_json
+    def expected(self) -> (int, bool):
+        """ The documents matching the query. Until every part has been counted the
+        total is extrapolated from the parts counted so far.
 
+        Returns:
+            int: the documents matching the query, None if nothing was counted yet
+            bool: True if the total is an estimate
+        """
+        with self.lock:
+            if not self.counts:
+                return None, False
+            counted = sum(self.counts.values())
+            if len(self.counts) >= self.count_parts:
+                return counted, False
+            return round(counted * self.count_parts / len(self.counts)), True
 
-def query_to_dataframe(index:str =None, paging_id_field:str =None, paging_time_field =None, return_fields:list = [], fields_to_search:list = [], search_string:str = None, field_to_exist:str = None, date_field:str = None, start_date:str = None, end_date:str = None, is_match_all:bool = False) -> pandas.DataFrame:
-    """ This is the function that takes in query parameters and returns a pandas datafram from
-    elasticsearch documents. This function creates a query object and calls an internal function that handles
-    the actual communication with elasticsearch.
+    def progress(self, docs:int) -> str:
+        """ Describe the progress of the download for the log, with the throughput so
+        far and the time left at that rate, e.g. [5000/~120000] 2500 docs/s, eta 0:00:46.
+        """
+        expected, estimated = self.expected()
+        rate = self._rate(docs)
+        text = f"[{docs}/{'?' if expected == None else ('~' if estimated else '') + str(expected)}]"
+        if rate > 0:
+            text += f" {rate:.0f} docs/s"
+            if expected != None:
+                text += f", eta {datetime.timedelta(seconds=round(max(0, expected - docs) / rate))}"
+        return text
 
-    Args:
-        index (str): the elasticsearch index you want to query
-        paging_id_field (str): the id field to page on
-        paging_time_field (str): the date/time field to page on
-        return_fields (list): the fields you want returned from the query
-        fields_to_search (list): the fields you want to search for your query string in
-        search_string (str): the terms you want to search for in the search fields
-        field_to_exist (str): supplied field will be used as an extra check to 
-            only return documents where this field isn't null
-        date_field (str): supplied field will be used to search by a custom date field
-            use in conjunction with start_date and end_date args
-        start_date (str): the first date you want to return documents from in format
-            yyyy-mm-dd
-        end_date (str): the last date you want to return documents from in format
-            yyyy-mm-dd, can also be set to 'now' to use current date
-        is_match_all (bool): this overrides search terms and exist terms and returns
-            all documents between start and end dates if specified
+    def _rate(self, docs:int) -> float:
+        elapsed = time.perf_counter() - self.start
+        return (docs - self.start_count) / elapsed if elapsed > 0 else 0.0
 
-    Returns:
-        pandas.DataFrame: a DataFrame where the json fields are columns
-    """
-    response_json = query_to_json(index, paging_id_field, paging_time_field, return_fields, fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)  
-    df = pandas.DataFrame()
-    if len(response_json['data']) > 0:
-        fields = response_json['data'][0].keys()
-        df = pandas.DataFrame(response_json['data'], columns=fields)
-    return df
+    def page(self, slice_num:int, page_docs:int, docs:int, expected_docs:int, page_size:int) -> None:
+        if self.on_metrics != None or self.metrics_file != None:
+            self._emit(dict(event="page", slice=slice_num, page_docs=page_docs, **self._progress(docs, expected_docs, page_size)))
 
+    def done(self, docs:int, expected_docs:int, page_size:int) -> None:
+        if self.on_metrics != None or self.metrics_file != None:
+            self._emit(dict(event="done", **self._progress(docs, expected_docs, page_size)))
 
-def write_dataframe_to_file(df:pandas.DataFrame, path:str, format:str="csv") -> None:
-    """ This function takes a dataframe and exports it to either JSON, CSV or Arrow Parquet.
-    NOTE: This function could be put in the Julia wrapper?
+    def _progress(self, docs:int, expected_docs:int, page_size:int) -> dict:
+        elapsed = time.perf_counter() - self.start
+        rate = self._rate(docs)
+        eta = None
+        if expected_docs != None and rate > 0:
+            eta = max(0, expected_docs - docs) / rate
 
-    Args:
-        df (pandas.DataFrame): the dataframe to be stored to file
-        path (str): the path including filename for the output
-        format (str): the format of the file on disk (csv, json, arrow)
-    """
-    if format == "json":
-        df_json = df.to_json(orient="records")
+        with self.lock:
+            stages = dict(self.stages)
+            page_stages = {stage: stages[stage] - self.last_stages[stage] for stage in _STAGES}
+            self.last_stages = stages
 
-        with open(path, 'w') as f:
-            json.dump(df_json, f)
+        return {"docs": docs, "expected_docs": expected_docs, "elapsed_seconds": elapsed, "docs_per_sec": rate,
+                "eta_seconds": eta, "bytes": self.bytes, "retries": self.retries, "page_size": page_size,
+                "stages": stages, "page_stages": page_stages}
 
-    elif format == "csv":
-        df.to_csv(path, index=False)
+    def _emit(self, event:dict) -> None:
+        if self.on_metrics != None:
+            self.on_metrics(event)
 
-    elif format == "arrow":
-        table = pa.Table.from_pandas(df)
-        pq.write_table(table, path)
+        if self.metrics_file == None:
+            return
+        elif not self.metrics_file.endswith(".prom"):
+            with self.lock, open(self.metrics_file, "a") as f:
+                f.write(json.dumps(event) + "\n")
+        elif event["event"] == "done" or self.last_prometheus == None or time.perf_counter() - self.last_prometheus >= _PROMETHEUS_INTERVAL:
+            self.last_prometheus = time.perf_counter()
+            self._write_prometheus(event)
 
-    else:
-        raise Exception("Invalid format please use either 'json', 'csv' or 'arrow'")
+    def _write_prometheus(self, event:dict) -> None:
+        """ Atomically rewrite the prometheus textfile with the latest event.
+        """
+        lines = []
+        def metric(name, kind, help, value, labels=""):
+            if not any(line == f"# TYPE esextract_{name} {kind}" for line in lines):
+                lines.extend([f"# HELP esextract_{name} {help}", f"# TYPE esextract_{name} {kind}"])
+            lines.append(f"esextract_{name}{labels} {value if value != None else 'NaN'}")
 
+        metric("docs_total", "counter", "Documents downloaded", event["docs"])
+        metric("expected_docs", "gauge", "Documents matching the query", event["expected_docs"])
+        metric("bytes_total", "counter", "Response bytes received", event["bytes"])
+        metric("retries_total", "counter", "Page requests retried", event["retries"])
+        metric("docs_per_second", "gauge", "Download rate", event["docs_per_sec"])
+        metric("eta_seconds", "gauge", "Estimated seconds until the download completes", event["eta_seconds"])
+        metric("page_size", "gauge", "Current page size", event["page_size"])
+        metric("elapsed_seconds", "gauge", "Seconds since the download began", event["elapsed_seconds"])
+        metric("done", "gauge", "1 once the download has completed", int(event["event"] == "done"))
+        for stage in _STAGES:
+            metric("stage_seconds_total", "counter", "Seconds spent in each stage", event["stages"][stage], f'{{stage="{stage}"}}')
 
-def read_dataframe_from_file(path:str) -> pandas.DataFrame:
-    """ Function to read in csv, json or arrow parquet to a dataframe.
-    NOTE: This function could be put in the Julia wrapper?
+        temp_path = f"{self.metrics_file}.tmp"
+        with open(temp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.metrics_file)
 
-    Args:
-        path (str): the path including filename for the output
 
-    Returns:
-        pandas.DataFrame: the csv in a DataFrame
+class _PageController:
+    """ Picks the size of every page request and retries failed requests. The size
+    starts small and grows towards the largest page that stays under the target
+    response bytes and request time, within the min and max bounds. Requests failing
+    with 429 (e.g. circuit breakers), 5xx or timeouts halve the page size and are
+    retried with exponential backoff and full jitter. One controller is shared by
+    every slice of a download, so parallel workers back off together, and it carries
+    the download's metrics.
     """
-    f, extension = os.path.splitext(path)
+    def __init__(self, min_size:int =100, max_size:int =10000, target_bytes:int =_TARGET_PAGE_BYTES, target_seconds:float =_TARGET_PAGE_SECONDS, retries:int =_SEARCH_RETRIES, metrics:_Metrics =None):
+        if min_size < 1 or max_size < min_size:
+            raise Exception("Invalid page size bounds, need 1 <= min_page_size <= max_page_size")
 
-    if extension == ".csv":
-        df = pandas.read_csv(path)
-        return df
-        
-    elif extension == ".json":
-        df = pandas.read_json(path)
-        return df
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        self.retries = retries
+        self.size = max(min_size, min(max_size, 1000))
+        self.lock = threading.Lock()
+        self.metrics = metrics if metrics != None else _Metrics()
 
-    elif extension == ".parquet":
-        df = pq.read_table(path).to_pandas()
-        return df
+    def record(self, docs:int, response_bytes:int, seconds:float) -> None:
+        """ Resize after a successful page of docs documents, response_bytes is None
+        when the client's serializer does not report it.
+        """
+        if docs == 0:
+            return
 
-    else:
-        raise Exception("Invalid format please use either 'json', 'csv' or arrow 'parquet'")
+        with self.lock:
+            sizes = [self.size * 2]  # Grow at most 2x per page
+            if response_bytes:
+                sizes.append(self.target_bytes * docs // response_bytes)
+            if seconds > 0:
+                sizes.append(int(self.target_seconds * docs / seconds))
+            self.size = max(self.min_size, min(self.max_size, *sizes))
 
+    def retry_delay(self, error:Exception, attempt:int, shrink:bool =True) -> float:
+        """ Return how long to wait before retrying a failed request, or None if the
+        error is not worth retrying or the retries are used up. Failed page requests
+        also halve the page size, shrink is False for other requests.
+        """
+        status = getattr(error, "status_code", None)
+        if not isinstance(error, ConnectionError) and not (isinstance(status, int) and (status == 429 or status >= 500)):
+            return None
+        elif attempt >= self.retries:
+            return None
 
-def main() -> None:
-    """This is the main function which reads the env vars (DISCUSS) and parsees command line args.
-    Look up 'arg pass'
-    1. Read arguments and fail
-    2. Do checks on FS etc.
-    3. Then do stuff...
-    """
+        if shrink:
+            with self.lock:
+                self.size = max(self.min_size, self.size // 2)
+
+        self.metrics.retry()
+        return random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2**attempt))
+
+
+def _record_total(body:dict, response:dict, metrics:_Metrics) -> None:
+    """ Pass the total hits of the first page of a slice to the metrics, the later
+    pages of the slice then stop counting them.
+
+    Args:
+        body (dict): the json body used for the request, see _page_body
+        response (dict): the raw search response
+        metrics (_Metrics): the metrics of the download
+    """
+    if body.get("track_total_hits"):
+        metrics.found(None, response.get("hits", {}).get("total", {}).get("value"))
+        body["track_total_hits"] = False
+
+
+def _retry_message(what:str, error:Exception, delay:float, controller:_PageController, shrink:bool) -> str:
+    return f"{what} failed ({error}), retrying in {delay:.1f}s" + (f" with pages of {controller.size}" if shrink else "")
+
+
+def _with_retries(request, controller:_PageController =None, what:str ="Request", shrink:bool =False):
+    """ Make an elasticsearch request, retrying connection errors, 429s and server
+    errors with the backoff of the page controller. The client itself does not retry,
+    see get_client.
+
+    Args:
+        request (callable): makes the request and returns its result
+        controller (_PageController): retries the request and counts the retries, a new
+            one with the default bounds if None
+        what (str): the request, for the retry warnings
+        shrink (bool): halve the page size on every retry, for page requests
+
+    Returns:
+        the result of the request
+    """
+    controller = controller if controller != None else _PageController()
+    attempt = 0
+    while True:
+        try:
+            return request()
+        except TransportError as e:
+            delay = controller.retry_delay(e, attempt, shrink)
+            if delay == None:
+                raise
+            logger.warning(_retry_message(what, e, delay, controller, shrink))
+            time.sleep(delay)
+            attempt += 1
+
+
+async def _awith_retries(request, controller:_PageController =None, what:str ="Request", shrink:bool =False):
+    """ Async version of _with_retries, request returns an awaitable.
+    """
+    controller = controller if controller != None else _PageController()
+    attempt = 0
+    while True:
+        try:
+            return await request()
+        except TransportError as e:
+            delay = controller.retry_delay(e, attempt, shrink)
+            if delay == None:
+                raise
+            logger.warning(_retry_message(what, e, delay, controller, shrink))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def _search_page(es:Elasticsearch, body:dict, return_fields:list, controller:_PageController) -> dict:
+    """ Request the next page, sized and retried by the page controller.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        body (dict): the json body of the page request
+        return_fields (list): the fields to return from the query
+        controller (_PageController): the page controller of the download
+
+    Returns:
+        dict: the raw search response
+    """
+    def search() -> (dict, float):
+        _RESPONSE_STATS.bytes = _RESPONSE_STATS.seconds = None
+        start = time.perf_counter()
+        response = es.search(body=body, size=controller.size, **_search_params(body, return_fields))
+        return response, time.perf_counter() - start
+
+    response, seconds = _with_retries(search, controller, "Page request", shrink=True)
+    controller.metrics.request(seconds, _RESPONSE_STATS.bytes, _RESPONSE_STATS.seconds)
+    controller.record(len(response.get("hits", {}).get("hits", [])), _RESPONSE_STATS.bytes, seconds)
+    return response
+
+
+async def _asearch_page(es:AsyncElasticsearch, body:dict, return_fields:list, controller:_PageController) -> dict:
+    """ Async version of _search_page.
+
+    Args:
+        es (AsyncElasticsearch): the open async elasticsearch connection
+        body (dict): the json body of the page request
+        return_fields (list): the fields to return from the query
+        controller (_PageController): the page controller of the download
+
+    Returns:
+        dict: the raw search response
+    """
+    async def search() -> (dict, float):
+        _RESPONSE_STATS.bytes = _RESPONSE_STATS.seconds = None
+        start = time.perf_counter()
+        response = await es.search(body=body, size=controller.size, **_search_params(body, return_fields))
+        return response, time.perf_counter() - start  # The response is decoded on this thread right before the search returns
+
+    response, seconds = await _awith_retries(search, controller, "Page request", shrink=True)
+    controller.metrics.request(seconds, _RESPONSE_STATS.bytes, _RESPONSE_STATS.seconds)
+    controller.record(len(response.get("hits", {}).get("hits", [])), _RESPONSE_STATS.bytes, seconds)
+    return response
+
+
+@contextmanager
+def _point_in_time(es:Elasticsearch, index:str, controller:_PageController =None):
+    """ Context manager that opens a point in time on the index and makes sure it
+    is closed again, even when the download fails part way through.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): the index to open the point in time on
+        controller (_PageController): retries the requests, a new one if None
+
+    Yields:
+        str: the point in time id
+    """
+    pit_id = _with_retries(lambda: es.open_point_in_time(index=index, keep_alive=_PIT_KEEP_ALIVE), controller, "Opening a point in time")["id"]
+    try:
+        yield pit_id
+    finally:
+        try:
+            _with_retries(lambda: es.close_point_in_time(body={"id": pit_id}), controller, "Closing the point in time")
+        except Exception as e:  # The point in time expires on its own, never hide the original error
+            logger.warning(f"Failed to close point in time: {e}")
+
+
+def _page_body(json:dict, pit_id:str, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =None) -> dict:
+    """ Copy the query json body and set up the sort and point in time for paging.
+    Pages are sorted on the paging fields when given with _shard_doc as the final
+    tiebreaker.
+
+    Args:
+        json (dict): the json body of the query, it is not modified
+        pit_id (str): the point in time to search in
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        return_fields (list): the fields to request when the query uses the fields api
+
+    Returns:
+        dict: the json body for the first page
+    """
+    body = copy.deepcopy(json)
+    body["sort"] = [{field: "asc"} for field in (paging_time_field, paging_id_field) if field != None] + [{"_shard_doc": "asc"}]
+    body["pit"] = {"id": pit_id, "keep_alive": _PIT_KEEP_ALIVE}
+    body["track_total_hits"] = False  # Counting the matches on every page is wasted work, see _record_total
+    if body.get("_source") is False:
+        body["fields"] = list(return_fields)
+
+    return body
+
+
+def _next_page(body:dict, hits:list, response:dict) -> None:
+    """ Move the page body on to the page after the response.
+
+    Args:
+        body (dict): the json body used for the request
+        hits (list): the hits of the response
+        response (dict): the raw search response
+    """
+    body["search_after"] = hits[-1]["sort"]  # Set page marker to last result
+    body["pit"]["id"] = response.get("pit_id", body["pit"]["id"])  # The id can change between pages
+
+
+def _page_documents(es:Elasticsearch, pit_id:str, json:dict, return_fields:list, paging_id_field:str =None, paging_time_field:str =None, cursor:list =None, controller:_PageController =None, count_hits:bool =False):
+    """ Generator that pages through every document matching the query in a point in
+    time and yields the cleaned documents one page at a time.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        pit_id (str): the point in time to search in
+        json (dict): the json body of the query, it is not modified
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        cursor (list): optional, the paging field sort values of the last document
+            already downloaded. Paging starts after it when it is not empty, and it is
+            updated in place after every page. Unlike the _shard_doc tiebreaker these
+            values stay valid across points in time, so they can be saved and resumed
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+        count_hits (bool): count the documents matching the query with the first page
+            and pass the total to the controller's metrics
+
+    Yields:
+        list: a page of cleaned json documents
+    """
+    controller = controller if controller != None else _PageController()
+    body = _page_body(json, pit_id, paging_id_field, paging_time_field, return_fields)
+    body["track_total_hits"] = count_hits
+    if cursor:  # Skip every document sorting at or before the cursor
+        body["search_after"] = list(cursor) + [_SHARD_DOC_MAX]
+
+    while True:  # Main response loop
+        # Search query on the point in time, the controller picks the page size
+        response = _search_page(es, body, return_fields, controller)
+        _record_total(body, response, controller.metrics)
+        res_docs = response.get("hits", {}).get("hits", [])
+
+        if not res_docs:  # If no new responses returned leave loop
+            break
+
+        _next_page(body, res_docs, response)
+        if cursor != None:
+            cursor[:] = res_docs[-1]["sort"][:-1]  # Drop the _shard_doc tiebreaker
+        with controller.metrics.timed("clean"):
+            rows = _clean_page(res_docs, body, return_fields)
+        yield rows
+
+
+def _get_time_bounds(es:Elasticsearch, pit_id:str, json:dict, time_field:str, controller:_PageController =None) -> (int, int, int):
+    """ Find the earliest and latest value of the time field across the documents
+    matching the query, and count them on the way.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        pit_id (str): the point in time to search in
+        json (dict): the json body of the query
+        time_field (str): the date/time field to find the bounds of
+        controller (_PageController): retries the request, a new one if None
+
+    Returns:
+        int: the earliest time in epoch milliseconds, None if no documents match
+        int: the latest time in epoch milliseconds, None if no documents match
+        int: the documents matching the query, None if elasticsearch did not say
+    """
+    body = {"query": json["query"], "size": 0, "pit": {"id": pit_id, "keep_alive": _PIT_KEEP_ALIVE}, "track_total_hits": True,
+            "aggs": {"min_time": {"min": {"field": time_field}}, "max_time": {"max": {"field": time_field}}}}
+    response = _with_retries(lambda: es.search(body=body), controller, "Finding the time range")
+    lower = response["aggregations"]["min_time"]["value"]
+    upper = response["aggregations"]["max_time"]["value"]
+    total = response.get("hits", {}).get("total", {}).get("value")  # The aggregation visits every match anyway
+
+    if lower == None or upper == None:
+        return None, None, total
+
+    return int(lower), int(upper), total
+
+
+def _split_time_windows(lower:int, upper:int, count:int) -> list:
+    """ Split the inclusive range lower to upper into contiguous windows of
+    roughly equal length.
+
+    Args:
+        lower (int): the start of the range in epoch milliseconds
+        upper (int): the end of the range in epoch milliseconds
+        count (int): the number of windows wanted
+
+    Returns:
+        list: a list of (gte, lt) tuples, the final window's upper bound is inclusive
+    """
+    count = max(1, min(count, upper - lower + 1))
+    step = (upper - lower + 1) / count
+    bounds = [lower + int(step * n) for n in range(count)] + [upper + 1]
+
+    return [(bounds[n], bounds[n + 1]) for n in range(count)]
+
+
+def _add_time_window(json:dict, time_field:str, window:tuple) -> dict:
+    """ Copy the query json body and restrict it to a single time window.
+
+    Args:
+        json (dict): the json body of the query
+        time_field (str): the date/time field to filter on
+        window (tuple): the (gte, lt) bounds of the window in epoch milliseconds
+
+    Returns:
+        dict: a new json query body with the window added as a filter
+    """
+    window_json = copy.deepcopy(json)
+    bool_query = window_json['query']['bool']
+
+    filters = bool_query.get('filter', [])
+    if type(filters) is not list:
+        filters = [filters]
+    filters.append({"range": {time_field: {"gte": window[0], "lt": window[1], "format": "epoch_millis"}}})
+    bool_query['filter'] = filters
+
+    return window_json
+
+
+def _add_missing_filter(json:dict, field:str) -> dict:
+    """ Copy the query json body and restrict it to documents without a value in a field.
+
+    Args:
+        json (dict): the json body of the query
+        field (str): the field that must be missing
+
+    Returns:
+        dict: a new json query body with the field excluded by must_not exists
+    """
+    missing_json = copy.deepcopy(json)
+    bool_query = missing_json['query']['bool']
+
+    must_not = bool_query.get('must_not', [])
+    if type(must_not) is not list:
+        must_not = [must_not]
+    must_not.append({"exists": {"field": field}})
+    bool_query['must_not'] = must_not
+
+    return missing_json
+
+
+def _split_query(es:Elasticsearch, pit_id:str, json:dict, paging_time_field:str, count:int, metrics:_Metrics =None, controller:_PageController =None) -> list:
+    """ Split the query into slices that can be downloaded independently. With a
+    paging time field the slices are contiguous time windows so joining them in order
+    keeps the time ordering, followed by a slice of the documents without a time (which
+    sort last when paging on one worker), otherwise point in time slicing is used.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        pit_id (str): the point in time to search in
+        json (dict): the json body of the query
+        paging_time_field (str): the date/time field to partition on or None
+        count (int): the number of slices wanted
+        metrics (_Metrics): given the documents matching the query when the time
+            windows are found, None to ignore them
+        controller (_PageController): retries the requests, a new one if None
+
+    Returns:
+        list: a json query body for every slice
+    """
+    if paging_time_field == None:
+        if count < 2:
+            return [copy.deepcopy(json)]
+        return [dict(copy.deepcopy(json), slice={"id": num, "max": count}) for num in range(count)]
+
+    lower, upper, total = _get_time_bounds(es, pit_id, json, paging_time_field, controller)
+    if metrics != None:
+        metrics.found("query", total)
+
+    slices = []
+    if lower != None:
+        slices = [_add_time_window(json, paging_time_field, window) for window in _split_time_windows(lower, upper, count)]
+    if total != 0:  # No window matches documents missing the time field
+        slices.append(_add_missing_filter(json, paging_time_field))
+
+    return slices
+
+
+def _iter_slices(es:Elasticsearch, pit_id:str, json:dict, return_fields:list, paging_id_field:str, paging_time_field:str, workers:int, controller:_PageController =None):
+    """ Generator that partitions the query and downloads each partition (slice) on a
+    pool of worker threads, yielding pages as they arrive. Slices are four times as
+    many as workers so that uneven slices are balanced out across the pool, and the
+    queue between the workers and the consumer is bounded to keep memory flat.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        pit_id (str): the point in time to search in
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on and to partition
+        workers (int): the number of slices to download at the same time
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+
+    Yields:
+        int: the slice the page belongs to
+        list: a page of cleaned json documents
+    """
+    controller = controller if controller != None else _PageController()
+    slice_queries = _split_query(es, pit_id, json, paging_time_field, workers * 4, controller.metrics if controller.metrics.count == "hits" else None, controller)
+    logger.info(f"Downloading {len(slice_queries)} slices with {workers} workers")
+
+    count_hits = controller.metrics.count == "hits" and paging_time_field == None  # Time windows were counted when they were found
+    if count_hits:
+        controller.metrics.expect(len(slice_queries))
+
+    downloads = [partial(_page_documents, es, pit_id, slice_json, return_fields, paging_id_field, paging_time_field, controller=controller, count_hits=count_hits)
+                 for slice_json in slice_queries]
+    yield from _iter_parallel(downloads, workers)
+
+
+def _iter_parallel(downloads:list, workers:int):
+    """ Run page generators on a pool of worker threads, yielding pages as they
+    arrive. The queue between the workers and the consumer is bounded to keep memory
+    flat, and an error in any download is raised in the consumer straight away.
+
+    Args:
+        downloads (list): functions returning a generator of pages, one per download
+        workers (int): the number of downloads to run at the same time
+
+    Yields:
+        int: the position of the download the page belongs to
+        list: a page of cleaned json documents
+    """
+    pages = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+
+    def put(item:tuple) -> bool:
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def download(num:int, start) -> None:
+        try:
+            with closing(start()) as download_pages:  # Closed early when the consumer stops
+                for rows in download_pages:
+                    if not put((num, rows)):
+                        return
+        except Exception as e:  # Hand the error to the consumer so it is raised straight away
+            put((num, e))
+            return
+        put((num, None))  # Mark the download as finished
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for num, start in enumerate(downloads):
+            pool.submit(download, num, start)
+
+        remaining = len(downloads)
+        while remaining > 0:
+            num, rows = pages.get()
+            if rows == None:
+                remaining -= 1
+            elif isinstance(rows, Exception):
+                raise rows
+            else:
+                yield num, rows
+    finally:
+        stop.set()  # Unblock and stop the workers if the consumer stops early or fails
+        pool.shutdown(wait=True)
+
+
+def _resolve_indices(es:Elasticsearch, index:str, controller:_PageController =None) -> list:
+    """ Resolve an index pattern (wildcards, aliases, data streams or a comma separated
+    list) to the concrete indices behind it. Closed indices are skipped, including the
+    hidden backing indices of data streams. An alias with a filter or routing is kept
+    as it is rather than expanded, so its filter still applies to the download.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): the index pattern
+        controller (_PageController): retries the requests, a new one if None
+
+    Returns:
+        list: the names of the concrete indices and filtered aliases, sorted
+    """
+    response = _with_retries(lambda: es.indices.resolve_index(name=index), controller, "Resolving the indices")
+    indices = set(entry["name"] for entry in response.get("indices", []) if "closed" not in entry.get("attributes", []))
+    aliases = {alias["name"]: alias.get("indices", []) for alias in response.get("aliases", [])}
+    members = set(name for stream in response.get("data_streams", []) for name in stream.get("backing_indices", []))
+
+    if aliases:
+        response = _with_retries(lambda: es.indices.get_alias(name=",".join(sorted(aliases))), controller, "Fetching the aliases")
+        filtered = set(name for entry in response.values() for name, alias in entry.get("aliases", {}).items()
+                       if alias.get("filter") != None or alias.get("index_routing") != None or alias.get("search_routing") != None)
+        for name, alias_indices in aliases.items():
+            if name not in filtered:
+                members.update(alias_indices)
+            elif not set(alias_indices) <= indices:  # Its indices are not downloaded in full anyway
+                indices.add(name)
+
+    members -= indices
+    if members:  # Only the names are listed for aliases and data streams, look up which are closed
+        response = _with_retries(lambda: es.indices.resolve_index(name=",".join(sorted(members)), expand_wildcards="all"), controller, "Resolving the indices")
+        indices.update(entry["name"] for entry in response.get("indices", []) if "closed" not in entry.get("attributes", []))
+    if not indices:
+        raise Exception(f"Error: no open indices match '{index}'.")
+
+    return sorted(indices)
+
+
+def _iter_indices(es:Elasticsearch, indices:list, json:dict, return_fields:list, paging_id_field:str =None, paging_time_field:str =None, workers:int =1, controller:_PageController =None):
+    """ Generator that downloads every index on its own, with its own point in time and
+    paging cursor, up to workers indices at a time. On a family of time based indices
+    this spreads the load across the data nodes and spares the coordinating node from
+    merging every page across all of them.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        indices (list): the concrete indices to download, see _resolve_indices
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        workers (int): the number of indices to download at the same time
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+
+    Yields:
+        int: the position in indices of the index the page belongs to
+        list: a page of cleaned json documents
+    """
+    controller = controller if controller != None else _PageController()
+    logger.info(f"Downloading {len(indices)} indices with {workers} workers")
+
+    count_hits = controller.metrics.count == "hits"
+    if count_hits:
+        controller.metrics.expect(len(indices))
+
+    def download_index(index:str):
+        with _point_in_time(es, index, controller) as pit_id:
+            yield from _page_documents(es, pit_id, json, return_fields, paging_id_field, paging_time_field, controller=controller, count_hits=count_hits)
+
+    yield from _iter_parallel([partial(download_index, index) for index in indices], workers)
+
+
+def _iter_pages(es:Elasticsearch, index:str, json:dict, return_fields:list, paging_id_field:str =None, paging_time_field:str =None, workers:int =1, cursor:list =None, start_count:int =0, controller:_PageController =None, indices:list =None):
+    """ Generator that opens a point in time and yields every page of cleaned documents
+    while reporting progress. The documents matching the query are counted as set by
+    the metrics' count, by default with the first page of each slice instead of a
+    separate count request, so the download starts straight away.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): to search into
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        workers (int): the number of slices to download in parallel, 1 pages
+            through the query in a single sequential loop
+        cursor (list): the resumable paging cursor when not downloading in parallel,
+            see _page_documents
+        start_count (int): the documents already downloaded by an earlier run, for progress
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+        indices (list): the concrete indices behind index to download one by one, workers
+            at a time, instead of slicing the query, see _iter_indices
+
+    Yields:
+        int: the slice (or position in indices) the page belongs to, always 0 when not
+            downloading in parallel
+        list: a page of cleaned json documents
+    """
+    controller = controller if controller != None else _PageController()
+    metrics = controller.metrics
+    if metrics.count == "exact":
+        logger.info("Counting documents in query")
+        response = _with_retries(lambda: es.count(index=index, body={"query": json["query"]}), controller, "Counting the documents")  # Send a count query to check the total hits of the search
+        metrics.found("query", response['count'])
+        logger.info(f"Found {response['count']} documents matching query")
+
+    logger.info("Beginning download")
+
+    current_count = start_count
+    slice_counts = {}
+    metrics.started(start_count)
+
+    with _point_in_time(es, index, controller) if indices == None else nullcontext() as pit_id:  # Every index gets its own point in time
+        if indices != None:
+            pages = _iter_indices(es, indices, json, return_fields, paging_id_field, paging_time_field, workers, controller)
+        elif workers > 1:
+            pages = _iter_slices(es, pit_id, json, return_fields, paging_id_field, paging_time_field, workers, controller)
+        else:
+            pages = ((0, rows) for rows in _page_documents(es, pit_id, json, return_fields, paging_id_field, paging_time_field, cursor, controller, metrics.count == "hits"))
+
+        try:
+            for slice_num, rows in pages:
+                current_count += len(rows)
+                if indices != None or workers > 1:
+                    slice_counts[slice_num] = slice_counts.get(slice_num, 0) + len(rows)
+                    part = f"index {indices[slice_num]}" if indices != None else f"slice {slice_num}"
+                    logger.info(f"Downloading {part}: [{slice_counts[slice_num]}] total: {metrics.progress(current_count)}")
+                else:
+                    logger.info(f"Downloading: {metrics.progress(current_count)}")
+                metrics.page(slice_num, len(rows), current_count, metrics.expected()[0], controller.size)
+                yield slice_num, rows
+        finally:
+            pages.close()  # Stop any workers before the point in time is closed
+
+    metrics.done(current_count, metrics.expected()[0], controller.size)
+
+
+def _split_extension(path:str) -> (str, str):
+    """ Split a path into its name and extension like os.path.splitext, keeping a
+    compression suffix with the format, e.g. output.csv.gz becomes output and .csv.gz.
+
+    Args:
+        path (str): the path to split
+
+    Returns:
+        str: the path without the extension
+        str: the extension
+    """
+    name, extension = os.path.splitext(path)
+    if extension in _COMPRESSION_EXTENSIONS:
+        name, format_extension = os.path.splitext(name)
+        extension = format_extension + extension
+
+    return name, extension
+
+
+def _open_output_file(path:str):
+    """ Open a file for writing in binary, compressed with gzip or zstd when its name
+    ends in .gz or .zst. Both compressors release the GIL, so compressing on the
+    background writer thread overlaps with the download.
+
+    Args:
+        path (str): the path to the file
+
+    Returns:
+        the writable binary file
+    """
+    extension = os.path.splitext(path)[1]
+
+    if extension == ".gz":
+        return gzip.open(path, "wb", compresslevel=_GZIP_LEVEL)
+
+    elif extension == ".zst":
+        if zstandard == None:
+            raise Exception("Error: zstd outputs need the zstandard package, install it with 'pip install esextract[zstd]' or use .gz.")
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).stream_writer(open(path, "wb"))
+
+    return open(path, "wb")
+
+
+def _slice_file_name(out_file:str, slice_num:int) -> str:
+    """ Build the name of a per-slice part file from the output file name,
+    e.g. output.csv becomes output.part0003.csv.
+
+    Args:
+        out_file (str): the path to the output file including filename
+        slice_num (int): the slice the part file holds
+
+    Returns:
+        str: the path to the part file
+    """
+    name, extension = _split_extension(out_file)
+    return f"{name}.part{slice_num:04d}{extension}"
+
+
+def _index_file_name(out_file:str, index:str) -> str:
+    """ Name the part file of one index when each index is written on its own.
+
+    Args:
+        out_file (str): the path to the output file including filename
+        index (str): the concrete index
+
+    Returns:
+        str: the path to the part file, e.g. output.ps_tweets-2021.01.csv
+    """
+    name, extension = _split_extension(out_file)
+    return f"{name}.{index.replace(':', '_')}{extension}"  # Indices of remote clusters are prefixed with cluster:
+
+
+def _infer_arrow_array(values:list) -> pa.Array:
+    """ Infer an arrow array from a column of cleaned documents. Missing fields are
+    stored as empty strings in the cleaned documents, so when the column does not
+    convert as it is they are treated as nulls, and columns that still have mixed
+    types are stored as strings.
+
+    Args:
+        values (list): the column values
+
+    Returns:
+        pyarrow.Array: the column as an arrow array, of null type if the field is
+            missing from every document
+    """
+    if all(value == "" or value == None for value in values):  # Nothing to infer from, the writers widen it later
+        return pa.nulls(len(values))
+
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        try:
+            return pa.array([None if value == "" else value for value in values])
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array([None if value == "" else str(value) for value in values])
+
+
+def _typed_array(values:list, data_type:pa.DataType) -> pa.Array:
+    """ Convert a column to a type with a safe cast, so values that do not fit (e.g.
+    5.5 in an integer column) raise instead of being truncated. Dates are parsed from
+    epoch milliseconds or iso strings, those without a zone are in UTC.
+
+    Args:
+        values (list): the column values, with missing fields as None
+        data_type (pyarrow.DataType): the type of the column
+
+    Returns:
+        pyarrow.Array: the column as an arrow array
+    """
+    if pa.types.is_list(data_type):  # The values of every list are converted like a column of their own
+        values = [value if value == None or type(value) is list else [value] for value in values]
+        items = _typed_array([item for value in values if value != None for item in value], data_type.value_type)
+        offsets = [0]
+        for value in values:
+            offsets.append(offsets[-1] + (len(value) if value != None else 0))
+        return pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), items, type=data_type, mask=pa.array([value == None for value in values]))
+
+    if pa.types.is_timestamp(data_type) and len(set(type(value) for value in values if value != None)) > 1:  # Epoch milliseconds mixed with date strings
+        numbers = _typed_array([None if type(value) is str else value for value in values], data_type)
+        texts = _typed_array([value if type(value) is str else None for value in values], data_type)
+        return pc.if_else(pc.is_valid(numbers), numbers, texts)
+
+    array = pa.array(values)
+    if pa.types.is_timestamp(data_type) and pa.types.is_integer(array.type):  # Epoch milliseconds, whatever the unit of the column
+        return pc.cast(pc.cast(array, pa.timestamp("ms", data_type.tz), safe=True), data_type, safe=True)
+    elif pa.types.is_timestamp(data_type) and data_type.tz != None and pa.types.is_string(array.type):
+        try:
+            return pc.cast(array, data_type, safe=True)
+        except pa.ArrowInvalid:  # Dates without a zone are in UTC
+            zoned = pc.match_substring_regex(array, r"(Z|[+-]\d\d:?\d\d)$")
+            missing = pa.scalar(None, pa.string())
+            with_zone = pc.cast(pc.if_else(zoned, array, missing), data_type, safe=True)
+            without_zone = pc.cast(pc.cast(pc.if_else(zoned, missing, array), pa.timestamp(data_type.unit), safe=True), data_type, safe=True)
+            return pc.if_else(zoned, with_zone, without_zone)
+
+    return pc.cast(array, data_type, safe=True)
+
+
+def _widen_schema(schema:pa.Schema, other:pa.Schema) -> pa.Schema:
+    """ Merge the schemas of two pages with the same fields into one both convert to:
+    nulls take the other type, integers widen to larger integers or floats, and
+    fields whose types do not merge are stored as strings, like _infer_arrow_array.
+
+    Args:
+        schema (pyarrow.Schema): the schema so far
+        other (pyarrow.Schema): the schema of the new page
+
+    Returns:
+        pyarrow.Schema: the merged schema
+    """
+    fields = []
+    for field in schema:
+        other_field = other.field(field.name)
+        try:
+            fields.append(pa.unify_schemas([pa.schema([field]), pa.schema([other_field])], promote_options="permissive").field(0))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            fields.append(pa.field(field.name, pa.string()))
+
+    return pa.schema(fields)
+
+
+def _widen_inferred(table:pa.Table, declared:pa.Schema =None) -> pa.Table:
+    """ Widen the inferred columns of the first page of a file up front to the types
+    later pages most likely fit, so the file schema rarely has to change: integers
+    become floats unless they are too large to be exact (e.g. ids), and fields missing
+    from every document become strings.
+
+    Args:
+        table (pyarrow.Table): the first page
+        declared (pyarrow.Schema): the declared types, those columns are left as they are
+
+    Returns:
+        pyarrow.Table: the page with the widened columns
+    """
+    columns = []
+    for field, column in zip(table.schema, table.columns):
+        if declared != None and field.name in declared.names:
+            pass
+        elif pa.types.is_integer(field.type):
+            try:
+                column = pc.cast(column, pa.float64(), safe=True)
+            except pa.ArrowInvalid:  # Keep large integers exact
+                pass
+        elif pa.types.is_null(field.type):
+            column = pa.array([""] * len(column), type=pa.string())
+        columns.append(column)
+
+    return pa.Table.from_arrays(columns, names=table.column_names)
+
+
+def _conform_table(table:pa.Table, schema:pa.Schema) -> pa.Table:
+    """ Safely cast a page to a schema it fits in, see _widen_schema. Values cast to a
+    string column that arrow can not cast (e.g. lists) are stored as their text, and
+    pages where the field was always missing get empty strings like other pages.
+
+    Args:
+        table (pyarrow.Table): the page
+        schema (pyarrow.Schema): the schema to cast to
+
+    Returns:
+        pyarrow.Table: the page in the schema
+    """
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if pa.types.is_null(column.type) and pa.types.is_string(field.type):
+            column = pa.array([""] * len(column), type=pa.string())
+        elif column.type != field.type:
+            try:
+                column = pc.cast(column, field.type, safe=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                if not pa.types.is_string(field.type):
+                    raise
+                column = pa.array([None if value == None else str(value) for value in column.to_pylist()], type=pa.string())
+        columns.append(column)
+
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _schema_array(values:list, data_type:pa.DataType =None) -> pa.Array:
+    """ Build an arrow array of the given type from a column of cleaned documents, with
+    missing fields (empty strings) as nulls. A field holding lists in any document
+    becomes a list of the type, dates are parsed from epoch milliseconds or iso strings
+    and values that do not convert fall back to an inferred type.
+
+    Args:
+        values (list): the column values
+        data_type (pyarrow.DataType): the type of the column, inferred if None
+
+    Returns:
+        pyarrow.Array: the column as an arrow array
+    """
+    values = [None if value == "" else value for value in values]
+    if data_type == None:
+        return _infer_arrow_array(values)
+
+    if not pa.types.is_list(data_type) and any(type(value) is list for value in values):  # Any field can hold several values
+        data_type = pa.list_(data_type)
+        values = [value if value == None or type(value) is list else [value] for value in values]
+
+    try:
+        return _typed_array(values, data_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+        logger.debug(f"Could not convert a column to {data_type}, inferring its type instead: {e}")
+        return _infer_arrow_array(values)
+
+
+def _pages_to_table(pages:list, schema:pa.Schema) -> pa.Table:
+    """ Join pages of arrow columns into one table. A column whose type differs
+    between pages (e.g. it only held lists in some of them) is converted again as a
+    whole.
+
+    Args:
+        pages (list): a dict of field name to arrow array for every page, see _schema_array
+        schema (pyarrow.Schema): the schema the pages were converted with
+
+    Returns:
+        pyarrow.Table: every page as one table
+    """
+    columns = []
+    for field in pages[0]:
+        chunks = [page[field] for page in pages]
+        if len({chunk.type for chunk in chunks}) > 1:
+            data_type = schema.field(field).type if field in schema.names else next((chunk.type for chunk in chunks if not pa.types.is_string(chunk.type)), None)
+            chunks = [_schema_array([value for chunk in chunks for value in chunk.to_pylist()], data_type)]
+        columns.append(pa.chunked_array(chunks))
+
+    return pa.Table.from_arrays(columns, names=list(pages[0]))
+
+
+def _mapped_type(mapping:dict, field:str) -> str:
+    """ Look up the arrow type alias of a dotted field name in an index mapping,
+    following object properties and multi-fields (e.g. text.keyword).
+
+    Args:
+        mapping (dict): the mappings of one index
+        field (str): the dotted field name
+
+    Returns:
+        str: the arrow type alias of the field, None if it is not mapped, an object, or a
+            date in a format other than iso dates and epoch milliseconds. Dates in a
+            nanosecond format are nanosecond timestamps, their source keeps the nanoseconds
+    """
+    properties = mapping.get("properties", {})
+    parts = field.split(".")
+    for num, part in enumerate(parts):
+        node = properties.get(part)
+        if node == None:
+            return None
+        rest = ".".join(parts[num + 1:])
+        if rest in node.get("fields", {}):
+            node = node["fields"][rest]
+            break
+        properties = node.get("properties", {})
+
+    if node.get("type") in ("date", "date_nanos"):
+        formats = node.get("format", "strict_date_optional_time||epoch_millis").split("||")
+        if not set(formats) <= _MAPPING_DATE_FORMATS:
+            return None
+        elif any(date_format.endswith("_nanos") for date_format in formats):
+            return "timestamp[ns]"
+
+    return _MAPPING_TYPES.get(node.get("type", "object"))
+
+
+def _mapping_schema(es:Elasticsearch, index:str, fields:list) -> pa.Schema:
+    """ Build an arrow schema for the return fields from the mapping of the index,
+    fetched once per query. Fields that are not mapped, are objects, are dates in a
+    custom format or have different types in the indices behind a pattern are left
+    out and their type is inferred.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): the index or index pattern to query
+        fields (list): the fields to return from the query
+
+    Returns:
+        pyarrow.Schema: the types of the mapped fields, dates in UTC
+    """
+    mappings = _with_retries(lambda: es.indices.get_mapping(index=index), what="Fetching the mapping")
+    schema = []
+    for field in fields:
+        types = {_mapped_type(mapping.get("mappings", {}), field) for mapping in mappings.values()}
+        if len(types) != 1 or None in types:
+            logger.debug(f"Field '{field}' has no single mapped type, its type will be inferred")
+            continue
+        data_type = pa.type_for_alias(types.pop())
+        if pa.types.is_timestamp(data_type):
+            data_type = pa.timestamp(data_type.unit, tz="UTC")
+        schema.append(pa.field(field, data_type))
+
+    return pa.schema(schema)
+
+
+def _resolve_schema(es:Elasticsearch, schema, index:str, fields:list, fields_api:bool =False) -> pa.Schema:
+    """ Resolve the schema argument of a query, 'mapping' builds it from the index mapping.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        schema (pyarrow.Schema | str): the declared schema, 'mapping' or None
+        index (str): the index or index pattern to query
+        fields (list): the fields to return from the query
+        fields_api (bool): the fields come from the fields api, which returns every
+            field as a list, so the declared types are those of the list values
+
+    Returns:
+        pyarrow.Schema: the declared schema or None to infer every type
+    """
+    if type(schema) is str:
+        if schema != "mapping":
+            raise Exception(f"Error: schema must be a pyarrow schema or 'mapping', not '{schema}'.")
+        schema = _mapping_schema(es, index, fields)
+
+    if schema != None and fields_api:
+        schema = pa.schema([field if pa.types.is_list(field.type) else field.with_type(pa.list_(field.type)) for field in schema])
+    return schema
+
+
+def _rows_to_table(rows:list, fields:list, schema:pa.Schema =None) -> pa.Table:
+    """ Build an arrow table from a page of cleaned documents, column by column.
+
+    Args:
+        rows (list): a page of cleaned json documents
+        fields (list): the fields in the documents, in column order
+        schema (pyarrow.Schema): the declared types of some or all of the fields, the
+            types of the rest are inferred from the rows. Dates that do not parse to
+            their declared timestamp are kept as text rather than failing the page
+
+    Returns:
+        pyarrow.Table: the page as an arrow table
+    """
+    columns = []
+    for field in fields:
+        values = [row[field] for row in rows]
+        if schema == None or field not in schema.names:
+            columns.append(_infer_arrow_array(values))
+            continue
+
+        data_type = schema.field(field).type
+        if not pa.types.is_string(data_type) and not pa.types.is_large_string(data_type):
+            values = [None if value == "" else value for value in values]  # Missing fields are nulls
+        try:
+            columns.append(_typed_array(values, data_type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            if pa.types.is_list(data_type) and pa.types.is_timestamp(data_type.value_type):
+                logger.debug(f"Could not parse the dates of '{field}' as {data_type}, keeping them as text: {e}")
+                columns.append(pa.array([None if value == None else [str(item) for item in (value if type(value) is list else [value])] for value in values], type=pa.list_(pa.string())))
+            elif pa.types.is_timestamp(data_type):
+                logger.debug(f"Could not parse the dates of '{field}' as {data_type}, keeping them as text: {e}")
+                columns.append(pa.array([None if value == None else str(value) for value in values], type=pa.string()))
+            else:
+                raise Exception(f"Error: field '{field}' does not match the declared schema type {data_type}. {e}")
+
+    return pa.Table.from_arrays(columns, names=fields)
+
+
+class _CsvPageWriter:
+    """ Writes pages of cleaned documents to a csv file as they are downloaded,
+    compressed when the file name ends in .gz or .zst.
+
+    Args:
+        out_file (str): the path including filename of the file to write to
+        fields (list): the fields in the documents, written as the headers
+        offset (int): resume an existing uncompressed file, cutting it back to this
+            many bytes instead of writing the headers
+    """
+    def __init__(self, out_file:str, fields:list, offset:int =None):
+        if offset == None:
+            logger.info(f"Writing headers to {out_file}")
+            self.file = io.TextIOWrapper(_open_output_file(out_file), newline="", encoding='utf-8')
+            self.writer = csv.DictWriter(self.file, fields)
+            self.writer.writeheader()
+        else:
+            logger.info(f"Resuming {out_file} from byte {offset}")
+            os.truncate(out_file, offset)  # Drop anything written after the checkpoint
+            self.file = open(out_file, "a", newline="", encoding='utf-8')
+            self.writer = csv.DictWriter(self.file, fields)
+
+    def write(self, rows:list) -> None:
+        self.writer.writerows(rows)
+
+    def tell(self) -> int:
+        """ Flush everything written to disk and return the size of the file.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def _json_lines(rows:list) -> bytes:
+    """ Encode cleaned documents as json lines, with orjson when it is installed.
+
+    Args:
+        rows (list): the cleaned json documents
+
+    Returns:
+        bytes: a utf-8 json line per document
+    """
+    if orjson != None:
+        try:
+            return b"".join([orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE) for row in rows])
+        except TypeError:  # Anything orjson rejects (e.g. integers above 64 bits) goes through json
+            pass
+
+    return "".join([json.dumps(row, ensure_ascii=False) + "\n" for row in rows]).encode("utf-8")
+
+
+class _JsonLinesPageWriter:
+    """ Writes pages of cleaned documents to a json lines file as they are downloaded,
+    one json object per line keyed by the return fields, e.g. {"user.id": 1}, with
+    lists and objects kept as they are. Compressed when the file name ends in .gz or .zst.
+
+    Args:
+        out_file (str): the path including filename of the file to write to
+    """
+    def __init__(self, out_file:str):
+        self.file = _open_output_file(out_file)
+
+    def write(self, rows:list) -> None:
+        self.file.write(_json_lines(rows))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class _SchemaChanged(Exception):
+    """ A page does not fit the schema of the arrow file being written.
+    """
+
+
+class _ParquetPageWriter:
+    """ Streams pages of cleaned documents into a parquet file as record batches
+    without holding the whole result in memory. The file takes the schema of the
+    first page, widened up front by _widen_inferred, and later pages are cast to it.
+    A page that still does not fit (e.g. text in a numeric field) is never truncated,
+    the file is closed and the rest of the download goes to a new part file with a
+    wider schema, e.g. output.part0001.parquet. Written rows are never rewritten.
+
+    Args:
+        out_file (str): the path including filename of the file to write to
+        fields (list): the fields in the documents, in column order
+        schema (pyarrow.Schema): the declared types of some or all of the fields, pages
+            that do not match them raise, the rest are inferred
+        row_group_size (int): the rows in each row group, by default every page is
+            written as its own row group
+        compression (str): the parquet compression codec
+    """
+    def __init__(self, out_file:str, fields:list, schema:pa.Schema =None, row_group_size:int =None, compression:str ="snappy"):
+        self.out_file = out_file
+        self.files = [out_file]
+        self.split = True  # Start a new part file when the types change, or raise _SchemaChanged
+        self.fields = fields
+        self.declared = schema
+        self.schema = None
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+
+    def _open_writer(self):
+        return pq.ParquetWriter(self.out_file, self.schema, compression=self.compression)
+
+    def _write_table(self, table:pa.Table) -> None:
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    def write(self, rows:list) -> None:
+        table = _rows_to_table(rows, self.fields, self.declared)
+        if self.writer == None:
+            table = _widen_inferred(table, self.declared)
+            self.schema = table.schema
+            logger.info(f"Writing {os.path.splitext(self.out_file)[1][1:]} schema to {self.out_file}")
+            self.writer = self._open_writer()
+        elif not table.schema.equals(self.schema):
+            try:
+                table = _conform_table(table, self.schema)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                if not self.split:
+                    raise _SchemaChanged(f"Error: the page does not fit the schema of {self.out_file}.")
+                table = self._next_file(table)
+
+        if self.row_group_size == None:
+            self._write_table(table)
+            return
+
+        self.pending.append(table)  # Buffer pages until there is a full row group
+        self.pending_rows += table.num_rows
+        if self.pending_rows >= self.row_group_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.pending:
+            self._write_table(pa.concat_tables(self.pending))
+            self.pending = []
+            self.pending_rows = 0
+
+    def _next_file(self, table:pa.Table) -> pa.Table:
+        """ Close the file and carry on in a new part file whose schema the page fits.
+        """
+        self._flush()
+        self.writer.close()
+
+        schema = _widen_schema(self.schema, table.schema)
+        changed = [field.name for field in schema if field.type != self.schema.field(field.name).type]
+        self.out_file = _slice_file_name(self.files[0], len(self.files))
+        self.files.append(self.out_file)
+        logger.warning(f"The types of {', '.join(changed)} changed part way through the download, writing the rest to {self.out_file}")
+        self.schema = schema
+        self.writer = self._open_writer()
+        return _conform_table(table, schema)
+
+    def close(self) -> None:
+        if self.writer != None:
+            self._flush()
+            self.writer.close()
+            self.writer = None
+
+
+class _FeatherPageWriter(_ParquetPageWriter):
+    """ Streams pages of cleaned documents into an arrow ipc (feather v2) file, which
+    read_dataframe_from_file memory maps. The file is uncompressed unless compression
+    is lz4 or zstd, only uncompressed files can be read without copying.
+
+    Args:
+        out_file (str): the path including filename of the file to write to
+        fields (list): the fields in the documents, in column order
+        schema (pyarrow.Schema): the declared types of some or all of the fields, the
+            rest are inferred and widened like _ParquetPageWriter
+        row_group_size (int): the rows in each record batch, by default every page
+            is written as its own record batch
+        compression (str): lz4 or zstd to compress the record batches
+    """
+    def _open_writer(self):
+        compression = self.compression if self.compression in ("lz4", "zstd") else None
+        return pa.ipc.new_file(self.out_file, self.schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+    def _write_table(self, table:pa.Table) -> None:
+        self.writer.write_table(table, max_chunksize=self.row_group_size)
+
+
+def _open_page_writer(out_file:str, fields:list, schema:pa.Schema =None, row_group_size:int =None, compression:str ="snappy"):
+    """ Open the page writer matching the output file extension.
+
+    Args:
+        out_file (str): the path including filename of the file to write to
+        fields (list): the fields in the documents
+        schema (pyarrow.Schema): the declared parquet types of some or all fields, the rest are inferred
+        row_group_size (int): the rows in each parquet row group
+        compression (str): the parquet compression codec
+
+    Returns:
+        the csv, json lines, parquet or feather writer for the file
+    """
+    f, extension = _split_extension(out_file)
+
+    if extension in (".csv", ".csv.gz", ".csv.zst"):
+        return _CsvPageWriter(out_file, fields)
+
+    elif extension in (".jsonl", ".jsonl.gz", ".jsonl.zst"):
+        return _JsonLinesPageWriter(out_file)
+
+    elif extension == ".parquet":
+        return _ParquetPageWriter(out_file, fields, schema, row_group_size, compression)
+
+    elif extension in (".feather", ".arrow"):
+        return _FeatherPageWriter(out_file, fields, schema, row_group_size, compression)
+
+    else:
+        raise Exception("Invalid output format please use either '.csv', '.jsonl', '.parquet', '.feather' or '.arrow', csv and jsonl can add '.gz' or '.zst'")
+
+
+class _BackgroundPageWriter:
+    """ Runs a page writer on its own thread fed by a bounded queue, so encoding,
+    compressing and writing pages overlaps with downloading the next ones instead of
+    stalling the page requests. The download only waits when the queue is full. An
+    error in the writer is raised by the next write, flush or close.
+
+    Args:
+        writer: the page writer to run in the background
+        metrics (_Metrics): times the writes on the writer thread, None to not time them
+        queue_size (int): the pages waiting to be written before write blocks
+    """
+    def __init__(self, writer, metrics:_Metrics =None, queue_size:int =_WRITER_QUEUE_SIZE):
+        self.writer = writer
+        self.metrics = metrics
+        self.pages = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="esextract-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            rows = self.pages.get()
+            try:
+                if rows == None:
+                    return
+                elif self.error != None:
+                    continue  # Keep draining so write never blocks on a failed writer
+                with self.metrics.timed("write") if self.metrics != None else nullcontext():
+                    self.writer.write(rows)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pages.task_done()
+
+    def write(self, rows:list) -> None:
+        if self.error != None:
+            raise self.error
+        self.pages.put(rows)
+
+    def flush(self) -> None:
+        """ Wait for the queued pages to be written, e.g. before reading the position of
+        the writer for a checkpoint.
+        """
+        self.pages.join()
+        if self.error != None:
+            raise self.error
+
+    def close(self) -> None:
+        """ Wait for the queued pages to be written, then close the writer.
+        """
+        self.pages.put(None)
+        self.thread.join()
+        with self.metrics.timed("write") if self.metrics != None else nullcontext():
+            self.writer.close()
+        if self.error != None:
+            raise self.error
+
+
+def _parse_partition_by(partition_by:str) -> (str, str):
+    """ Split a partition spec into its field and granularity, e.g. created_at:day
+    partitions by the day of created_at and lang by the values of lang.
+
+    Args:
+        partition_by (str): field:day, field:month or a field
+
+    Returns:
+        str: the field to partition by
+        str: 'day', 'month' or None to partition by the field values
+    """
+    field, separator, granularity = partition_by.partition(":")
+    if not field or granularity not in ("", "day", "month"):
+        raise Exception(f"Error: partition by field:day, field:month or a field, not '{partition_by}'.")
+
+    return field, granularity or None
+
+
+def _partition_value(value, granularity:str =None) -> str:
+    """ The partition a document belongs to from the value of its partition field.
+    Dates are read as epoch milliseconds when they are numbers and as iso dates when
+    they are strings, and partitioned by their UTC day (yyyy-mm-dd) or month (yyyy-mm).
+
+    Args:
+        value: the value of the partition field in the cleaned document
+        granularity (str): 'day', 'month' or None to partition by the value itself
+
+    Returns:
+        str: the partition value, None if the value is not a date that can be read
+    """
+    if isinstance(value, list):  # Multi-valued fields go to the partition of their first value
+        value = value[0] if value else None
+    if value == None or value == "":
+        return _HIVE_DEFAULT_PARTITION
+    elif granularity == None:
+        return str(value)
+
+    try:
+        if isinstance(value, (int, float)) or str(value).isdigit():
+            date = datetime.datetime.fromtimestamp(int(value) / 1000, datetime.timezone.utc)
+        else:
+            date = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+            if date.tzinfo != None:
+                date = date.astimezone(datetime.timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        return None
+
+    return date.strftime("%Y-%m-%d" if granularity == "day" else "%Y-%m")
+
+
+class _PartitionedWriter:
+    """ Writes pages of cleaned documents to a hive-style partitioned dataset, a
+    directory with a sub directory per partition (e.g. created_at_day=2021-01-01)
+    holding part files in any output format of at most max_rows_per_file rows. Only the
+    most recently written partitions keep their file open, a partition written again
+    after its file was closed carries on in a new part file. Once the download is
+    complete write_manifest() lists every file with its rows and the range of the
+    paging fields in it in a _SUCCESS file, which readers can wait for.
+
+    Args:
+        directory (str): the dataset directory, created if needed, it must be empty
+        extension (str): the format of the part files, see _OUTPUT_EXTENSIONS
+        fields (list): the fields in the documents
+        partition_by (str): partition by field:day, field:month or the values of a
+            field, None to only split the output into files of max_rows_per_file
+        max_rows_per_file (int): the most rows in a part file, no limit if None
+        paging_fields (list): the fields whose smallest and largest values are recorded per file
+        schema (pyarrow.Schema): the declared parquet types of some or all fields, the rest
+            are inferred per part file and the manifest records one schema they all cast to
+        row_group_size (int): the rows in each parquet row group
+        compression (str): the parquet compression codec
+    """
+    def __init__(self, directory:str, extension:str, fields:list, partition_by:str =None, max_rows_per_file:int =None, paging_fields:list =[], schema:pa.Schema =None, row_group_size:int =None, compression:str ="snappy"):
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise Exception(f"Error: the dataset directory '{directory}' is not empty, remove it or pick another output.")
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.extension = extension
+        self.fields = fields
+        self.partition_by = partition_by
+        self.field, self.granularity = _parse_partition_by(partition_by) if partition_by != None else (None, None)
+        self.column = f"{self.field}_{self.granularity}" if self.granularity != None else self.field
+        self.max_rows_per_file = max_rows_per_file
+        self.paging_fields = paging_fields
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.open_files = {}  # Partition to its open writer and file entry, least recently written first
+        self.parts = {}  # Part files started in each partition
+        self.files = []
+        self.arrow_files = []  # Writers of parquet and feather part files, see close
+        self.unreadable = 0
+
+    def write(self, rows:list) -> None:
+        groups = {}
+        for row in rows:
+            partition = _partition_value(row[self.field], self.granularity) if self.field != None else None
+            if partition == None and self.field != None:
+                self.unreadable += 1
+                partition = _HIVE_DEFAULT_PARTITION
+            groups.setdefault(partition, []).append(row)
+
+        for partition, group in groups.items():
+            while group:
+                writer, entry = self._open(partition)
+                room = len(group) if self.max_rows_per_file == None else self.max_rows_per_file - entry["rows"]
+                chunk, group = group[:room], group[room:]
+                try:
+                    writer.write(chunk)
+                except _SchemaChanged:  # The types changed, carry on in a new part file of the partition
+                    self._close(partition)
+                    writer, entry = self._open(partition)
+                    writer.write(chunk)
+                self._record(entry, chunk)
+                if self.max_rows_per_file != None and entry["rows"] >= self.max_rows_per_file:
+                    self._close(partition)
+
+    def _open(self, partition:str) -> tuple:
+        """ Return the open writer and file entry of a partition, starting a new part
+        file if it has none and closing the least recently written file if too many are open.
+        """
+        if partition in self.open_files:
+            self.open_files[partition] = self.open_files.pop(partition)  # Now the most recently written
+            return self.open_files[partition]
+
+        if len(self.open_files) >= _MAX_OPEN_PARTITIONS:
+            self._close(next(iter(self.open_files)))
+
+        part = self.parts.get(partition, 0)
+        self.parts[partition] = part + 1
+        name = f"part-{part:05d}{self.extension}"
+        path = os.path.join(f"{self.column}={quote(partition, safe='')}", name) if self.field != None else name
+        os.makedirs(os.path.dirname(os.path.join(self.directory, path)), exist_ok=True)
+
+        writer = _open_page_writer(os.path.join(self.directory, path), self.fields, self.schema, self.row_group_size, self.compression)
+        if isinstance(writer, _ParquetPageWriter):
+            writer.split = False  # Every part file has to be listed in the manifest
+            self.arrow_files.append(writer)
+        entry = {"path": path, "partition": {self.column: partition} if self.field != None else {}, "rows": 0, "min": {}, "max": {}}
+        self.files.append(entry)
+        self.open_files[partition] = (writer, entry)
+        return writer, entry
+
+    def _record(self, entry:dict, rows:list) -> None:
+        """ Add a chunk of rows to the row count and paging field ranges of a file.
+        """
+        entry["rows"] += len(rows)
+        for field in self.paging_fields:
+            values = [value for row in rows for value in (row[field] if isinstance(row[field], list) else [row[field]]) if value not in ("", None)]
+            if values:
+                entry["min"][field] = min(values + ([entry["min"][field]] if field in entry["min"] else []))
+                entry["max"][field] = max(values + ([entry["max"][field]] if field in entry["max"] else []))
+
+    def _close(self, partition:str) -> None:
+        writer, entry = self.open_files.pop(partition)
+        writer.close()
+
+    def close(self) -> None:
+        for partition in list(self.open_files):
+            self._close(partition)
+
+    def write_manifest(self) -> None:
+        """ Write the _SUCCESS manifest, only once every file is complete.
+        """
+        if self.unreadable > 0:
+            logger.warning(f"{self.unreadable} documents had a '{self.field}' that is not a date, they were written to the {_HIVE_DEFAULT_PARTITION} partition")
+
+        format_extension, compression = os.path.splitext(self.extension)  # e.g. .csv and .gz, or .parquet and nothing
+        schemas = [writer.schema for writer in self.arrow_files if writer.schema != None]
+        schema = reduce(_widen_schema, schemas) if schemas else None  # Part files whose types differ are cast to it when read
+        _write_json_atomic(os.path.join(self.directory, "_SUCCESS"), {
+            "format": format_extension[1:], "compression": _COMPRESSION_EXTENSIONS.get(compression), "partition_by": self.partition_by, "partition_column": self.column,
+            "max_rows_per_file": self.max_rows_per_file, "rows": sum(entry["rows"] for entry in self.files),
+            "schema": base64.b64encode(schema.serialize().to_pybytes()).decode() if schema != None else None,
+            "files": self.files, "created": datetime.datetime.now(datetime.timezone.utc).isoformat()})
+
+
+def _query_hash(index:str, body:dict, return_fields:list, paging_id_field:str, paging_time_field:str, schema:pa.Schema =None) -> str:
+    """ Hash everything that decides which rows a query writes, so a checkpoint is
+    never resumed with a different query.
+
+    Args:
+        index (str): to search into
+        body (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        schema (pyarrow.Schema): the schema the rows are converted to, if any
+
+    Returns:
+        str: the sha256 hex digest of the query
+    """
+    query = {"index": index, "body": body, "fields": return_fields, "sort": [paging_time_field, paging_id_field]}
+    if schema != None:
+        query["schema"] = schema.to_string()
+    return hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _write_json_atomic(path:str, data:dict) -> None:
+    """ Atomically replace a small json state file (checkpoints, watermarks), so a
+    crash while saving leaves the previous version in place.
+
+    Args:
+        path (str): the path to the json file
+        data (dict): the data to save
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _load_checkpoint(path:str, query_hash:str) -> dict:
+    """ Load the checkpoint file of an earlier run of the same query.
+
+    Args:
+        path (str): the path to the checkpoint file
+        query_hash (str): the hash of the query being resumed
+
+    Returns:
+        dict: the saved checkpoint
+    """
+    if not os.path.exists(path):
+        raise Exception(f"Error: no checkpoint found at '{path}' to resume from.")
+
+    with open(path) as f:
+        checkpoint = json.load(f)
+
+    if checkpoint["query_hash"] != query_hash:
+        raise Exception(f"Error: the checkpoint at '{path}' was saved for a different query.")
+
+    return checkpoint
+
+
+def _load_watermark(state_file:str, query_hash:str) -> dict:
+    """ Load the high watermark of a query from the incremental state store.
+
+    Args:
+        state_file (str): the path to the json state store, it does not need to exist yet
+        query_hash (str): the hash of the query, see _query_hash
+
+    Returns:
+        dict: the watermark of the query, empty if the query has not been run before
+    """
+    if not os.path.exists(state_file):
+        return {}
+
+    with open(state_file) as f:
+        return json.load(f).get(query_hash, {})
+
+
+def _save_watermark(state_file:str, query_hash:str, watermark:dict) -> None:
+    """ Save the high watermark of a query to the incremental state store, keeping the
+    watermarks of every other query in it.
+
+    Args:
+        state_file (str): the path to the json state store
+        query_hash (str): the hash of the query, see _query_hash
+        watermark (dict): the new watermark of the query
+    """
+    with _STATE_LOCK:  # Queries run in the same process share the store
+        state = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+        state[query_hash] = watermark
+        _write_json_atomic(state_file, state)
+
+
+def _delta_file_name(out_file:str) -> str:
+    """ Build the name of the new partition file for an incremental run from the
+    output file name, e.g. output.csv becomes output.20210101T020000-000.csv. The
+    zero padded sequence tells apart runs in the same second and keeps the partition
+    files sorting in the order they were written.
+
+    Args:
+        out_file (str): the path to the dataset output file including filename
+
+    Returns:
+        str: the path to the partition file
+    """
+    name, extension = _split_extension(out_file)
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S')
+
+    run = 0
+    while os.path.exists(f"{name}.{stamp}-{run:03d}{extension}"):  # Never overwrite an earlier partition from the same second
+        run += 1
+
+    return f"{name}.{stamp}-{run:03d}{extension}"
+
+
+def _is_closed_range(end_date:str) -> bool:
+    """ Check if a query's date range ended before today, no new documents are
+    expected in it so its results can be cached without expiring.
+
+    Args:
+        end_date (str): the last date of the query in format yyyy-mm-dd, or 'now'
+
+    Returns:
+        bool: True if the date range is closed
+    """
+    try:
+        return end_date != None and datetime.date.fromisoformat(end_date) < datetime.datetime.now(datetime.timezone.utc).date()
+    except ValueError:  # 'now' or date math
+        return False
+
+
+def _table_to_dataframe(table:pa.Table) -> pandas.DataFrame:
+    """ Convert a cached arrow table back to the DataFrame query_to_dataframe builds.
+    Nulls in non-string columns were missing fields (empty strings) before caching and
+    list columns hold python lists.
+
+    Args:
+        table (pyarrow.Table): the cached table
+
+    Returns:
+        pandas.DataFrame: the DataFrame
+    """
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        nested = pa.types.is_nested(column.type)
+        values = pandas.Series(column.to_pylist(), dtype=object) if nested else column.to_pandas(integer_object_nulls=True)
+        if column.null_count > 0 and not pa.types.is_string(column.type) and not pa.types.is_large_string(column.type):
+            values = values.astype(object).where(values.notna(), "")
+        columns[name] = values
+
+    return pandas.DataFrame(columns, columns=table.column_names)
+
+
+class _ResultCache:
+    """ A local cache of query results stored as parquet files named by the query hash
+    (see _query_hash), with an index.json recording when each entry was created and
+    last used and its size. Entries expire after ttl seconds unless their date range
+    is closed, and the least recently used entries are evicted once the cache grows
+    past max_bytes.
+
+    Args:
+        directory (str): the cache directory, created if it does not exist
+        ttl (int): the seconds before entries for open date ranges expire, None to never expire
+        max_bytes (int): the largest total size of the cache files, None for no limit
+    """
+    def __init__(self, directory:str, ttl:int =None, max_bytes:int =None):
+        self.directory = os.path.expanduser(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(self.directory, "index.json")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.directory, f"{key}.parquet")
+
+    def _load_index(self) -> dict:
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    def _expired(self, entry:dict, now:float) -> bool:
+        return not entry["immutable"] and self.ttl != None and now - entry["created"] > self.ttl
+
+    def get(self, key:str) -> pa.Table:
+        """ Return the cached table for a query hash, None on a miss.
+        """
+        with _CACHE_LOCK:
+            index = self._load_index()
+            entry = index.get(key)
+            now = time.time()
+            if entry == None or not os.path.exists(self._path(key)) or self._expired(entry, now):
+                return None
+            entry["last_used"] = now
+            _write_json_atomic(self.index_file, index)
+
+        return pq.read_table(self._path(key))
+
+    def put(self, key:str, frames:list, fields:list, immutable:bool =False) -> None:
+        """ Cache the pages of a query result, or a typed result as one arrow table, then
+        evict expired and least recently used entries. The pages are unified into one
+        table (e.g. integers on one page and floats on another become floats), a result
+        whose pages do not unify or convert to parquet is not cached.
+        """
+        if not frames:
+            return
+
+        temp_path = f"{self._path(key)}.tmp"
+        try:
+            if isinstance(frames, pa.Table):  # Typed results keep their schema
+                table = frames
+            else:
+                tables = [_rows_to_table(frame.to_dict("records"), fields) for frame in frames]
+                schema = pa.unify_schemas([table.schema for table in tables], promote_options="permissive")
+                table = pa.concat_tables([_conform_table(table, schema) for table in tables])
+            pq.write_table(table, temp_path)
+        except Exception as e:
+            logger.warning(f"Could not cache the query result: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with _CACHE_LOCK:
+            os.replace(temp_path, self._path(key))
+            index = self._load_index()
+            now = time.time()
+            index[key] = {"created": now, "last_used": now, "bytes": os.path.getsize(self._path(key)), "immutable": immutable}
+            self._evict(index, now, keep=key)
+            _write_json_atomic(self.index_file, index)
+
+    def _evict(self, index:dict, now:float, keep:str) -> None:
+        """ Remove expired entries, then the least recently used until the cache fits.
+        """
+        for key in [key for key, entry in index.items() if self._expired(entry, now) and key != keep]:
+            self._remove(index, key)
+
+        if self.max_bytes == None:
+            return
+
+        for key in sorted(index, key=lambda key: index[key]["last_used"]):
+            if sum(entry["bytes"] for entry in index.values()) <= self.max_bytes:
+                break
+            elif key != keep:
+                self._remove(index, key)
+
+    def _remove(self, index:dict, key:str) -> None:
+        index.pop(key)
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+
+def _query_to_csv_checkpointed(es:Elasticsearch, index:str, body:dict, return_fields:list, paging_id_field:str, paging_time_field:str, out_file:str, checkpoint_every:int, resume:bool =False, controller:_PageController =None) -> int:
+    """ Stream the results to a csv file, saving a checkpoint next to it every few
+    pages with the paging cursor, the rows written and the size of the file at that
+    point. A resumed run cuts the file back to the saved size and pages on from the
+    saved cursor, so no rows are duplicated or lost. Pages are written on a background
+    thread, which is drained before each checkpoint. The checkpoint is removed once
+    the download completes.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): to search into
+        body (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        out_file (str): the path to the output csv file including filename
+        checkpoint_every (int): the number of pages between checkpoints
+        resume (bool): resume from the checkpoint of an earlier run
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+
+    Returns:
+        int: the total number of documents in the file
+    """
+    checkpoint_file = f"{out_file}.checkpoint"
+    query_hash = _query_hash(index, body, return_fields, paging_id_field, paging_time_field)
+    checkpoint = {"query_hash": query_hash, "search_after": [], "rows": 0, "offset": None, "pages": 0}
+
+    if resume:
+        checkpoint = _load_checkpoint(checkpoint_file, query_hash)
+        logger.info(f"Resuming after {checkpoint['rows']} documents")
+
+    controller = controller if controller != None else _PageController()
+    cursor = list(checkpoint["search_after"])
+    current_count = checkpoint["rows"]
+    writer = _CsvPageWriter(out_file, return_fields, checkpoint["offset"])
+    background = _BackgroundPageWriter(writer, controller.metrics)
+
+    try:
+        pages = _iter_pages(es, index, body, return_fields, paging_id_field, paging_time_field, 1, cursor, current_count, controller)
+        for page_num, (slice_num, rows) in enumerate(pages, start=checkpoint["pages"] + 1):
+            background.write(rows)  # Written and timed on the writer's own thread
+            current_count += len(rows)
+            if page_num % checkpoint_every == 0:
+                background.flush()  # The saved offset has to include every row counted
+                checkpoint.update(search_after=list(cursor), rows=current_count, offset=writer.tell(), pages=page_num)
+                _write_json_atomic(checkpoint_file, checkpoint)
+    finally:
+        background.close()
+
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    return current_count
+
+
+def _query_to_file_large(es:Elasticsearch, index:str, json:dict, return_fields:list, paging_id_field:str, paging_time_field:str, out_file:str, workers:int =1, split_output:bool =False, schema:pa.Schema =None, row_group_size:int =None, compression:str ="snappy", checkpoint_every:int =None, resume:bool =False, state_file:str =None, partition_by:str =None, max_rows_per_file:int =None, controller:_PageController =None, fan_out:bool =False) -> None:
+    """ This is the internal function for handling the connection to elasticsearch and
+    the subsequent API calls with the data provided from the Query object. It then streams
+    the results to a csv, json lines, parquet or feather file, picked from the extension of out_file.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): to search into
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on or None
+        paging_time_field (str): the date/time field to sort on or None
+        out_file (str): the path to the output file including filename
+        workers (int): the number of slices to download in parallel, 1 pages
+            through the query in a single sequential loop
+        split_output (bool): when downloading in parallel write each slice (or index) to
+            its own part file instead of merging all slices into out_file
+        schema (pyarrow.Schema): the declared parquet types of some or all fields, the rest are inferred
+        row_group_size (int): the rows in each parquet row group, one per page if None
+        compression (str): the parquet compression codec
+        checkpoint_every (int): save a resumable checkpoint every this many pages,
+            only for csv output from one worker with both paging fields, None to disable
+        resume (bool): resume from the checkpoint of an earlier run
+        state_file (str): download incrementally, only fetching documents after the
+            watermark saved in this json state store by the last run of the same query
+            and writing them to a new timestamped partition file next to out_file
+        partition_by (str): write a partitioned dataset to the directory named after out_file
+            (without its extension), partitioned by field:day, field:month or the values of a field
+        max_rows_per_file (int): write a dataset whose part files hold at most this many rows,
+            on its own or within each partition
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+        fan_out (bool): download every index behind the index pattern on its own, workers
+            indices at a time, instead of slicing the query
+    """
+    partitioned = partition_by != None or max_rows_per_file != None
+    if partitioned and (resume or state_file != None):
+        raise Exception("Error: partitioned datasets can not be resumed or downloaded incrementally.")
+
+    can_checkpoint = not partitioned and state_file == None and workers == 1 and not fan_out and paging_id_field != None and paging_time_field != None and os.path.splitext(out_file)[1] == ".csv"
+    if resume and not can_checkpoint:
+        raise Exception("Error: resuming needs a csv output, one worker without fan out and both paging fields.")
+    elif checkpoint_every and not can_checkpoint and state_file == None:
+        logger.info("Checkpoints need an unpartitioned csv output, one worker without fan out and both paging fields, continuing without them")
+
+    controller = controller if controller != None else _PageController()
+    current_count = 0
+    writers = {}
+
+    if partitioned:
+        dataset, extension = _split_extension(out_file)
+        if _split_extension(out_file)[1] not in _OUTPUT_EXTENSIONS:
+            raise Exception("Invalid output format please use either '.csv', '.jsonl', '.parquet', '.feather' or '.arrow', csv and jsonl can add '.gz' or '.zst'")
+        if partition_by != None and _parse_partition_by(partition_by)[0] not in return_fields:
+            return_fields = return_fields + [_parse_partition_by(partition_by)[0]]
+        paging_fields = [field for field in (paging_time_field, paging_id_field) if field != None]
+        dataset_writer = _PartitionedWriter(dataset, extension, return_fields, partition_by, max_rows_per_file, paging_fields, schema, row_group_size, compression)
+        writers[0] = _BackgroundPageWriter(dataset_writer, controller.metrics)
+
+    if state_file != None:
+        if workers > 1 or fan_out or paging_id_field == None or paging_time_field == None:
+            raise Exception("Error: incremental downloads need one worker without fan out and both paging fields.")
+        query_hash = _query_hash(index, json, return_fields, paging_id_field, paging_time_field)
+        watermark = _load_watermark(state_file, query_hash)
+        cursor = list(watermark.get("search_after", []))
+        if cursor:
+            logger.info(f"Downloading documents after watermark {cursor}")
+        out_file = _delta_file_name(out_file)
+        pages = _iter_pages(es, index, json, return_fields, paging_id_field, paging_time_field, 1, cursor, controller=controller)
+    elif (checkpoint_every or resume) and can_checkpoint:
+        current_count = _query_to_csv_checkpointed(es, index, json, return_fields, paging_id_field, paging_time_field, out_file, checkpoint_every or 10, resume, controller)
+        pages = []
+    else:
+        indices = _resolve_indices(es, index, controller) if fan_out else None
+        pages = _iter_pages(es, index, json, return_fields, paging_id_field, paging_time_field, workers, controller=controller, indices=indices)
+
+    split = split_output and (workers > 1 or fan_out)
+    try:
+        for slice_num, rows in pages:
+            if partitioned or not split:
+                slice_num = 0  # Every slice is merged into the one output file or dataset
+            if slice_num not in writers:
+                if split:
+                    path = _index_file_name(out_file, indices[slice_num]) if fan_out else _slice_file_name(out_file, slice_num)
+                else:
+                    path = out_file
+                writers[slice_num] = _BackgroundPageWriter(_open_page_writer(path, return_fields, schema, row_group_size, compression), controller.metrics)
+            writers[slice_num].write(rows)  # Written and timed on the writer's own thread
+            current_count += len(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    if partitioned:
+        dataset_writer.write_manifest()
+        partitions = len(set(file["path"].split(os.sep)[0] for file in dataset_writer.files)) if partition_by != None else 1
+        out_file = f"{dataset} ({len(dataset_writer.files)} files in {partitions} partitions)"
+    elif split:
+        out_file = f"{len(writers)} part files"
+
+    files = [out_file]
+    if not partitioned and not split and 0 in writers:  # Arrow files whose types changed carry on in part files
+        files = getattr(writers[0].writer, "files", files)
+        out_file = ", ".join(files)
+
+    if state_file != None and current_count > 0:  # Only move the watermark once the partition is complete
+        _save_watermark(state_file, query_hash, {"index": index, "search_after": cursor,
+                                                 "rows": watermark.get("rows", 0) + current_count,
+                                                 "files": watermark.get("files", []) + files,
+                                                 "updated": datetime.datetime.now(datetime.timezone.utc).isoformat()})
+
+    if current_count > 0:
+        logger.info(f"Saved data to {out_file}")
+    else:
+        logger.info("No results nothing saved")
+
+    logger.info("Done")
+
+
+def _iter_query(es:Elasticsearch, json:dict, return_fields:list, index:str =None, paging_id_field:str =None, paging_time_field:str =None, workers:int =1, controller:_PageController =None, fan_out:bool =False):
+    """ This is the internal generator for handling the connection to elasticsearch and
+    the subsequent API calls with the data provided from the Query object. It yields the
+    results one page of cleaned JSON objects at a time.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        index (str): to search into
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        workers (int): the number of slices to download in parallel
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+        fan_out (bool): download every index behind the index pattern on its own, workers
+            indices at a time, instead of slicing the query
+
+    Yields:
+        int: the slice (or index) the page belongs to, always 0 when not downloading in parallel
+        list: a page of cleaned json documents
+    """
+    return_fields, index, paging_id_field, paging_time_field = _resolve_query_target(return_fields, index, paging_id_field, paging_time_field)
+    indices = _resolve_indices(es, index, controller) if fan_out else None
+
+    yield from _iter_pages(es, index, json, return_fields, paging_id_field, paging_time_field, workers, controller=controller, indices=indices)
+
+    logger.info("Done")
+
+
+def _query_to_json(es:Elasticsearch, json:dict, return_fields:list, index:str =None, paging_id_field:str =None, paging_time_field:str =None, workers:int =1, controller:_PageController =None, fan_out:bool =False) -> list:
+    """ This is the internal function that collects every page from _iter_query and
+    returns the results in a list of JSON objects. Pages from parallel slices (or
+    indices) are joined in slice order so time slices keep the sort order.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        index (str): to search into
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        workers (int): the number of slices to download in parallel
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+        fan_out (bool): download every index behind the index pattern on its own, workers
+            indices at a time, instead of slicing the query
+
+    Returns:
+        list: a list of cleaned json documents returned by the query
+    """
+    slices = {}
+    for slice_num, rows in _iter_query(es, json, return_fields, index, paging_id_field, paging_time_field, workers, controller, fan_out):
+        slices.setdefault(slice_num, []).extend(rows)
+
+    rows = []
+    for slice_num in sorted(slices):
+        rows += slices.pop(slice_num)
+
+    return rows
+
+
+def _composite_sources(group_by:list) -> list:
+    """ Build the sources of a composite aggregation from group by specs. A plain field
+    groups by its terms (use the keyword version of text fields) and 'field:interval'
+    groups dates into buckets, e.g. 'created_at:1d' or 'created_at:30m'. Documents
+    missing a field are grouped into a bucket with an empty key.
+
+    Args:
+        group_by (list): the fields to group by
+
+    Returns:
+        list: the composite aggregation sources
+    """
+    sources = []
+    for spec in group_by:
+        field, interval_given, interval = spec.partition(":")
+        if not interval_given:
+            source = {"terms": {"field": field, "missing_bucket": True}}
+        else:
+            kind = "calendar_interval" if interval in _CALENDAR_INTERVALS else "fixed_interval"
+            source = {"date_histogram": {"field": field, kind: interval, "format": "strict_date_optional_time", "missing_bucket": True}}
+        sources.append({field: source})
+
+    return sources
+
+
+def _metric_aggregations(metrics:list) -> dict:
+    """ Build the metric aggregations of every bucket from 'aggregation:field' specs,
+    e.g. 'sum:retweet_count' becomes the column sum_retweet_count.
+
+    Args:
+        metrics (list): the metrics to compute per bucket
+
+    Returns:
+        dict: the sub aggregations of the composite aggregation
+    """
+    aggregations = {}
+    for spec in metrics:
+        kind, field_given, field = spec.partition(":")
+        if not field_given or kind not in _METRIC_AGGREGATIONS:
+            raise Exception(f"Error: invalid metric '{spec}', please use 'aggregation:field' with one of {', '.join(_METRIC_AGGREGATIONS)}.")
+        aggregations[f"{kind}_{field}"] = {kind: {"field": field}}
+
+    return aggregations
+
+
+def _bucket_columns(group_by:list, metrics:list) -> list:
+    """ The columns of the rows built from composite aggregation buckets.
+
+    Args:
+        group_by (list): the fields to group by
+        metrics (list): the metrics computed per bucket
+
+    Returns:
+        list: the group fields, doc_count and the metric columns
+    """
+    return [spec.partition(":")[0] for spec in group_by] + ["doc_count"] + list(_metric_aggregations(metrics))
+
+
+def _page_buckets(es:Elasticsearch, index:str, json:dict, group_by:list, metrics:list, page_size:int =_COMPOSITE_PAGE_SIZE, controller:_PageController =None):
+    """ Generator that pages through every bucket of a composite aggregation over the
+    documents matching the query using after_key, yielding one page of rows at a time.
+    Failed requests are retried with backoff like document pages.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): to search into
+        json (dict): the json body of the query, it is not modified
+        group_by (list): the fields to group by, see _composite_sources
+        metrics (list): the metrics to compute per bucket, see _metric_aggregations
+        page_size (int): the buckets in each page
+        controller (_PageController): retries the requests and carries the metrics,
+            a new one if None
+
+    Yields:
+        list: a page of rows, one per bucket
+    """
+    controller = controller if controller != None else _PageController()
+    aggregations = _metric_aggregations(metrics)
+    composite = {"size": page_size, "sources": _composite_sources(group_by)}
+    body = {"query": json["query"], "size": 0, "aggs": {"groups": {"composite": composite, "aggs": aggregations}}}
+    current_count = 0
+    controller.metrics.started()
+
+    def search() -> (dict, float):
+        start = time.perf_counter()
+        return es.search(index=index, body=body), time.perf_counter() - start
+
+    while True:
+        response, seconds = _with_retries(search, controller, "Bucket request")
+        controller.metrics.request(seconds, None, None)
+
+        groups = response["aggregations"]["groups"]
+        buckets = groups["buckets"]
+        if not buckets:
+            break
+
+        rows = []
+        for bucket in buckets:
+            row = {field: "" if key == None else key for field, key in bucket["key"].items()}
+            row["doc_count"] = bucket["doc_count"]
+            for name in aggregations:
+                row[name] = bucket[name]["value"]
+            rows.append(row)
+
+        current_count += len(rows)
+        logger.info(f"Downloading buckets: [{current_count}]")
+        controller.metrics.page(0, len(rows), current_count, None, page_size)
+        yield rows
+
+        if "after_key" not in groups:
+            break
+        composite["after"] = groups["after_key"]
+
+    controller.metrics.done(current_count, None, page_size)
+
+
+def _aggregate_to_file(es:Elasticsearch, index:str, json:dict, group_by:list, metrics:list, out_file:str, page_size:int =_COMPOSITE_PAGE_SIZE, schema:pa.Schema =None, compression:str ="snappy", controller:_PageController =None) -> None:
+    """ Stream every bucket of a composite aggregation to a csv, json lines, parquet or feather file, picked
+    from the extension of out_file.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        index (str): to search into
+        json (dict): the json body of the query
+        group_by (list): the fields to group by, see _composite_sources
+        metrics (list): the metrics to compute per bucket, see _metric_aggregations
+        out_file (str): the path to the output file including filename
+        page_size (int): the buckets in each page
+        schema (pyarrow.Schema): the declared parquet types of some or all fields, the rest are inferred
+        compression (str): the parquet compression codec
+        controller (_PageController): retries the requests and carries the metrics,
+            a new one if None
+    """
+    controller = controller if controller != None else _PageController()
+    writer = _open_page_writer(out_file, _bucket_columns(group_by, metrics), schema, None, compression)
+    current_count = 0
+
+    try:
+        for rows in _page_buckets(es, index, json, group_by, metrics, page_size, controller):
+            with controller.metrics.timed("write"):
+                writer.write(rows)
+            current_count += len(rows)
+    finally:
+        writer.close()
+
+    if current_count > 0:
+        logger.info(f"Saved {current_count} buckets to {out_file}")
+    else:
+        logger.info("No results nothing saved")
+
+    logger.info("Done")
+
+
+def iter_query_batches(index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, workers:int =1, batch_size:int =None, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", fan_out:bool =False, client:Elasticsearch =None):
+    """ This is the function that takes in query parameters and yields batches of json objects
+    from elasticsearch documents as they are downloaded, so results can be processed with
+    bounded memory. With workers above 1 batches arrive in no particular order.
+
+    Args:
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        workers (int): the number of slices to download in parallel
+        batch_size (int): the number of documents in each batch, by default every
+            downloaded page is yielded as it arrives
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        fan_out (bool): download every index behind the index pattern on its own, with its
+            own point in time and cursor, workers indices at a time instead of slicing
+            the query
+        client (Elasticsearch): the client to use, the shared client from get_client() if None
+
+    Yields:
+        list: a batch of cleaned json documents returned by the query
+    """
+    es = client if client != None else get_client(pool_size=max(10, workers))
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    if fields_api:
+        json = _use_fields_api(json)
+    pages = _iter_query(es, json, return_fields, index, paging_id_field, paging_time_field, workers, _PageController(min_page_size, max_page_size, metrics=_Metrics(on_metrics, metrics_file, count)), fan_out=fan_out)
+
+    if batch_size == None:
+        for slice_num, rows in pages:
+            yield rows
+        return
+
+    batch = []
+    for slice_num, rows in pages:
+        batch += rows
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+
+    if batch:
+        yield batch
+
+
+def iter_query(index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, workers:int =1, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", fan_out:bool =False, client:Elasticsearch =None):
+    """ This is the function that takes in query parameters and yields json objects from
+    elasticsearch documents one at a time as they are downloaded. See iter_query_batches.
+
+    Args:
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        workers (int): the number of slices to download in parallel
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        fan_out (bool): download every index behind the index pattern on its own, with its
+            own point in time and cursor, workers indices at a time instead of slicing
+            the query
+        client (Elasticsearch): the client to use, the shared client from get_client() if None
+
+    Yields:
+        dict: a cleaned json document returned by the query
+    """
+    for batch in iter_query_batches(index, paging_id_field, paging_time_field, return_fields, fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all, workers, fields_api=fields_api, min_page_size=min_page_size, max_page_size=max_page_size, on_metrics=on_metrics, metrics_file=metrics_file, count=count, fan_out=fan_out, client=client):
+        yield from batch
+
+
+def query_to_json(index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, workers:int =1, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", fan_out:bool =False, client:Elasticsearch =None) -> list:
+    """ This is the function that takes in query parameters and returns a list of json objects from
+    elasticsearch documents. This function creates a query object and calls an internal function that handles
+    the actual communication with elasticsearch.
+
+    Args:
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        workers (int): the number of slices to download in parallel
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        fan_out (bool): download every index behind the index pattern on its own, with its
+            own point in time and cursor, workers indices at a time instead of slicing
+            the query
+        client (Elasticsearch): the client to use, the shared client from get_client() if None
+
+    Returns:
+        list: a list of cleaned json documents returned by the query
+    """
+    es = client if client != None else get_client(pool_size=max(10, workers))
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    if fields_api:
+        json = _use_fields_api(json)
+    response_list = _query_to_json(es, json, return_fields, index, paging_id_field, paging_time_field, workers, _PageController(min_page_size, max_page_size, metrics=_Metrics(on_metrics, metrics_file, count)), fan_out=fan_out)
+    response_json = {"data":response_list}
+
+    return response_json
+
+
+def query_to_dataframe(index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, workers:int =1, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", schema:pa.Schema =None, cache_dir:str =None, cache_ttl:int =86400, cache_max_bytes:int =10 * 2**30, fan_out:bool =False, client:Elasticsearch =None) -> pandas.DataFrame:
+    """ This is the function that takes in query parameters and returns a pandas datafram from
+    elasticsearch documents. This function creates a query object and calls an internal function that handles
+    the actual communication with elasticsearch. Each page is converted to a DataFrame as it
+    arrives so the raw documents are never all held in memory at once.
+
+    Without a schema missing fields are empty strings and columns are python objects
+    as in earlier versions. With a schema every page is converted straight to typed
+    arrow columns, missing fields are nulls and the DataFrame is backed by arrow.
+
+    Args:
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        workers (int): the number of slices to download in parallel
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        schema (pyarrow.Schema): the types of the columns, 'mapping' to take them from the
+            index mapping, None for an untyped DataFrame. Fields missing from the
+            schema have their type inferred
+        cache_dir (str): cache results as parquet in this directory and load repeated
+            queries from it instead of elasticsearch, None to not cache
+        cache_ttl (int): seconds before cached results expire, results for date ranges
+            that ended before today never expire, None to never expire
+        cache_max_bytes (int): the size the cache is kept under by evicting the least
+            recently used results, None for no limit
+        fan_out (bool): download every index behind the index pattern on its own, with its
+            own point in time and cursor, workers indices at a time instead of slicing
+            the query
+        client (Elasticsearch): the client to use, the shared client from get_client() if None
+
+    Returns:
+        pandas.DataFrame: a DataFrame where the json fields are columns
+    """
+    es = client if client != None else get_client(pool_size=max(10, workers))
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    if fields_api:
+        json = _use_fields_api(json)
+
+    if schema != None or cache_dir != None:
+        return_fields, index, paging_id_field, paging_time_field = _resolve_query_target(return_fields, index, paging_id_field, paging_time_field)
+    schema = _resolve_schema(es, schema, index, return_fields, fields_api)
+
+    cache = None
+    if cache_dir != None:
+        cache = _ResultCache(cache_dir, cache_ttl, cache_max_bytes)
+        cache_key = _query_hash(index, json, return_fields, paging_id_field, paging_time_field, schema)
+        table = cache.get(cache_key)
+        if table != None:
+            logger.info(f"Loaded {table.num_rows} documents from the cache in {cache_dir}")
+            return _table_to_dataframe(table) if schema == None else table.to_pandas(types_mapper=pandas.ArrowDtype)
+
+    slices = {}
+    for slice_num, rows in _iter_query(es, json, return_fields, index, paging_id_field, paging_time_field, workers, _PageController(min_page_size, max_page_size, metrics=_Metrics(on_metrics, metrics_file, count)), fan_out=fan_out):
+        if schema == None:
+            slices.setdefault(slice_num, []).append(pandas.DataFrame(rows, columns=list(rows[0].keys())))
+        else:
+            page = {field: _schema_array([row[field] for row in rows], schema.field(field).type if field in schema.names else None) for field in rows[0]}
+            slices.setdefault(slice_num, []).append(page)
+
+    frames = [frame for slice_num in sorted(slices) for frame in slices[slice_num]]
+    if schema != None:
+        table = _pages_to_table(frames, schema) if frames else None
+        if cache != None and table != None:
+            cache.put(cache_key, table, return_fields, _is_closed_range(end_date))
+        return table.to_pandas(types_mapper=pandas.ArrowDtype) if table != None else pandas.DataFrame()
+
+    if cache != None:
+        cache.put(cache_key, frames, return_fields, _is_closed_range(end_date))
+
+    df = pandas.DataFrame()
+    if len(frames) > 0:
+        df = pandas.concat(frames, ignore_index=True)
+    return df
+
+
+def query_to_file(path:str, index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, workers:int =1, split_output:bool =False, schema:pa.Schema =None, row_group_size:int =None, compression:str ="snappy", checkpoint_every:int =None, resume:bool =False, state_file:str =None, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", partition_by:str =None, max_rows_per_file:int =None, fan_out:bool =False, client:Elasticsearch =None) -> None:
+    """ This is the function that takes in query parameters and streams the elasticsearch
+    documents straight to a csv, json lines, parquet or feather file, one page at a time, without building
+    a DataFrame first.
+
+    Args:
+        path (str): the path including filename for the output, ending in .csv, .jsonl,
+            .parquet, .feather or .arrow
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        workers (int): the number of slices to download in parallel
+        split_output (bool): when downloading in parallel write each slice to its
+            own part file
+        schema (pyarrow.Schema): the declared parquet types of some or all fields, the rest are inferred,
+            or 'mapping' to take them from the index mapping
+        row_group_size (int): the rows in each parquet row group, one per page if None
+        compression (str): the parquet compression codec
+        checkpoint_every (int): save a resumable checkpoint next to the file every this
+            many pages, only for csv output from one worker with both paging fields
+        resume (bool): resume from the checkpoint of an earlier interrupted run
+        state_file (str): download incrementally, only fetching documents newer than
+            the last run of the same query recorded in this json state store and writing
+            them to a new timestamped partition file, needs both paging fields
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        partition_by (str): write a hive-style partitioned dataset to the directory named
+            after path (without its extension) instead of one file, partitioned by
+            field:day, field:month or the values of a field, with a _SUCCESS manifest
+        max_rows_per_file (int): the most rows in each part file of a dataset, on its own
+            this splits the output into a dataset of part files without partitions
+        fan_out (bool): download every index behind the index pattern on its own, with its
+            own point in time and cursor, workers indices at a time instead of slicing
+            the query
+        client (Elasticsearch): the client to use, the shared client from get_client() if None
+    """
+    es = client if client != None else get_client(pool_size=max(10, workers))
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    if fields_api:
+        json = _use_fields_api(json)
+
+    return_fields, index, paging_id_field, paging_time_field = _resolve_query_target(return_fields, index, paging_id_field, paging_time_field)
+    schema = _resolve_schema(es, schema, index, return_fields, fields_api)
+
+    _query_to_file_large(es, index, json, return_fields, paging_id_field, paging_time_field, path, workers, split_output, schema, row_group_size, compression, checkpoint_every, resume, state_file, partition_by, max_rows_per_file, _PageController(min_page_size, max_page_size, metrics=_Metrics(on_metrics, metrics_file, count)), fan_out=fan_out)
+
+
+def iter_aggregate_batches(group_by:list, metrics:list =[], index:str =None, fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, page_size:int =_COMPOSITE_PAGE_SIZE, on_metrics =None, metrics_file:str =None, client:Elasticsearch =None):
+    """ This is the function that takes in query parameters and aggregates the matching
+    documents in elasticsearch instead of downloading them, yielding one page of buckets
+    at a time. Every row holds the group by keys, the doc_count and the metrics.
+
+    Args:
+        group_by (list): the fields to group by, a plain field groups by its terms and
+            'field:interval' groups a date field into buckets, e.g. 'created_at:1d'
+        metrics (list): the metrics to compute per bucket as 'aggregation:field', e.g.
+            'sum:retweet_count', with sum, avg, min, max, value_count or cardinality
+        index (str): the elasticsearch index you want to query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        page_size (int): the buckets in each page
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the aggregation is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        client (Elasticsearch): the client to use, the shared client from get_client() if None
+
+    Yields:
+        list: a page of rows, one per bucket
+    """
+    es = client if client != None else get_client()
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    index = _resolve_query_target([], index)[1]
+
+    yield from _page_buckets(es, index, json, group_by, metrics, page_size, _PageController(metrics=_Metrics(on_metrics, metrics_file)))
+
+
+def aggregate_to_dataframe(group_by:list, metrics:list =[], index:str =None, fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, page_size:int =_COMPOSITE_PAGE_SIZE, on_metrics =None, metrics_file:str =None, client:Elasticsearch =None) -> pandas.DataFrame:
+    """ Takes the same parameters as iter_aggregate_batches and returns every bucket in
+    a pandas DataFrame.
+
+    Returns:
+        pandas.DataFrame: a DataFrame with a column per group by field, doc_count and
+            a column per metric
+    """
+    rows = []
+    for batch in iter_aggregate_batches(group_by, metrics, index, fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all, page_size, on_metrics, metrics_file, client):
+        rows += batch
+
+    return pandas.DataFrame(rows, columns=_bucket_columns(group_by, metrics))
+
+
+def aggregate_to_file(path:str, group_by:list, metrics:list =[], index:str =None, fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, page_size:int =_COMPOSITE_PAGE_SIZE, schema:pa.Schema =None, compression:str ="snappy", on_metrics =None, metrics_file:str =None, client:Elasticsearch =None) -> None:
+    """ Takes the same parameters as iter_aggregate_batches and streams every bucket to
+    a .csv, .jsonl, .parquet, .feather or .arrow file one page at a time.
+
+    Args:
+        path (str): the path to the output file including filename
+        schema (pyarrow.Schema): the declared parquet types of some or all fields, the rest are inferred
+        compression (str): the parquet compression codec
+    """
+    es = client if client != None else get_client()
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    index = _resolve_query_target([], index)[1]
+
+    _aggregate_to_file(es, index, json, group_by, metrics, path, page_size, schema, compression, _PageController(metrics=_Metrics(on_metrics, metrics_file)))
+
+
+def _timed_call(metrics:_Metrics, stage:str, function, *args):
+    """ Call function and add the time it took to a stage, for work run in an executor.
+
+    Args:
+        metrics (_Metrics): the metrics of the download
+        stage (str): the stage to add the time to
+        function: the function to call with args
+
+    Returns:
+        the result of the function
+    """
+    with metrics.timed(stage):
+        return function(*args)
+
+
+@asynccontextmanager
+async def _apoint_in_time(es:AsyncElasticsearch, index:str, controller:_PageController =None):
+    """ Async version of _point_in_time.
+
+    Args:
+        es (AsyncElasticsearch): the open async elasticsearch connection
+        index (str): the index to open the point in time on
+        controller (_PageController): retries the requests, a new one if None
+
+    Yields:
+        str: the point in time id
+    """
+    pit_id = (await _awith_retries(lambda: es.open_point_in_time(index=index, keep_alive=_PIT_KEEP_ALIVE), controller, "Opening a point in time"))["id"]
+    try:
+        yield pit_id
+    finally:
+        try:
+            await _awith_retries(lambda: es.close_point_in_time(body={"id": pit_id}), controller, "Closing the point in time")
+        except Exception as e:  # The point in time expires on its own, never hide the original error
+            logger.warning(f"Failed to close point in time: {e}")
+
+
+async def _afetch_pages(es:AsyncElasticsearch, body:dict, return_fields:list, pages:asyncio.Queue, controller:_PageController) -> None:
+    """ The fetch stage of the async pipeline. Requests every page and puts the raw
+    hits on the queue, which blocks once the consumer falls prefetch pages behind.
+    None is put on the queue when there are no more pages, and any error is put on
+    the queue so the consumer raises it.
+
+    Args:
+        es (AsyncElasticsearch): the open async elasticsearch connection
+        body (dict): the json body for the first page, see _page_body
+        return_fields (list): the fields to return from the query
+        pages (asyncio.Queue): the bounded queue to the clean stage
+        controller (_PageController): sizes and retries the page requests
+    """
+    try:
+        while True:
+            response = await _asearch_page(es, body, return_fields, controller)
+            _record_total(body, response, controller.metrics)
+            res_docs = response.get("hits", {}).get("hits", [])
+
+            if not res_docs:  # If no new responses returned leave loop
+                break
+
+            _next_page(body, res_docs, response)
+            await pages.put(res_docs)
+        await pages.put(None)
+    except Exception as e:
+        await pages.put(e)
+
+
+async def _aiter_pages(es:AsyncElasticsearch, index:str, json:dict, return_fields:list, paging_id_field:str =None, paging_time_field:str =None, prefetch:int =2, controller:_PageController =None):
+    """ Async generator that opens a point in time and yields every page of cleaned
+    documents, counting the documents matching the query as set by the metrics' count.
+    The next pages are fetched while the current one is cleaned (in the default
+    executor) and processed by the consumer.
+
+    Args:
+        es (AsyncElasticsearch): the open async elasticsearch connection
+        index (str): to search into
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        prefetch (int): the number of pages fetched ahead of the page being processed
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+
+    Yields:
+        list: a page of cleaned json documents
+    """
+    controller = controller if controller != None else _PageController()
+    metrics = controller.metrics
+    if metrics.count == "exact":
+        logger.info("Counting documents in query")
+        response = await _awith_retries(lambda: es.count(index=index, body={"query": json["query"]}), controller, "Counting the documents")  # Send a count query to check the total hits of the search
+        metrics.found("query", response['count'])
+        logger.info(f"Found {response['count']} documents matching query")
+
+    logger.info("Beginning download")
+
+    loop = asyncio.get_running_loop()
+    current_count = 0
+    metrics.started()
+
+    async with _apoint_in_time(es, index, controller) as pit_id:
+        pages = asyncio.Queue(maxsize=prefetch)
+        body = _page_body(json, pit_id, paging_id_field, paging_time_field, return_fields)
+        body["track_total_hits"] = metrics.count == "hits"
+        fetcher = asyncio.ensure_future(_afetch_pages(es, copy.deepcopy(body), return_fields, pages, controller))
+
+        try:
+            while True:
+                res_docs = await pages.get()
+                if res_docs == None:
+                    break
+                elif isinstance(res_docs, Exception):
+                    raise res_docs
+
+                rows = await loop.run_in_executor(None, _timed_call, controller.metrics, "clean", _clean_page, res_docs, body, return_fields)
+                current_count += len(rows)
+                logger.info(f"Downloading: {metrics.progress(current_count)}")
+                metrics.page(0, len(rows), current_count, metrics.expected()[0], controller.size)
+                yield rows
+        finally:
+            fetcher.cancel()  # Stop fetching before the point in time is closed
+            await asyncio.gather(fetcher, return_exceptions=True)
+
+    metrics.done(current_count, metrics.expected()[0], controller.size)
+
+
+async def _aiter_query(es:AsyncElasticsearch, json:dict, return_fields:list, index:str =None, paging_id_field:str =None, paging_time_field:str =None, prefetch:int =2, controller:_PageController =None):
+    """ Async version of _iter_query, handles the async connection to elasticsearch
+    and yields the results one page of cleaned JSON objects at a time.
+
+    Args:
+        es (AsyncElasticsearch): the open async elasticsearch connection, a new one is
+            opened and closed again if None
+        json (dict): the json body of the query
+        return_fields (list): the fields to return from the query
+        index (str): to search into
+        paging_id_field (str): the id field to sort on
+        paging_time_field (str): the date/time field to sort on
+        prefetch (int): the number of pages fetched ahead of the page being processed
+        controller (_PageController): sizes and retries the page requests, a new one with the
+            default bounds if None
+
+    Yields:
+        list: a page of cleaned json documents
+    """
+    return_fields, index, paging_id_field, paging_time_field = _resolve_query_target(return_fields, index, paging_id_field, paging_time_field)
+
+    own_client = es == None
+    if own_client:
+        logger.info("Connecting to elasticsearch")
+        es = _get_async_client()
+
+    pages = _aiter_pages(es, index, json, return_fields, paging_id_field, paging_time_field, prefetch, controller)
+    try:
+        async for rows in pages:
+            yield rows
+    finally:
+        await pages.aclose()  # Close the point in time when the consumer stops early, before the client
+        if own_client:
+            await es.close()
+
+    logger.info("Done")
+
+
+async def aiter_query_batches(index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, prefetch:int =2, batch_size:int =None, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", client:AsyncElasticsearch =None):
+    """ This is the async version of iter_query_batches. It yields batches of json objects
+    while the following pages are already being fetched, with at most prefetch pages
+    waiting in memory.
+
+    Args:
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        prefetch (int): the number of pages fetched ahead of the page being processed
+        batch_size (int): the number of documents in each batch, by default every
+            downloaded page is yielded as it arrives
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        client (AsyncElasticsearch): the async client to use, a new one is opened and closed
+            again if None
+
+    Yields:
+        list: a batch of cleaned json documents returned by the query
+    """
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    if fields_api:
+        json = _use_fields_api(json)
+    pages = _aiter_query(client, json, return_fields, index, paging_id_field, paging_time_field, prefetch, _PageController(min_page_size, max_page_size, metrics=_Metrics(on_metrics, metrics_file, count)))
+    try:
+        if batch_size == None:
+            async for rows in pages:
+                yield rows
+            return
+
+        batch = []
+        async for rows in pages:
+            batch += rows
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+
+        if batch:
+            yield batch
+    finally:
+        await pages.aclose()  # Async generators are not closed by a break in the consumer
+
+
+async def aiter_query(index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, prefetch:int =2, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", client:AsyncElasticsearch =None):
+    """ This is the async version of iter_query, it yields json objects from elasticsearch
+    documents one at a time as they are downloaded.
+
+    Args:
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        prefetch (int): the number of pages fetched ahead of the page being processed
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        client (AsyncElasticsearch): the async client to use, a new one is opened and closed
+            again if None
+
+    Yields:
+        dict: a cleaned json document returned by the query
+    """
+    batches = aiter_query_batches(index, paging_id_field, paging_time_field, return_fields, fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all, prefetch, fields_api=fields_api, min_page_size=min_page_size, max_page_size=max_page_size, on_metrics=on_metrics, metrics_file=metrics_file, count=count, client=client)
+    try:
+        async for rows in batches:
+            for row in rows:
+                yield row
+    finally:
+        await batches.aclose()  # Async generators are not closed by a break in the consumer
+
+
+async def aquery_to_json(index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, prefetch:int =2, fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", client:AsyncElasticsearch =None) -> dict:
+    """ This is the async version of query_to_json.
+
+    Args:
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        prefetch (int): the number of pages fetched ahead of the page being processed
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        client (AsyncElasticsearch): the async client to use, a new one is opened and closed
+            again if None
+
+    Returns:
+        dict: the cleaned json documents returned by the query under the key 'data'
+    """
+    rows = []
+    async for batch in aiter_query_batches(index, paging_id_field, paging_time_field, return_fields, fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all, prefetch, fields_api=fields_api, min_page_size=min_page_size, max_page_size=max_page_size, on_metrics=on_metrics, metrics_file=metrics_file, count=count, client=client):
+        rows += batch
+
+    return {"data": rows}
+
+
+async def aquery_to_file(path:str, index:str =None, paging_id_field:str =None, paging_time_field:str =None, return_fields:list =[], fields_to_search:list =[], search_string:str =None, field_to_exist:str =None, date_field:str =None, start_date:str =None, end_date:str =None, is_match_all:bool =False, prefetch:int =2, schema:pa.Schema =None, row_group_size:int =None, compression:str ="snappy", fields_api:bool =False, min_page_size:int =100, max_page_size:int =10000, on_metrics =None, metrics_file:str =None, count:str ="hits", client:AsyncElasticsearch =None) -> None:
+    """ This is the async version of query_to_file. Fetching, cleaning and writing run as
+    separate stages so the next pages are downloaded and cleaned while the previous page
+    is written to disk in the default executor.
+
+    Args:
+        path (str): the path including filename for the output, ending in .csv, .jsonl,
+            .parquet, .feather or .arrow
+        index (str): the elasticsearch index you want to query
+        paging_id_field (str): the id field to sort on (optional)
+        paging_time_field (str): the date/time field to sort on (optional)
+        return_fields (list): the fields you want returned from the query
+        fields_to_search (list): the fields you want to search for your query string in
+        search_string (str): the terms you want to search for in the search fields
+        field_to_exist (str): supplied field will be used as an extra check to 
+            only return documents where this field isn't null
+        date_field (str): supplied field will be used to search by a custom date field
+            use in conjunction with start_date and end_date args
+        start_date (str): the first date you want to return documents from in format
+            yyyy-mm-dd
+        end_date (str): the last date you want to return documents from in format
+            yyyy-mm-dd, can also be set to 'now' to use current date
+        is_match_all (bool): this overrides search terms and exist terms and returns
+            all documents between start and end dates if specified
+        prefetch (int): the number of pages fetched ahead of the page being processed
+        schema (pyarrow.Schema): the declared parquet types of some or all fields, the rest are inferred
+        row_group_size (int): the rows in each parquet row group, one per page if None
+        compression (str): the parquet compression codec
+        fields_api (bool): fetch the return fields through the fields api instead of
+            _source, elasticsearch then only sends back the requested fields
+        min_page_size (int): the smallest page the page size controller may request
+        max_page_size (int): the largest page the page size controller may request
+        on_metrics (callable): called with a dict of timings, counters and progress after
+            every page and when the download is done, see _Metrics
+        metrics_file (str): append the same metrics to this file as json lines, or for a
+            file ending in .prom keep it up to date as a prometheus textfile
+        count (str): how the documents matching the query are counted for the progress and
+            eta, 'hits' with the first page of each slice, 'exact' with a count request
+            before the download begins or 'none'
+        client (AsyncElasticsearch): the async client to use, a new one is opened and closed
+            again if None
+    """
+    json = _generate_query_json(fields_to_search, search_string, field_to_exist, date_field, start_date, end_date, is_match_all)
+    if fields_api:
+        json = _use_fields_api(json)
+    return_fields, index, paging_id_field, paging_time_field = _resolve_query_target(return_fields, index, paging_id_field, paging_time_field)
+    schema = _resolve_schema(client, schema, index, return_fields, fields_api)
+
+    loop = asyncio.get_running_loop()
+    writer = _open_page_writer(path, return_fields, schema, row_group_size, compression)
+    controller = _PageController(min_page_size, max_page_size, metrics=_Metrics(on_metrics, metrics_file, count))
+    current_count = 0
+    writing = None
+    pages = _aiter_query(client, json, return_fields, index, paging_id_field, paging_time_field, prefetch, controller)
+
+    try:
+        async for rows in pages:
+            if writing != None:
+                await writing  # Keep the pages in order, one write at a time
+            writing = loop.run_in_executor(None, _timed_call, controller.metrics, "write", writer.write, rows)
+            current_count += len(rows)
+        if writing != None:
+            await writing
+    finally:
+        await pages.aclose()  # Close the point in time straight away if a write failed
+        if writing != None:
+            await asyncio.gather(writing, return_exceptions=True)  # Never close the file under a write
+        writer.close()
+
+    if current_count > 0:
+        logger.info(f"Saved data to {path}")
+    else:
+        logger.info("No results nothing saved")
+
+
+def _run_arguments(es:Elasticsearch, args:argparse.ArgumentParser, on_metrics =None) -> None:
+    """ Run the query described by checked command line arguments to its output file.
+
+    Args:
+        es (Elasticsearch): the open elasticsearch connection
+        args (argparse.ArgumentParser): the arguments of the query
+        on_metrics (callable): called with the metrics of the download, see _Metrics
+    """
+    index, json, return_fields, paging_id_field, paging_time_field  = _args_to_query(args)
+    metrics = _Metrics(on_metrics, args.metrics_file, args.count)
+
+    if args.group_by != None:
+        aggregate_metrics = args.metrics.split() if args.metrics else []
+        _aggregate_to_file(es, index, json, args.group_by.split(), aggregate_metrics, args.out, compression=args.compression,
+                           controller=_PageController(metrics=metrics))
+        return
+
+    _query_to_file_large(es, index, json, return_fields, paging_id_field, paging_time_field, args.out, args.workers, args.split_output,
+                        schema=_resolve_schema(es, args.schema, index, return_fields, args.fields_api), row_group_size=args.row_group_size, compression=args.compression,
+                        checkpoint_every=args.checkpoint_every, resume=args.resume, state_file=args.incremental,
+                        partition_by=args.partition_by, max_rows_per_file=args.max_rows_per_file,
+                        controller=_PageController(args.min_page_size, args.max_page_size, metrics=metrics), fan_out=args.fan_out)
+
+
+def _load_manifest(path:str) -> dict:
+    """ Load a batch manifest from a yaml or json file.
+
+    Args:
+        path (str): the path to the .yaml, .yml or .json manifest
+
+    Returns:
+        dict: the manifest
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1] in (".yaml", ".yml"):
+            try:
+                import yaml  # Optional, install esextract[batch] for yaml manifests
+            except ImportError:
+                raise Exception("Error: yaml manifests need the pyyaml package, install it with 'pip install esextract[batch]' or use a json manifest.")
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("queries"), list):
+        raise Exception(f"Error: the manifest '{path}' needs a list of queries.")
+
+    return manifest
+
+
+def _manifest_query_to_argv(query:dict) -> list:
+    """ Turn a manifest query into command line arguments. Keys are the long argument
+    names and true adds a flag. Lists are joined with spaces (e.g. fields), except for
+    search which takes its two values as a list.
+
+    Args:
+        query (dict): the query settings
+
+    Returns:
+        list: the command line arguments
+    """
+    argv = []
+    for name, value in query.items():
+        if name == "name" or value == None or value is False:
+            continue
+        argv.append(f"--{name}")
+        if isinstance(value, list) and name == "search":
+            argv += [str(item) for item in value]
+        elif isinstance(value, list):
+            argv.append(" ".join(str(item) for item in value))
+        elif value is not True:
+            argv.append(str(value))
+
+    return argv
+
+
+def run_manifest(manifest, concurrency:int =None, report:str =None, client:Elasticsearch =None) -> list:
+    """ Run every query in a batch manifest in this process, sharing one elasticsearch
+    client, with up to concurrency queries at a time. Each query takes the same
+    settings as the command line (long argument names without the dashes) merged
+    over the manifest defaults, e.g.
+
+        concurrency: 4
+        defaults: {index: "ps_tweets*", fields: "user.id full_text", page_id: id, page_time: created_at}
+        queries:
+          - name: vaccine
+            search: [full_text, "vac* OR vax*"]
+            start: 2021-01-01
+            end: now
+            out: data/vaccine.parquet
+
+    A failing query does not stop the others, every result is logged at the end.
+
+    Args:
+        manifest: the path to a yaml or json manifest, or the manifest dict
+        concurrency (int): the queries run at the same time, the manifest's
+            concurrency (or 1) if None
+        report (str): write the results to this json file
+        client (Elasticsearch): the client to use, the shared client from get_client() if None
+
+    Returns:
+        list: a result per query with its name, output, status ('ok' or 'failed'),
+            documents, seconds and error
+    """
+    if not isinstance(manifest, dict):
+        manifest = _load_manifest(manifest)
+    concurrency = concurrency or manifest.get("concurrency", 1)
+    queries = [dict(manifest.get("defaults", {}), **query) for query in manifest["queries"]]
+
+    outputs = [query.get("out", "output.csv") for query in queries]
+    duplicates = sorted(set(out for out in outputs if outputs.count(out) > 1))
+    if duplicates:
+        raise Exception(f"Error: several manifest queries write to {', '.join(duplicates)}, give each query its own out.")
+
+    es = client if client != None else get_client(pool_size=max(10, concurrency))
+
+    def run(query):
+        result = {"name": query.get("name", query.get("out", "output.csv")), "out": query.get("out", "output.csv"),
+                  "status": "failed", "docs": 0, "seconds": 0.0, "error": None}
+        start = time.perf_counter()
+        try:
+            args = _get_arguments(_manifest_query_to_argv(query))
+            if not _check_arguments(args):
+                raise Exception("invalid arguments")
+            logger.info(f"Running {result['name']}")
+            _run_arguments(es, args, lambda event: result.update(docs=event["docs"]) if event["event"] == "done" else None)
+            result["status"] = "ok"
+        except SystemExit:  # argparse prints the usage and exits on bad arguments
+            result["error"] = "invalid arguments"
+        except Exception as e:
+            result["error"] = str(e) or repr(e)
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run, queries))
+
+    for result in results:
+        if result["status"] == "ok":
+            logger.info(f"{result['name']}: ok, {result['docs']} documents in {result['seconds']:.1f}s to {result['out']}")
+        else:
+            logger.error(f"{result['name']}: failed after {result['seconds']:.1f}s, {result['error']}")
+
+    if report != None:
+        _write_json_atomic(report, {"results": results})
+
+    return results
+
+
+def write_dataframe_to_file(df:pandas.DataFrame, path:str, format:str="csv") -> None:
+    """ This function takes a dataframe and exports it to either JSON lines, CSV, Arrow Parquet
+    or Arrow IPC (Feather).
+    NOTE: This function could be put in the Julia wrapper?
+
+    Args:
+        df (pandas.DataFrame): the dataframe to be stored to file
+        path (str): the path including filename for the output
+        format (str): the format of the file on disk (csv, json or jsonl for json lines,
+            arrow or parquet for parquet, feather for an uncompressed arrow ipc file that
+            read_dataframe_from_file memory maps)
+    """
+    if format in ("json", "jsonl"):
+        with open(path, "w", encoding="utf-8") as f:
+            for start in range(0, len(df), _JSON_LINES_CHUNK):  # Encode a chunk at a time instead of one huge string
+                f.write(df.iloc[start:start + _JSON_LINES_CHUNK].to_json(orient="records", lines=True).rstrip("\n") + "\n")
+
+    elif format == "csv":
+        df.to_csv(path, index=False)
+
+    elif format in ("arrow", "parquet"):
+        table = pa.Table.from_pandas(df)
+        pq.write_table(table, path)
+
+    elif format == "feather":
+        table = pa.Table.from_pandas(df)
+        with pa.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table)
+
+    else:
+        raise Exception("Invalid format please use either 'json', 'jsonl', 'csv', 'arrow', 'parquet' or 'feather'")
+
+
+def _read_json_file(path:str) -> pandas.DataFrame:
+    """ Read a json lines file, which may be compressed, or a .json file holding json
+    lines, a json array of records or the json encoded string of one written by
+    earlier versions of write_dataframe_to_file.
+    """
+    if _split_extension(path)[1] != ".json":
+        return pandas.read_json(path, lines=True)  # Compression is picked from the extension
+
+    with open(path, encoding="utf-8") as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+
+        if first == '"':  # Earlier versions encoded the records a second time
+            f.seek(0)
+            return pandas.read_json(io.StringIO(json.load(f)))
+
+    if first == "[":
+        return pandas.read_json(path)
+
+    return pandas.read_json(path, lines=True)
+
+
+def _manifest_schema(manifest:dict) -> pa.Schema:
+    """ The arrow schema every part file of a parquet or feather dataset casts to, as
+    recorded in its manifest by _PartitionedWriter.write_manifest.
+    """
+    return pa.ipc.read_schema(pa.py_buffer(base64.b64decode(manifest["schema"])))
+
+
+def _manifest_dataset(path:str, manifest:dict) -> pads.Dataset:
+    """ Load a json lines or zstd compressed csv dataset file by file with the partition
+    columns from its manifest. Pyarrow datasets do not recognise .zst part files and
+    can hang scanning json lines part files. Parquet and feather datasets are read this
+    way when a part file does not cast to the schema of the manifest while scanning.
+
+    Args:
+        path (str): the dataset directory
+        manifest (dict): the _SUCCESS manifest of the dataset
+
+    Returns:
+        pyarrow.dataset.Dataset: the dataset in memory
+    """
+    tables = []
+    for file in manifest["files"]:
+        file_path = os.path.join(path, file["path"])
+        if manifest["format"] == "parquet":
+            table = _conform_table(pq.read_table(file_path), _manifest_schema(manifest))
+        elif manifest["format"] in ("feather", "arrow"):
+            with pa.OSFile(file_path) as source:
+                table = _conform_table(pa.ipc.open_file(source).read_all(), _manifest_schema(manifest))
+        else:
+            with pa.input_stream(file_path) as source:  # Decompressed going by the extension
+                table = pacsv.read_csv(source) if manifest["format"] == "csv" else pajson.read_json(source)
+        for column, value in file["partition"].items():
+            if column in table.column_names:  # Partitioned by the values of a field kept in the file
+                continue
+            table = table.append_column(column, pa.array([value] * table.num_rows, pa.string()))
+        tables.append(table)
+
+    return pads.dataset(pa.concat_tables(tables, promote_options="permissive") if tables else pa.table({}))
+
+
+def read_dataframe_from_file(path:str, columns:list =None, filters =None, memory_map:bool =True) -> pandas.DataFrame:
+    """ Function to read in csv or json lines (both optionally gzip or zstd compressed), arrow
+    parquet, arrow ipc (feather) or a partitioned dataset directory written with partition_by
+    to a dataframe. Parquet files and datasets only
+    read the requested columns and skip row groups and partitions that the filters rule out,
+    feather files are memory mapped so only the requested columns are loaded.
+    NOTE: This function could be put in the Julia wrapper?
+
+    Args:
+        path (str): the path including filename for the output, or a dataset directory
+        columns (list): the columns to read, every column if None
+        filters: only read the rows matching these filters, in the pyarrow.parquet.read_table
+            form, e.g. [("lang", "=", "en"), ("retweet_count", ">", 10)], parquet, feather
+            and datasets only
+        memory_map (bool): memory map parquet and feather files instead of reading them
+
+    Returns:
+        pandas.DataFrame: the file in a DataFrame
+    """
+    f, extension = _split_extension(path)
+    if filters != None and not os.path.isdir(path) and extension not in (".parquet", ".feather", ".arrow"):
+        raise Exception("Error: filters need a parquet, feather or arrow file or a dataset directory.")
+
+    if os.path.isdir(path):
+        manifest_file = os.path.join(path, "_SUCCESS")
+        if not os.path.exists(manifest_file):
+            raise Exception(f"Error: '{path}' is not a complete dataset, it has no _SUCCESS manifest.")
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        expression = pq.filters_to_expression(filters) if filters != None else None
+        if manifest["format"] == "jsonl" or manifest.get("compression") == "zstd":
+            return _manifest_dataset(path, manifest).to_table(columns=columns, filter=expression).to_pandas()
+
+        dataset = pads.dataset(path, format=_DATASET_FORMATS[manifest["format"]], partitioning="hive")
+        if manifest.get("schema") != None:  # Part files whose types drifted are cast to the schema of the whole dataset
+            schema = _manifest_schema(manifest)
+            schema = pa.schema([schema.field(field.name) if field.name in schema.names else field for field in dataset.schema])
+            dataset = pads.dataset(path, format=_DATASET_FORMATS[manifest["format"]], partitioning="hive", schema=schema)
+        try:
+            return dataset.to_table(columns=columns, filter=expression).to_pandas()
+        except pa.ArrowNotImplementedError:  # A cast arrow can not do while scanning (e.g. lists to text), read the part files one by one
+            return _manifest_dataset(path, manifest).to_table(columns=columns, filter=expression).to_pandas()
+
+    elif extension in (".csv", ".csv.gz", ".csv.zst"):
+        df = pandas.read_csv(path, usecols=columns)
+        return df
+        
+    elif extension in (".json", ".jsonl", ".jsonl.gz", ".jsonl.zst"):
+        df = _read_json_file(path)
+        return df[columns] if columns != None else df
+
+    elif extension == ".parquet":
+        df = pq.read_table(path, columns=columns, filters=filters, memory_map=memory_map).to_pandas()
+        return df
+
+    elif extension in (".feather", ".arrow"):
+        source = pa.memory_map(path) if memory_map else pa.OSFile(path)
+        table = pa.ipc.open_file(source).read_all()  # Zero copy when memory mapped, columns are only read when used
+        if columns != None:
+            table = table.select(columns)
+        if filters != None:
+            table = table.filter(pq.filters_to_expression(filters))
+        return table.to_pandas()
+
+    else:
+        raise Exception("Invalid format please use either 'json', 'jsonl', 'csv', arrow 'parquet' or 'feather'")
+
+
+def main() -> None:
+    """This is the main function which reads the env vars (DISCUSS) and parsees command line args.
+    Look up 'arg pass'
+    1. Read arguments and fail
+    2. Do checks on FS etc.
+    3. Then do stuff...
+    """
 
     host, port, username, password = _get_env_variables()
     args = _get_arguments()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+
+    if args.manifest != None:
+        manifest = _load_manifest(args.manifest)
+        concurrency = args.concurrency or manifest.get("concurrency", 1)
+        workers = max([1] + [query.get("workers", manifest.get("defaults", {}).get("workers", 1)) for query in manifest["queries"]])
+        es = get_client(host, port, username, password, pool_size=max(10, concurrency * workers), timeout=args.timeout,
+                        http_compress=args.http_compress, serializer=args.serializer)
+        results = run_manifest(manifest, concurrency, args.report, es)
+        if any(result["status"] != "ok" for result in results):
+            raise SystemExit(1)
+        return
     
     if not _check_arguments(args):
-        print('Done')
+        logger.info('Done')
         return
    
-    output_file = args.out
-    index, json, return_fields, paging_id_field, paging_time_field  = _args_to_query(args)
-    _query_to_csv_large(host, port, username, password, index, json, return_fields, paging_id_field, paging_time_field, output_file)
+    es = get_client(host, port, username, password, pool_size=max(10, args.workers), timeout=args.timeout, http_compress=args.http_compress,
+                    serializer=args.serializer)
+    _run_arguments(es, args)
 
     # Testing external functions here
     
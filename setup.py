@@ -12,7 +12,10 @@ setuptools.setup(
     py_modules=["esextract"],             # Name of the python package
     package_dir={'':'esextract/src'},     # Directory of the source code of the package
     install_requires=['elasticsearch',
-        'pandas',
-        'argparse',
-        'pyarrow']                          # Install other dependencies if any
+        'argparse'],                        # Install other dependencies if any
+    extras_require={'dataframe': ['pandas', 'pyarrow'],  # Optional DataFrames and parquet
+                    'fast': ['orjson'],   # Optional faster json decoding of responses
+                    'batch': ['pyyaml'],  # Optional yaml batch manifests
+                    'zstd': ['zstandard'],  # Optional zstd compressed outputs
+                    'async': ['elasticsearch[async]']}  # Optional async api on aiohttp
 )
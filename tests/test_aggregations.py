@@ -0,0 +1,51 @@
+import copy
+
+import pytest
+
+import esextract
+
+
+class CompositeClient:
+    """ Answers composite aggregations over user.id with a bucket per user, paging on after_key.
+    """
+    def __init__(self, users=10):
+        self.users = users
+        self.bodies = []
+
+    def search(self, index, body):
+        self.bodies.append(copy.deepcopy(body))
+        composite = body["aggs"]["groups"]["composite"]
+        after = composite.get("after", {}).get("user.id", -1)
+        keys = [user for user in range(self.users) if user > after][:composite["size"]]
+        buckets = [{"key": {"user.id": user}, "doc_count": user + 1, "sum_retweet_count": {"value": user * 2.0}} for user in keys]
+        groups = {"buckets": buckets}
+        if buckets:  # Like elasticsearch, the last page still has an after_key
+            groups["after_key"] = buckets[-1]["key"]
+        return {"aggregations": {"groups": groups}}
+
+
+@pytest.mark.parametrize("users, page_size", [(10, 3), (9, 3), (2, 5), (0, 5)])
+def test_buckets_page_on_after_key(users, page_size):
+    es = CompositeClient(users)
+    pages = list(esextract._page_buckets(es, "idx", {"query": {"match_all": {}}}, ["user.id"], ["sum:retweet_count"], page_size))
+    rows = [row for page in pages for row in page]
+    assert rows == [{"user.id": user, "doc_count": user + 1, "sum_retweet_count": user * 2.0} for user in range(users)]
+    assert all(len(page) == page_size for page in pages[:-1])
+    afters = [body["aggs"]["groups"]["composite"].get("after") for body in es.bodies]
+    assert afters == [None] + [{"user.id": min(users, (num + 1) * page_size) - 1} for num in range(len(afters) - 1)]
+    assert all(body["query"] == {"match_all": {}} and body["size"] == 0 for body in es.bodies)
+
+
+def test_missing_keys_are_empty():
+    class MissingClient:
+        def search(self, index, body):
+            return {"aggregations": {"groups": {"buckets": [{"key": {"user.id": None}, "doc_count": 1}]}}}
+
+    rows = [row for page in esextract._page_buckets(MissingClient(), "idx", {"query": {}}, ["user.id"], []) for row in page]
+    assert rows == [{"user.id": "", "doc_count": 1}]
+
+
+@pytest.mark.parametrize("argv", [["-w", "2"], ["--fan_out"]])
+def test_group_by_can_not_be_sliced(argv):
+    args = esextract._get_arguments(["-m", "-i", "idx", "--group_by", "user.id", *argv])
+    assert esextract._check_arguments(args) is False
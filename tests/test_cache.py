@@ -0,0 +1,26 @@
+import pandas
+import pytest
+
+import esextract
+
+
+@pytest.mark.parametrize("pages", [
+    [[{"score": 2}], [{"score": 2.75}]],
+    [[{"score": ""}], [{"score": 3}, {"score": ""}]],
+    [[{"score": 1, "name": "a"}], [{"score": 2, "name": ""}]],
+])
+def test_cached_pages_round_trip(tmp_path, pages):
+    frames = [pandas.DataFrame(page) for page in pages]
+    fields = list(frames[0].columns)
+    cache = esextract._ResultCache(str(tmp_path))
+    cache.put("key", frames, fields)
+    cached = esextract._table_to_dataframe(cache.get("key"))
+    expected = pandas.concat(frames, ignore_index=True)
+    assert cached.to_dict("list") == expected.to_dict("list")
+
+
+def test_pages_that_do_not_unify_are_not_cached(tmp_path):
+    frames = [pandas.DataFrame([{"score": 1}]), pandas.DataFrame([{"score": "high"}])]
+    cache = esextract._ResultCache(str(tmp_path))
+    cache.put("key", frames, ["score"])
+    assert cache.get("key") == None
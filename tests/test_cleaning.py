@@ -0,0 +1,89 @@
+import json
+
+import pyarrow as pa
+import pytest
+
+import esextract
+import fake_es
+
+
+def _original_clean(sources, fields):
+    """ The interpreted cleaner _compile_doc_cleaner replaced, for documents it could clean.
+    """
+    parsed_sources = []
+    for source in sources:
+        out = {}
+        for field in fields:
+            if '.' in field:
+                f_split = field.split('.')
+                if f_split[0] not in source:
+                    out[field] = ""
+                    continue
+                data = source[f_split[0]]
+                for layer in f_split[1:]:
+                    if type(data) is list:
+                        out[field] = [e[layer] for e in data]
+                    else:
+                        data = data[layer]
+                        out[field] = data
+            else:
+                out[field] = source.get(field, "")
+        parsed_sources.append(out)
+
+    return parsed_sources
+
+
+def test_matches_the_original_cleaner_on_generated_documents():
+    dataset = fake_es.Dataset(docs=300, width=4, depth=3)
+    sources = [json.loads(dataset.source(num)) for num in range(dataset.docs)]
+    fields = dataset.return_fields()
+    assert any("." in field for field in fields)
+    assert esextract._clean_elastic_docs(sources, fields) == _original_clean(sources, fields)
+
+
+def test_matches_the_original_cleaner_on_nested_fields_and_lists():
+    sources = [{"id": 1, "user": {"id": 7, "name": "a", "place": {"country": "nz"}}, "urls": [{"url": "x"}, {"url": "y"}]},
+               {"id": 2, "user": {"id": 8, "name": "b", "place": {"country": "au"}}, "urls": []},
+               {"id": 3}]
+    fields = ["id", "user.id", "user.place.country", "urls.url", "missing"]
+    cleaned = esextract._clean_elastic_docs(sources, fields)
+    assert cleaned == _original_clean(sources, fields)
+    assert cleaned[0] == {"id": 1, "user.id": 7, "user.place.country": "nz", "urls.url": ["x", "y"], "missing": ""}
+
+
+def test_missing_nested_fields_are_empty():
+    sources = [{"user": {"id": 7}}, {"user": None}, {"user": "text"}, {"user": {"place": {}}}]
+    assert [doc["user.place.country"] for doc in esextract._clean_elastic_docs(sources, ["user.place.country"])] == ["", "", "", ""]
+    assert [doc["user.name"] for doc in esextract._clean_elastic_docs(sources, ["user.name"])] == ["", "", "", ""]
+
+
+@pytest.mark.parametrize("source, expected", [
+    ({"entities": {"urls": [{"expanded": {"url": "x"}}, {"expanded": {"url": "y"}}]}}, ["x", "y"]),
+    ({"entities": {"urls": [{"expanded": {"url": "x"}}, {"other": 1}]}}, ["x", ""]),
+    ({"entities": [{"urls": [{"expanded": {"url": "x"}}]}, {"urls": []}]}, [["x"], []]),
+])
+def test_lists_of_objects_map_the_rest_of_the_path(source, expected):
+    assert esextract._clean_elastic_docs([source], ["entities.urls.expanded.url"])[0]["entities.urls.expanded.url"] == expected
+
+
+def test_fields_api_values_stay_lists():
+    docs = [{"id": [1], "tags": ["a", "b"]}, {"id": [2]}]
+    assert esextract._clean_fields_docs(docs, ["id", "tags"]) == [{"id": [1], "tags": ["a", "b"]}, {"id": [2], "tags": ""}]
+    assert esextract._rows_to_table(esextract._clean_fields_docs(docs, ["id"]), ["id"]).schema.field("id").type == pa.list_(pa.int64())
+
+
+def test_fields_api_declared_types_apply_to_the_values():
+    schema = esextract._resolve_schema(None, pa.schema([("id", pa.int64()), ("created_at", pa.timestamp("ms", tz="UTC"))]), "idx", ["id", "created_at"], fields_api=True)
+    assert schema.field("id").type == pa.list_(pa.int64())
+    rows = [{"id": [1], "created_at": ["2021-01-01T00:00:00Z"]}, {"id": "", "created_at": [1609459200000, "2021-01-01"]}]
+    table = esextract._rows_to_table(rows, ["id", "created_at"], schema)
+    assert table.schema == schema
+    assert table.column("id").to_pylist() == [[1], None]
+    assert [len(dates) for dates in table.column("created_at").to_pylist()] == [1, 2]
+
+
+def test_dataset_ranges_of_list_paging_fields(tmp_path):
+    writer = esextract._PartitionedWriter(str(tmp_path / "out"), ".csv", ["id"], max_rows_per_file=10, paging_fields=["id"])
+    writer.write([{"id": [5]}, {"id": [3]}, {"id": ""}, {"id": [9]}])
+    writer.close()
+    assert (writer.files[0]["min"], writer.files[0]["max"]) == ({"id": 3}, {"id": 9})
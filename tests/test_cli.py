@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+
+import pytest
+
+import esextract
+
+
+def _check(*argv):
+    return esextract._check_arguments(esextract._get_arguments(["-m", "-i", "idx", *argv]))
+
+
+@pytest.mark.parametrize("argv", [["-o", "out.csv.gz", "-pt", "created_at"], ["-o", "out.parquet", "-pt", "created_at"],
+                                  ["-o", "out.csv", "-pt", "created_at", "-w", "2"], ["-o", "out.csv", "-pt", "created_at", "--fan_out"],
+                                  ["-o", "out.csv"]])
+def test_resume_needs_a_plain_csv_one_worker_and_both_paging_fields(monkeypatch, argv):
+    monkeypatch.delenv("PAGE_TIME_FIELD", raising=False)
+    assert _check("--resume", "-pi", "id", *argv) is False
+
+
+def test_resume_a_plain_csv():
+    assert _check("--resume", "-pi", "id", "-pt", "created_at", "-o", "out.csv") is True
+
+
+def test_checkpoints_are_off_by_default():
+    assert esextract._get_arguments(["-m"]).checkpoint_every == None
+
+
+def test_manifest_query_round_trips_to_arguments(tmp_path):
+    (tmp_path / "queries.yaml").write_text("""
+defaults: {index: "ps_tweets*", fields: [user.id, full_text], page_id: id, page_time: created_at}
+queries:
+  - name: vaccine
+    search: [full_text, "vac* OR vax*"]
+    start: 2021-01-01
+    end: now
+    workers: 4
+    split_output: true
+    fan_out: false
+    out: data/vaccine.parquet
+""")
+    manifest = esextract._load_manifest(str(tmp_path / "queries.yaml"))
+    query = dict(manifest["defaults"], **manifest["queries"][0])
+    args = esextract._get_arguments(esextract._manifest_query_to_argv(query))
+    assert args.index == "ps_tweets*" and args.fields == "user.id full_text"
+    assert args.search == ["full_text", "vac* OR vax*"]
+    assert (args.start, args.end, args.out) == ("2021-01-01", "now", "data/vaccine.parquet")
+    assert args.workers == 4 and args.split_output is True and args.fan_out is False
+    assert (args.page_id, args.page_time) == ("id", "created_at")
+
+
+def test_manifest_runs_at_most_concurrency_queries_at_a_time(monkeypatch, tmp_path):
+    lock = threading.Lock()
+    running = [0, 0]  # Now and the most at once
+
+    def run_arguments(es, args, on_metrics=None):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        if args.out.endswith("3.csv"):
+            raise Exception("boom")
+        on_metrics({"event": "done", "docs": 7})
+
+    monkeypatch.setattr(esextract, "_run_arguments", run_arguments)
+    manifest = {"concurrency": 2, "defaults": {"index": "idx", "match_all": True},
+                "queries": [{"out": str(tmp_path / f"{num}.csv")} for num in range(6)]}
+    results = esextract.run_manifest(manifest, client=object(), report=str(tmp_path / "report.json"))
+    assert running[1] == 2
+    assert [result["status"] for result in results] == ["ok", "ok", "ok", "failed", "ok", "ok"]
+    assert results[3]["error"] == "boom" and results[0]["docs"] == 7
+    assert json.loads((tmp_path / "report.json").read_text())["results"] == results
+
+
+def test_manifest_queries_need_their_own_output():
+    with pytest.raises(Exception, match="give each query its own out"):
+        esextract.run_manifest({"queries": [{"out": "a.csv"}, {"out": "a.csv"}]}, client=object())
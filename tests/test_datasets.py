@@ -0,0 +1,20 @@
+import pytest
+
+import esextract
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz", ".jsonl.zst"])
+@pytest.mark.parametrize("partition_by", ["lang", "created_at:day"])
+def test_json_lines_dataset_round_trip(tmp_path, extension, partition_by):
+    rows = [{"lang": "en", "id": 1, "created_at": "2021-01-01T10:00:00Z"},
+            {"lang": "fr", "id": 2, "created_at": "2021-01-02T10:00:00Z"},
+            {"lang": "en", "id": 3, "created_at": "2021-01-02T11:00:00Z"}]
+    writer = esextract._PartitionedWriter(str(tmp_path / "out"), extension, ["lang", "id", "created_at"], partition_by=partition_by)
+    writer.write(rows)
+    writer.close()
+    writer.write_manifest()
+
+    df = esextract.read_dataframe_from_file(str(tmp_path / "out"))
+    assert sorted(zip(df["lang"], df["id"])) == [("en", 1), ("en", 3), ("fr", 2)]
+    df = esextract.read_dataframe_from_file(str(tmp_path / "out"), filters=[("lang", "=", "fr")])
+    assert df["id"].tolist() == [2]
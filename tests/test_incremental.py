@@ -0,0 +1,66 @@
+import json
+import os
+
+import pandas
+
+import esextract
+import fake_es
+
+
+def _run(tmp_path, docs):
+    es = fake_es.client(fake_es.Dataset(docs=docs, width=2, depth=1))
+    esextract.query_to_file(str(tmp_path / "tweets.csv"), "idx", "id", "created_at", ["id"], is_match_all=True,
+                            state_file=str(tmp_path / "state.json"), client=es)
+    with open(tmp_path / "state.json") as f:
+        return json.load(f)
+
+
+def test_runs_only_download_documents_after_the_watermark(tmp_path):
+    state = _run(tmp_path, 300)
+    assert len(state) == 1
+    watermark = list(state.values())[0]
+    assert watermark["rows"] == 300 and watermark["index"] == "idx"
+    assert watermark["search_after"] == [fake_es.BASE_TIME + 299 * fake_es.TIME_STEP, 299]
+
+    assert _run(tmp_path, 300) == state  # Nothing new, no partition file and the watermark stays
+
+    watermark = list(_run(tmp_path, 500).values())[0]
+    assert watermark["rows"] == 500
+    assert watermark["search_after"] == [fake_es.BASE_TIME + 499 * fake_es.TIME_STEP, 499]
+    assert len(watermark["files"]) == 2 and sorted(watermark["files"]) == watermark["files"]
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(path) for path in watermark["files"]] + ["state.json"])
+    ids = [pandas.read_csv(path)["id"].tolist() for path in watermark["files"]]
+    assert ids == [list(range(300)), list(range(300, 500))]
+
+
+def test_watermarks_of_other_queries_are_kept(tmp_path):
+    esextract._save_watermark(str(tmp_path / "state.json"), "other", {"rows": 1})
+    state = _run(tmp_path, 10)
+    assert state["other"] == {"rows": 1} and len(state) == 2
+    assert esextract._load_watermark(str(tmp_path / "missing.json"), "other") == {}
+
+
+def test_delta_files_from_the_same_second_sort_in_order(tmp_path):
+    paths = []
+    for run in range(12):
+        paths.append(esextract._delta_file_name(str(tmp_path / "tweets.csv.gz")))
+        open(paths[-1], "w").close()
+    assert len(set(paths)) == 12 and all(path.endswith(".csv.gz") for path in paths)
+    assert sorted(paths) == paths
+
+
+def test_part_files_of_a_run_are_recorded(tmp_path, monkeypatch):
+    original = esextract._clean_page
+
+    def drift(res_docs, body, return_fields):  # Text in the id column from the second page on
+        rows = original(res_docs, body, return_fields)
+        return rows if rows[0]["id"] == 0 else [dict(row, id=f"#{row['id']}") for row in rows]
+
+    monkeypatch.setattr(esextract, "_clean_page", drift)
+    es = fake_es.client(fake_es.Dataset(docs=300, width=2, depth=1))
+    esextract.query_to_file(str(tmp_path / "tweets.parquet"), "idx", "id", "created_at", ["id"], is_match_all=True, min_page_size=100, max_page_size=100,
+                            state_file=str(tmp_path / "state.json"), client=es)
+    with open(tmp_path / "state.json") as f:
+        files = list(json.load(f).values())[0]["files"]
+    assert len(files) == 2 and files[1].endswith(".part0001.parquet")
+    assert sum(len(pandas.read_parquet(path)) for path in files) == 300
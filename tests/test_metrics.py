@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import esextract
+import fake_es
+
+
+def _download(workers=1, count="hits", metrics_file=None):
+    events = []
+    es = fake_es.client(fake_es.Dataset(docs=1000, width=2, depth=1))
+    rows = esextract.query_to_json("idx", "id", "created_at", ["id"], is_match_all=True, workers=workers, min_page_size=100, max_page_size=100,
+                                   on_metrics=events.append, metrics_file=metrics_file, count=count, client=es)
+    return rows["data"], events
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_page_events_add_up_to_the_done_event(workers):
+    rows, events = _download(workers)
+    assert [event["event"] for event in events] == ["page"] * (len(events) - 1) + ["done"]
+    pages, done = events[:-1], events[-1]
+    assert sum(event["page_docs"] for event in pages) == done["docs"] == len(rows) == 1000
+    assert [event["docs"] for event in pages] == sorted(event["docs"] for event in pages)
+    assert done["expected_docs"] == 1000 and done["eta_seconds"] == 0
+    assert all(set(event["stages"]) == set(esextract._STAGES) for event in events)
+    for stage in esextract._STAGES:  # Each event covers the time since the one before
+        assert sum(event["page_stages"][stage] for event in events) == pytest.approx(done["stages"][stage])
+
+
+@pytest.mark.parametrize("count, expected", [("exact", 1000), ("none", None)])
+def test_count_modes(count, expected):
+    rows, events = _download(count=count)
+    assert all(event["expected_docs"] == expected for event in events)
+
+
+def test_metrics_files(tmp_path):
+    rows, events = _download(metrics_file=str(tmp_path / "metrics.jsonl"))
+    with open(tmp_path / "metrics.jsonl") as f:
+        assert [json.loads(line) for line in f] == json.loads(json.dumps(events))
+
+    _download(metrics_file=str(tmp_path / "metrics.prom"))
+    lines = (tmp_path / "metrics.prom").read_text().splitlines()
+    assert "esextract_docs_total 1000" in lines and "# TYPE esextract_docs_total counter" in lines
+
+
+def test_expected_documents_are_extrapolated_until_every_part_is_counted():
+    metrics = esextract._Metrics()
+    assert metrics.expected() == (None, False)
+    metrics.expect(4)
+    metrics.found(None, 100)
+    metrics.found(None, None)  # Ignored
+    assert metrics.expected() == (400, True)
+    for num in range(3):
+        metrics.found(None, 50)
+    assert metrics.expected() == (250, False)
+    assert metrics.progress(0).startswith("[0/250]")
+
+
+def test_unknown_count_mode():
+    with pytest.raises(Exception, match="count must be one of"):
+        esextract._Metrics(count="maybe")
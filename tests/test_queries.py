@@ -0,0 +1,136 @@
+import asyncio
+import json
+
+import pytest
+
+import esextract
+import fake_es
+
+
+class RecordingConnection(fake_es.FakeConnection):
+    """ Records the url and body of every request before answering it.
+    """
+    requests = []
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        self.requests.append((url, json.loads(body) if body else {}))
+        return super().perform_request(method, url, params, body, timeout, ignore, headers)
+
+
+@pytest.fixture
+def recorded():
+    RecordingConnection.requests = []
+    RecordingConnection.dataset = fake_es.Dataset(docs=500, width=2, depth=1)
+    return RecordingConnection.requests
+
+
+def _client():
+    return esextract.Elasticsearch(["fake"], connection_class=RecordingConnection)
+
+
+@pytest.mark.parametrize("fields_api", [False, True])
+def test_exact_count_sends_only_the_query(recorded, fields_api):
+    rows = esextract.query_to_json("idx", "id", "created_at", ["id"], is_match_all=True, fields_api=fields_api, count="exact", client=_client())
+    assert len(rows["data"]) == 500
+    counts = [body for url, body in recorded if url.endswith("/_count")]
+    assert counts and all(list(body) == ["query"] for body in counts)
+
+
+class FlakyConnection(RecordingConnection):
+    """ Answers the first request to every endpoint with a 429.
+    """
+    failed = set()
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        endpoint = (method, url.rsplit("/", 1)[-1])
+        if endpoint not in self.failed:
+            self.failed.add(endpoint)
+            raise esextract.TransportError(429, "too_many_requests", "try again")
+        return super().perform_request(method, url, params, body, timeout, ignore, headers)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_every_request_is_retried(recorded, monkeypatch, workers):
+    monkeypatch.setattr(esextract, "_BACKOFF_BASE", 0)
+    FlakyConnection.failed = set()
+    es = esextract.Elasticsearch(["fake"], connection_class=FlakyConnection, max_retries=0)
+    rows = esextract.query_to_json("idx", "id", "created_at", ["id"], is_match_all=True, workers=workers, count="exact", client=es)
+    assert sorted(row["id"] for row in rows["data"]) == list(range(500))
+    assert {("POST", "_pit"), ("DELETE", "_pit"), ("POST", "_count"), ("POST", "_search")} <= FlakyConnection.failed
+
+
+class AsyncFakeClient:
+    """ An async client answering from the fake elasticsearch.
+    """
+    def __init__(self):
+        self.es = esextract.Elasticsearch(["fake"], connection_class=RecordingConnection)
+
+    def __getattr__(self, name):
+        method = getattr(self.es, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+@pytest.mark.parametrize("batch_size", [None, 64])
+def test_async_batches(recorded, batch_size):
+    async def collect():
+        return [batch async for batch in esextract.aiter_query_batches("idx", "id", "created_at", ["id"], is_match_all=True, batch_size=batch_size,
+                                                                        min_page_size=100, max_page_size=100, client=AsyncFakeClient())]
+
+    batches = asyncio.run(collect())
+    assert [row["id"] for batch in batches for row in batch] == list(range(500))
+    expected = 100 if batch_size == None else batch_size
+    assert all(len(batch) == expected for batch in batches[:-1]) and len(batches[-1]) <= expected
+
+
+class IndicesClient:
+    """ Answers resolve_index and get_alias for an alias with a filter, a plain alias over
+    a closed index and a data stream with a closed backing index.
+    """
+    closed = {"old", ".ds-logs-000001"}
+
+    def resolve_index(self, name, expand_wildcards=None):
+        if expand_wildcards == "all":
+            return {"indices": [{"name": index, "attributes": ["closed" if index in self.closed else "open", "hidden"]} for index in name.split(",")]}
+        return {"indices": [{"name": "tweets", "attributes": ["open"]}, {"name": "shut", "attributes": ["closed"]}],
+                "aliases": [{"name": "english", "indices": ["tweets", "news"]}, {"name": "everything", "indices": ["news", "old"]}],
+                "data_streams": [{"name": "logs", "backing_indices": [".ds-logs-000001", ".ds-logs-000002"]}]}
+
+    def get_alias(self, name):
+        return {"tweets": {"aliases": {"english": {"filter": {"term": {"lang": "en"}}}}}, "news": {"aliases": {"english": {"filter": {"term": {"lang": "en"}}}, "everything": {}}},
+                "old": {"aliases": {"everything": {}}}}
+
+
+class AliasClient:
+    indices = IndicesClient()
+
+
+def test_filtered_aliases_are_kept_and_closed_indices_skipped():
+    assert esextract._resolve_indices(AliasClient(), "*") == [".ds-logs-000002", "english", "news", "tweets"]
+
+
+def test_pages_through_a_point_in_time_with_search_after(recorded):
+    rows = esextract.query_to_json("idx", "id", "created_at", ["id"], is_match_all=True, min_page_size=100, max_page_size=100, client=_client())
+    assert [row["id"] for row in rows["data"]] == list(range(500))
+
+    searches = [body for url, body in recorded if url == "/_search" and "aggs" not in body]
+    assert all(body["pit"]["id"] == "fake-pit" and body["sort"][-1] == {"_shard_doc": "asc"} for body in searches)
+    assert "search_after" not in searches[0]
+    times = [after["search_after"][0] for after in searches[1:]]
+    assert times == [fake_es.BASE_TIME + num * fake_es.TIME_STEP for num in (99, 199, 299, 399, 499)]
+    assert all(len(after["search_after"]) == 3 for after in searches[1:])  # created_at, id and the _shard_doc tiebreaker
+    assert any(url == "/_pit" for url, body in recorded)
+
+
+def test_cursor_starts_after_the_last_document(recorded):
+    start = [fake_es.BASE_TIME + 249 * fake_es.TIME_STEP, 249]
+    cursor = list(start)
+    pages = esextract._page_documents(_client(), "fake-pit", {"query": {"match_all": {}}}, ["id", "created_at"], "id", "created_at", cursor,
+                                      esextract._PageController(100, 100))
+    first = next(pages)
+    assert recorded[-1][1]["search_after"] == start + [esextract._SHARD_DOC_MAX]
+    assert first[0]["id"] == 250
+    assert cursor == [fake_es.BASE_TIME + 349 * fake_es.TIME_STEP, 349]  # Updated in place without the tiebreaker
+    assert sum(len(page) for page in pages) + len(first) == 250
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import esextract
+import fake_es
+
+
+@pytest.mark.parametrize("lower, upper, count", [(0, 999, 4), (10, 12, 8), (5, 5, 3), (0, 10**12, 7)])
+def test_time_windows_cover_the_range(lower, upper, count):
+    windows = esextract._split_time_windows(lower, upper, count)
+    assert len(windows) == min(count, upper - lower + 1)
+    assert windows[0][0] == lower and windows[-1][1] == upper + 1
+    assert all(first[1] == second[0] for first, second in zip(windows, windows[1:]))
+    assert all(gte < lt for gte, lt in windows)
+
+
+def test_split_query_adds_a_slice_for_documents_without_a_time():
+    es = fake_es.client(fake_es.Dataset(docs=100, width=2, depth=1))
+    json = {"query": {"bool": {"must": {"match_all": {}}}}}
+    slices = esextract._split_query(es, "fake-pit", json, "created_at", 4)
+    assert len(slices) == 5
+    windows = [body["query"]["bool"]["filter"][-1]["range"]["created_at"] for body in slices[:4]]
+    assert windows[0]["gte"] == fake_es.BASE_TIME and windows[-1]["lt"] == fake_es.BASE_TIME + 99 * fake_es.TIME_STEP + 1
+    assert slices[-1]["query"]["bool"]["must_not"] == [{"exists": {"field": "created_at"}}]
+    assert json == {"query": {"bool": {"must": {"match_all": {}}}}}  # Not modified
+
+
+def test_parallel_pages_keep_their_order_within_each_download():
+    def download(num):
+        for page in range(5):
+            time.sleep(0.001 * ((num + page) % 3))
+            yield [(num, page)]
+
+    pages = list(esextract._iter_parallel([lambda num=num: download(num) for num in range(6)], 3))
+    assert len(pages) == 30
+    for num in range(6):
+        assert [rows[0] for slice_num, rows in pages if slice_num == num] == [(num, page) for page in range(5)]
+
+
+def test_parallel_errors_reach_the_consumer():
+    def failing():
+        yield [1]
+        raise ValueError("slice failed")
+
+    with pytest.raises(ValueError, match="slice failed"):
+        list(esextract._iter_parallel([failing, lambda: iter([[2]])], 2))
+
+
+@pytest.mark.parametrize("paging_time_field", ["created_at", None])
+def test_workers_download_the_same_rows_as_one_worker(paging_time_field):
+    es = fake_es.client(fake_es.Dataset(docs=1000, width=2, depth=1))
+    one = esextract.query_to_json("idx", "id", paging_time_field, ["id"], is_match_all=True, client=es)["data"]
+    many = esextract.query_to_json("idx", "id", paging_time_field, ["id"], is_match_all=True, workers=4, client=es)["data"]
+    assert len(many) == len(one) == 1000
+    assert sorted(row["id"] for row in many) == [row["id"] for row in one]
+    if paging_time_field != None:  # Time windows are joined in order
+        assert many == one
@@ -0,0 +1,125 @@
+import datetime
+import os
+
+import pandas
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import esextract
+
+
+def _write(path, pages, schema=None):
+    writer = esextract._open_page_writer(str(path), ["a"], schema, None, "snappy")
+    for page in pages:
+        writer.write(page)
+    writer.close()
+    if str(path).endswith(".parquet"):
+        return pq.read_table(path)
+    with pa.OSFile(str(path)) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+@pytest.mark.parametrize("ext", ["parquet", "feather"])
+def test_floats_after_integers_widen(tmp_path, ext):
+    table = _write(tmp_path / f"out.{ext}", [[{"a": 1}, {"a": 2}], [{"a": 5.5}]])
+    assert table.schema.field("a").type == pa.float64()
+    assert table.column("a").to_pylist() == [1.0, 2.0, 5.5]
+
+
+@pytest.mark.parametrize("ext", ["parquet", "feather"])
+def test_values_after_empty_page_become_strings(tmp_path, ext):
+    table = _write(tmp_path / f"out.{ext}", [[{"a": ""}, {"a": ""}], [{"a": 3}]])
+    assert table.schema.field("a").type == pa.string()
+    assert table.column("a").to_pylist() == ["", "", "3"]
+
+
+def test_large_integers_stay_exact(tmp_path):
+    table = _write(tmp_path / "out.parquet", [[{"a": 2**53 + 1}], [{"a": 2}]])
+    assert table.schema.field("a").type == pa.int64()
+    assert table.column("a").to_pylist() == [2**53 + 1, 2]
+
+
+def test_lists_after_numbers_go_to_a_new_file(tmp_path):
+    table = _write(tmp_path / "out.parquet", [[{"a": 1}], [{"a": [1, 2]}]])
+    assert table.column("a").to_pylist() == [1.0]
+    assert pq.read_table(tmp_path / "out.part0001.parquet").column("a").to_pylist() == ["[1, 2]"]
+
+
+def test_declared_type_mismatch_raises(tmp_path):
+    with pytest.raises(Exception, match="does not match the declared schema type"):
+        _write(tmp_path / "out.parquet", [[{"a": 1}], [{"a": 5.5}]], pa.schema([("a", pa.int64())]))
+
+
+def test_partitioned_parts_share_a_schema(tmp_path):
+    writer = esextract._PartitionedWriter(str(tmp_path / "out"), ".parquet", ["a", "b"], max_rows_per_file=1)
+    writer.write([{"a": 1, "b": ""}, {"a": 2.5, "b": "x"}])
+    writer.close()
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(tmp_path) for name in names if name.endswith(".parquet"))
+    schemas = [pq.read_schema(path) for path in paths]
+    assert len(schemas) == 2
+    assert all(schema.equals(schemas[0]) for schema in schemas)
+    assert schemas[0].field("a").type == pa.float64()
+    assert schemas[0].field("b").type == pa.string()
+
+
+def test_strings_after_empty_page_keep_empty_strings(tmp_path):
+    table = _write(tmp_path / "out.parquet", [[{"a": ""}], [{"a": "x"}, {"a": ""}]])
+    assert table.column("a").to_pylist() == ["", "x", ""]
+
+
+def test_partitioned_parts_read_back_with_one_schema(tmp_path):
+    writer = esextract._PartitionedWriter(str(tmp_path / "out"), ".parquet", ["a"], max_rows_per_file=2)
+    writer.write([{"a": 1}, {"a": 2}, {"a": "x"}])
+    writer.close()
+    writer.write_manifest()
+    df = esextract.read_dataframe_from_file(str(tmp_path / "out"))
+    assert sorted(df["a"].tolist()) == ["1", "2", "x"]
+
+
+def test_partitioned_part_files_that_arrow_can_not_cast_are_read(tmp_path):
+    writer = esextract._PartitionedWriter(str(tmp_path / "out"), ".parquet", ["a"])
+    writer.write([{"a": 1}])
+    writer.write([{"a": [1, 2]}])
+    writer.close()
+    writer.write_manifest()
+    assert len(writer.files) == 2
+    df = esextract.read_dataframe_from_file(str(tmp_path / "out"))
+    assert sorted(df["a"].tolist()) == ["1", "[1, 2]"]
+
+
+@pytest.mark.parametrize("field, expected", [
+    ({"type": "date"}, "timestamp[ms]"),
+    ({"type": "date", "format": "strict_date_optional_time||epoch_millis"}, "timestamp[ms]"),
+    ({"type": "date", "format": "strict_date_optional_time_nanos"}, "timestamp[ns]"),
+    ({"type": "date_nanos"}, "timestamp[ns]"),
+    ({"type": "date", "format": "yyyy/MM/dd HH:mm:ss"}, None),
+    ({"type": "date", "format": "strict_date||epoch_second"}, None),
+])
+def test_mapped_date_types(field, expected):
+    assert esextract._mapped_type({"properties": {"created_at": field}}, "created_at") == expected
+
+
+def test_mapped_nested_and_multi_field_types():
+    mapping = {"properties": {"user": {"properties": {"id": {"type": "long"}}}, "text": {"type": "text", "fields": {"keyword": {"type": "keyword"}}}}}
+    assert esextract._mapped_type(mapping, "user.id") == "int64"
+    assert esextract._mapped_type(mapping, "text.keyword") == "string"
+    assert esextract._mapped_type(mapping, "user") == None
+
+
+def test_dates_that_do_not_parse_are_kept_as_text():
+    schema = pa.schema([("created_at", pa.timestamp("ms", tz="UTC"))])
+    table = esextract._rows_to_table([{"created_at": "2021-01-01T00:00:00.123456789Z"}, {"created_at": ""}], ["created_at"], schema)
+    assert table.column("created_at").to_pylist() == ["2021-01-01T00:00:00.123456789Z", None]
+
+
+def test_epoch_milliseconds_mixed_with_date_strings():
+    schema = pa.schema([("created_at", pa.timestamp("ms", tz="UTC"))])
+    table = esextract._rows_to_table([{"created_at": "2021-01-01"}, {"created_at": 1609459200000}], ["created_at"], schema)
+    assert table.schema.field("created_at").type == schema.field("created_at").type
+    assert table.column("created_at").to_pylist() == [datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)] * 2
+
+
+def test_epoch_milliseconds_in_nanosecond_dates():
+    table = esextract._rows_to_table([{"created_at": 1609459200000}], ["created_at"], pa.schema([("created_at", pa.timestamp("ns", tz="UTC"))]))
+    assert table.column("created_at").to_pylist() == [pandas.Timestamp("2021-01-01", tz="UTC")]